@@ -47,25 +47,127 @@
 ############################################################################################
 import serial
 import time
+import contextlib
+import threading
+from servo_model import ServoModel
 def log(*msgline):
     for msg in msgline:
         print msg,
     print
+
+## One move of a channel's output as the Maestro makes it, from start to end (us), begun at time started, timed by model (a
+## servo_model.ServoModel of the channel's speed and acceleration settings): the speed ramps up at the acceleration limit
+## until it reaches the speed limit, then ramps down the same way to stop at end.
+## A move is taken to start from rest, as one begun while the output is still moving has no way to carry its speed over.
+class ServoMotion(object):
+    def __init__(self,started,start,end,model):
+        self.started = started
+        self.start = float(start)
+        self.end = float(end)
+        self.distance = abs(self.end - self.start)
+        self.acceleration = model.acceleration
+        self.speed = float(model.top_speed(self.distance))
+        self.ramp = self.speed / self.acceleration if self.acceleration is not None else 0.0
+        self.duration = float(model.move_time(self.start,self.end))
+
+    @property
+    def arrival(self):
+        return self.started + self.duration
+
+    ## distance covered elapsed seconds into the move
+    def travelled(self,elapsed):
+        if elapsed <= 0:
+            return 0.0
+        if elapsed >= self.duration:
+            return self.distance
+        if self.acceleration is None:
+            return self.speed * elapsed
+        if elapsed < self.ramp:
+            return 0.5 * self.acceleration * elapsed ** 2
+        if elapsed > self.duration - self.ramp:
+            return self.distance - 0.5 * self.acceleration * (self.duration - elapsed) ** 2
+        return 0.5 * self.speed * self.ramp + self.speed * (elapsed - self.ramp)
+
+    def position(self,t):
+        travelled = self.travelled(t - self.started)
+        return self.start + travelled if self.end >= self.start else self.start - travelled
+
+    ## seconds into the move at which the output first reaches position, which must lie between start and end
+    def elapsed_at(self,position):
+        travelled = min(abs(position - self.start),self.distance)
+        low,high = 0.0,self.duration
+        for i in range(40):
+            middle = (low + high) / 2
+            if self.travelled(middle) < travelled:
+                low = middle
+            else:
+                high = middle
+        return high
+
+## the outcome of Device.wait_for_motion_async: arrived is True once the servos reach their targets, False if the wait
+## timed out, in which case errors holds the error flags read then
+class MotionWait(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.arrived = None
+        self.errors = None
+
+    def done(self):
+        return self.event.is_set()
+
+    ## blocks until the wait is over (or timeout seconds), then returns arrived
+    def wait(self,timeout=None):
+        self.event.wait(timeout)
+        return self.arrived
+
+    ## calls fn(self) from the waiting thread once the wait is over, or straight away if it already is
+    def add_done_callback(self,fn):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def finish(self,arrived,errors):
+        with self.lock:
+            self.arrived = arrived
+            self.errors = errors
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            fn(self)
 class Device(object):
-    def __init__(self,con_port="COM4",ser_port="COM5",timeout=1): #/dev/ttyACM0  and   /dev/ttyACM1  for Linux
+    # con_port and ser_port may also be already open serial-like objects, e.g. a stand-in for testing
+    # multiple_targets, moving_state: use Set Multiple Targets and Get Moving State, which only the Mini Maestro 12, 18 and 24
+    # understand
+    def __init__(self,con_port="COM4",ser_port="COM5",timeout=1,multiple_targets=False,moving_state=False): #/dev/ttyACM0  and   /dev/ttyACM1  for Linux
         ############################
         # lets introduce and init the main variables
         self.con = None
         self.ser = None
         self.isInitialized = False
         self.targets = [0] * 24
+        self.speeds = [0] * 24
+        self.accelerations = [0] * 24
+        self.motions = [None] * 24 # ServoMotion of the last target set on each channel, if where it started from is known
+        self.positions = [None] * 24 # (time, position) last read from each channel
+        self.last_errors = None # error flags read when a wait_for_motion timed out
+        self.multiple_targets = multiple_targets
+        self.moving_state = moving_state
+        self.queued = None # commands held back until flush_batch, see batch
+        self.lock = threading.RLock() # keeps each command and its reply together when several threads use the device
         ############################
         # lets connect the TTL Port
         try:
-            self.con = serial.Serial(con_port,timeout=timeout)
-            self.con.baudrate = 9600
-            self.con.close()
-            self.con.open()
+            if hasattr(con_port, 'write'):
+                self.con = con_port
+            else:
+                self.con = serial.Serial(con_port,timeout=timeout)
+                self.con.baudrate = 9600
+                self.con.close()
+                self.con.open()
             log("Link to Command Port -", con_port, "- successful")
         except serial.serialutil.SerialException, e:
             print e
@@ -84,9 +186,12 @@ class Device(object):
         ###################################
         # lets connect the TTL Port
         try:
-            self.ser = serial.Serial(ser_port,timeout=timeout)
-            self.ser.close()
-            self.ser.open()
+            if hasattr(ser_port, 'write'):
+                self.ser = ser_port
+            else:
+                self.ser = serial.Serial(ser_port,timeout=timeout)
+                self.ser.close()
+                self.ser.open()
             log("Link to TTL Port -", ser_port, "- successful")
         except serial.serialutil.SerialException, e:
             print e
@@ -100,14 +205,54 @@ class Device(object):
 
     ###########################################################################################################################
     ## common write function for handling all write related tasks
+    # The command is sent as one write, or held back with any others until the batch is flushed
     def write(self,*data):
         if not self.isInitialized: log("Not initialized"); return
+        if self.queued is not None:
+            self.queued.extend(data)
+            return
+        self.send(bytearray(data))
+
+    ## sends commands expecting a reply, along with any held back, so the reply can be read straight after
+    def request(self,*data):
+        if not self.isInitialized: log("Not initialized"); return
+        buf = bytearray(data)
+        if self.queued:
+            buf = self.queued + buf
+            self.queued = bytearray()
+        self.send(buf)
+
+    def send(self,buf):
         if not self.ser.writable():
             log("Device not writable")
             return
-        for d in data:
-            self.ser.write(chr(d))
-        self.ser.flush()
+        with self.lock:
+            self.ser.write(bytes(buf))
+            self.ser.flush()
+
+    ###########################################################################################################################
+    ## Batches of commands
+    # Between begin_batch and flush_batch, commands are collected and then all sent in one write, e.g.
+    #     with device.batch():
+    #         device.set_target(0, 1452)
+    #         device.set_target(1, 1886)
+    # Commands with a reply (get_position etc.) send everything collected so far with them.
+    def begin_batch(self):
+        if self.queued is None:
+            self.queued = bytearray()
+
+    def flush_batch(self):
+        queued, self.queued = self.queued, None
+        if queued:
+            self.send(queued)
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.flush_batch()
     
     ###########################################################################################################################
     ## Go Home
@@ -120,6 +265,9 @@ class Device(object):
     def go_home(self):
         if not self.isInitialized: log("Not initialized"); return
         self.write(0xA2)
+        # the home positions aren't known here
+        self.motions = [None] * len(self.motions)
+        self.positions = [None] * len(self.positions)
     
     ###########################################################################################################################
     ## Set Target
@@ -134,7 +282,52 @@ class Device(object):
         highbits,lowbits = divmod(value,32)
         self.write(0x84,servo,lowbits << 2,highbits)
         # Record Target value
+        self.record_target(servo,value)
+
+    ## starts the predicted motion of a channel sent to value, from where it is predicted to be now
+    def record_target(self,servo,value):
+        now = time.time()
+        start = self.predicted_position(servo,now)
+        if start is None and self.targets[servo]:
+            start = self.targets[servo] # never read, so taken to have reached the last target
+        if start is None:
+            self.motions[servo] = None
+        else:
+            self.motions[servo] = ServoMotion(now,start,value,self.servo_model(servo))
         self.targets[servo] = value
+
+    ###########################################################################################################################
+    ## Set Multiple Targets (Mini Maestro 12, 18, and 24 only)
+    # Compact protocol: 0x9F, number of targets, first channel number, first target low bits, first target high bits, second
+    # target low bits, second target high bits, ...
+    # --
+    # This command simultaneously sets the targets for a contiguous block of channels. The first byte specifies how many
+    # channels are in the contiguous block; this is the number of target values you will need to send. The second byte
+    # specifies the lowest channel number in the block. The subsequent bytes contain the target values for each of the
+    # channels, in order by channel number, in the same format as the Set Target command above.
+    # --
+    # Source: https://www.pololu.com/docs/pdf/0J40/maestro.pdf
+    def set_multiple_targets(self,first_servo,values):
+        if not self.isInitialized: log("Not initialized"); return
+        data = [0x9F,len(values),first_servo]
+        for value in values:
+            highbits,lowbits = divmod(value,32)
+            data += [lowbits << 2,highbits]
+        self.write(*data)
+        for servo,value in enumerate(values,first_servo):
+            self.record_target(servo,value)
+
+    ## sets the targets of several servos, given as {channel: target}, in one write: with Set Multiple Targets if the
+    ## channels are contiguous and the Maestro has it, or else as a batch of Set Target commands
+    def set_targets(self,targets):
+        if not self.isInitialized: log("Not initialized"); return
+        channels = sorted(targets)
+        if self.multiple_targets and channels == list(range(channels[0], channels[0] + len(channels))):
+            self.set_multiple_targets(channels[0], [targets[c] for c in channels])
+        else:
+            with self.batch():
+                for c in channels:
+                    self.set_target(c, targets[c])
     
     ###########################################################################################################################
     ## Set Speed
@@ -158,6 +351,7 @@ class Device(object):
         lowbits = speed & 0x7f #7 bits for least significant byte
         highbits = (speed >> 7) & 0x7f #shift 7 and take next 7 bits for msb
         self.write(0x87,servo,lowbits,highbits)
+        self.speeds[servo] = speed
         
         
     ###########################################################################################################################
@@ -179,7 +373,8 @@ class Device(object):
         if not self.isInitialized: log("Not initialized"); return
         lowbits = acceleration & 0x7f #7 bits for least significant byte
         highbits = (acceleration >> 7) & 0x7f #shift 7 and take next 7 bits for msb
-        self.write(0x87,servo,lowbits,highbits)
+        self.write(0x89,servo,lowbits,highbits)
+        self.accelerations[servo] = acceleration
         
     ###########################################################################################################################
     ## Get Position
@@ -210,12 +405,33 @@ class Device(object):
     # Source: https://www.pololu.com/docs/pdf/0J40/maestro.pdf
     def get_position(self,servo):
         if not self.isInitialized: log("Not initialized"); return None
-        self.write(0x90,servo)
-        data = self.ser.read(2)
+        with self.lock:
+            self.request(0x90,servo)
+            data = self.ser.read(2)
+            read_at = time.time()
         if data:
-            return (ord(data[0])+(ord(data[1])<<8))/4
+            position = (ord(data[0])+(ord(data[1])<<8))/4
+            self.correct_drift(servo,position,read_at)
+            return position
         else:
             return None
+
+    ## the positions of several channels, asked for in one write; None if any reply timed out
+    def get_positions(self,servos):
+        if not self.isInitialized: log("Not initialized"); return None
+        data = []
+        for servo in servos:
+            data += [0x90,servo]
+        with self.lock:
+            self.request(*data)
+            data = bytearray(self.ser.read(2 * len(servos)))
+            read_at = time.time()
+        if len(data) < 2 * len(servos):
+            return None
+        positions = [(data[2*i]+(data[2*i+1]<<8))/4 for i in range(len(servos))]
+        for servo,position in zip(servos,positions):
+            self.correct_drift(servo,position,read_at)
+        return positions
     
     ###########################################################################################################################    
     ## Get Moving State
@@ -230,8 +446,9 @@ class Device(object):
     # Source: https://www.pololu.com/docs/pdf/0J40/maestro.pdf
     def get_moving_state(self):
         if not self.isInitialized: log("Not initialized"); return None
-        self.write(0x93)
-        data = self.ser.read(1)
+        with self.lock:
+            self.request(0x93)
+            data = self.ser.read(1)
         if data:
             return ord(data[0])
         else:
@@ -269,18 +486,140 @@ class Device(object):
     # Source: https://www.pololu.com/docs/pdf/0J40/maestro.pdf
     def get_errors(self):
         if not self.isInitialized: log("Not initialized"); return None
-        self.write(0xA1)
-        data = self.ser.read(2)
+        with self.lock:
+            self.request(0xA1)
+            data = self.ser.read(2)
         if data:
             return ord(data[0])+(ord(data[1])<<8)
         else:
             return None
     
     ###########################################################################################################################
-    ## a helper function for Set Target. NOTE: CAN'T use with Micro 6 
+    ## Waiting for moves to finish
+    # channels: the channels to wait for, None being every channel given a target. If they include every such channel and the
+    # Maestro has Get Moving State (moving_state=True), they are asked about with that; otherwise their positions are read,
+    # which has the same caveats as is_moving.
+
+    ## True while any of channels is on its way to its target, None if the Maestro didn't answer
+    def moving(self,channels=None):
+        targeted = [c for c in range(len(self.targets)) if self.targets[c]]
+        if channels is None:
+            channels = targeted
+        if not channels:
+            return False
+        if self.moving_state and set(channels) >= set(targeted): # one byte says whether any of them is moving
+            state = self.get_moving_state()
+            return None if state is None else state == 1
+        positions = self.get_positions(channels)
+        if positions is None:
+            return None
+        return any(position != self.targets[c] for c,position in zip(channels,positions))
+
+    ## seconds until channels are predicted to reach their targets, see predicted_arrival. A channel whose motion isn't
+    ## known counts as arriving straight away.
+    def remaining_time(self,channels=None,now=None):
+        if now is None:
+            now = time.time()
+        if channels is None:
+            channels = range(len(self.targets))
+        arrivals = [self.predicted_arrival(c) for c in channels]
+        return max([arrival - now for arrival in arrivals if arrival is not None] + [0.0])
+
+    ## waits for channels to reach their targets: sleeps until they are predicted to, then asks every interval seconds.
+    ## During long moves the positions are read every check_interval seconds, to correct the prediction (see
+    ## correct_drift). Returns True once they have arrived, or False after timeout seconds, having read (and cleared) the
+    ## Maestro's error flags into last_errors and logged them.
+    def wait_for_motion(self,channels=None,timeout=None,interval=0.005,check_interval=0.5):
+        if not self.isInitialized: log("Not initialized"); return False
+        deadline = None if timeout is None else time.time() + timeout
+        checked = time.time()
+        while True:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            wait = self.remaining_time(channels,now)
+            if wait <= 0:
+                if self.moving(channels) is False:
+                    return True
+                wait = interval
+            elif now - checked >= check_interval:
+                checked = now
+                moving = [c for c in (range(len(self.targets)) if channels is None else channels) if self.motions[c]]
+                if moving:
+                    self.get_positions(moving)
+                    continue
+            wait = min(wait,check_interval)
+            if deadline is not None:
+                wait = min(wait,deadline - now)
+            time.sleep(wait)
+        self.last_errors = self.get_errors()
+        log("Servos still moving after",timeout,"s, error flags:",self.last_errors)
+        return False
+
+    ## wait_for_motion on a thread of its own. Returns a MotionWait, and calls callback(motion_wait) when it is over.
+    def wait_for_motion_async(self,channels=None,timeout=None,interval=0.005,callback=None):
+        result = MotionWait()
+        if callback is not None:
+            result.add_done_callback(callback)
+        def run():
+            arrived = self.wait_for_motion(channels,timeout,interval)
+            result.finish(arrived,None if arrived else self.last_errors)
+        thread = threading.Thread(target=run,name='maestro motion wait')
+        thread.daemon = True
+        thread.start()
+        return result
+
+    ###########################################################################################################################
+    ## Predicted motion
+    # Every target set is followed with a ServoMotion from the speed and acceleration settings, so where a channel is, and when
+    # it will get to its target, can be told without asking the Maestro. Positions read from the Maestro correct the
+    # prediction. A channel's motion is only known once its position has been read or it has been given a second target.
+
+    ## the ServoModel of a channel's speed and acceleration settings, as the scan planner times moves with
+    def servo_model(self,channel):
+        return ServoModel(self.speeds[channel],self.accelerations[channel])
+
+    ## predicted position (us) of channel at time t (now, if None), or None if it isn't known
+    def predicted_position(self,channel,t=None):
+        if t is None:
+            t = time.time()
+        if self.motions[channel] is not None:
+            return self.motions[channel].position(t)
+        if self.positions[channel] is not None:
+            return float(self.positions[channel][1])
+        return None
+
+    ## time channel is predicted to reach its target, or None if its motion isn't known
+    def predicted_arrival(self,channel):
+        if self.motions[channel] is None:
+            return None
+        return self.motions[channel].arrival
+
+    ## records position, read from channel at time t, and moves the predicted motion in time to agree with it: servos
+    ## start late, and the Maestro's ramps don't match the model exactly. A position off the predicted path starts a new
+    ## motion from there.
+    def correct_drift(self,channel,position,t):
+        self.positions[channel] = (t,position)
+        motion = self.motions[channel]
+        if motion is None:
+            if position == self.targets[channel]:
+                self.motions[channel] = ServoMotion(t,position,position,self.servo_model(channel))
+            return
+        if abs(motion.position(t) - position) <= 1: # positions are read in whole us
+            return
+        low,high = min(motion.start,motion.end),max(motion.start,motion.end)
+        if position == motion.end:
+            motion.started = min(motion.started,t - motion.duration)
+        elif low <= position <= high:
+            motion.started = t - motion.elapsed_at(position)
+        else:
+            self.motions[channel] = ServoMotion(t,position,motion.end,self.servo_model(channel))
+
+    ###########################################################################################################################
+    ## a helper function for Set Target, waiting for every servo. Without moving_state=True it reads the positions of the
+    ## channels given targets, as Get Moving State doesn't work with the Micro 6
     def wait_until_at_target(self):
-        while (self.get_moving_state()):
-            time.sleep(0.1)
+        self.wait_for_motion()
     
     ###########################################################################################################################
     ## Lets close and clean when we are done
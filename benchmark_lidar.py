@@ -0,0 +1,306 @@
+#Throughput benchmarks for the lidar acquisition path
+#Drives each stage with a synthetic packet stream, so neither the lidar nor VPython is needed
+#requires numpy and pandas
+#
+#Usage:
+#   python benchmark_lidar.py                          # run every stage and print the results
+#   python benchmark_lidar.py --save baseline.json     # also save them as a baseline
+#   python benchmark_lidar.py --compare baseline.json  # flag stages that got slower
+#   python benchmark_lidar.py --stages framing decode_batch
+
+import os, sys, time, math, json, platform, argparse, collections
+import numpy as np
+import pandas as pd
+import rotation as rot
+from lidar_packets import (PacketFramer, PACKETS_PER_REV, INDEX_MIN, checksum, compute_speed,
+                           verify_checksums, decode_packets, packets_to_array)
+from lidar_scan import RevolutionAssembler
+from lidar_replay import ReplaySerial, synthesize_from_csv
+from point_buffer import PointBuffer
+
+try:
+    import tracemalloc # Python 3 only
+except ImportError:
+    tracemalloc = None
+try:
+    import resource # Unix only, allocations are reported as n/a with neither this nor tracemalloc
+except ImportError:
+    resource = None
+
+timer = getattr(time, 'perf_counter', time.time)
+
+LIDAR_PACKET_RATE = 450 # packets/s from the lidar at 300 RPM (90 packets, 360 samples per revolution)
+DEFAULT_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '2D_kitchen_test.csv')
+
+# Each stage is a function taking the benchmark data and returning a list of
+# (work, packets) pairs: work() is timed as one call, and handles that many packets.
+STAGES = collections.OrderedDict()
+
+def stage(fn):
+    STAGES[fn.__name__] = fn
+    return fn
+
+class BenchData(object):
+    """The synthetic stream, as raw bytes and as one (90, 22) packet array per revolution."""
+    def __init__(self, csv, revolutions, seed=0):
+        self.stream = synthesize_from_csv(csv, revolutions, noise_mm=5, seed=seed)
+        self.raw = bytes(self.stream[0])
+        packets = np.frombuffer(self.raw, dtype=np.uint8).reshape(-1, 22)
+        self.revolutions = [packets[i:i + PACKETS_PER_REV] for i in range(0, len(packets), PACKETS_PER_REV)]
+        self.lists = [[p.tolist() for p in rev] for rev in self.revolutions]
+
+def legacy_sample(angle, data, lidar_df=None):
+    """The per-sample work update_view() does with visualization off; stored samples are rotated
+to the pose (yaw 25, pitch 7) a point at a time, as lidar3Dstore did.
+"""
+    x, x1, x2, x3 = data
+    angle_rad = angle * math.pi / 180.0
+    c = math.cos(angle_rad)
+    s = -math.sin(angle_rad)
+    dist_mm = x | ((x1 & 0x3f) << 8)
+    quality = x2 | (x3 << 8)
+    if lidar_df is not None and not x1 & 0x80:
+        dist_x, dist_y, dist_z = rot.rotation(dist_mm * c, dist_mm * s, 0, 25.0, 7.0)
+        lidar_df.loc[angle] = [dist_x, dist_y, dist_z, quality, 1 if x1 & 0x40 else 0]
+    return dist_mm * c, dist_mm * s, quality
+
+@stage
+def framing(bench):
+    framer = PacketFramer()
+    chunk = 512
+    return [(lambda i=i: framer.feed(bench.raw[i:i + chunk]), chunk / 22.0) for i in range(0, len(bench.raw), chunk)]
+
+@stage
+def checksum_scalar(bench):
+    def work(rev):
+        for p in rev:
+            checksum(p) == p[20] + (p[21] << 8)
+    return [(lambda rev=rev: work(rev), len(rev)) for rev in bench.lists]
+
+@stage
+def checksum_batch(bench):
+    return [(lambda rev=rev: verify_checksums(rev), len(rev)) for rev in bench.revolutions]
+
+@stage
+def decode_scalar(bench):
+    def work(rev):
+        for p in rev:
+            compute_speed(p[2:4])
+            index = p[1] - INDEX_MIN
+            for k in range(4):
+                legacy_sample(index * 4 + k, p[4 + 4 * k:8 + 4 * k])
+    return [(lambda rev=rev: work(rev), len(rev)) for rev in bench.lists]
+
+@stage
+def decode_batch(bench):
+    return [(lambda rev=rev: decode_packets(rev), len(rev)) for rev in bench.revolutions]
+
+@stage
+def transform_scalar(bench):
+    def work(samples):
+        for angle, dist_mm in zip(samples['angle'].ravel().tolist(), samples['dist_mm'].ravel().tolist()):
+            angle_rad = math.radians(angle)
+            rot.rotation(dist_mm * math.cos(angle_rad), -dist_mm * math.sin(angle_rad), 0, 25.0, 7.0)
+    return [(lambda s=decode_packets(rev): work(s), len(rev)) for rev in bench.revolutions]
+
+@stage
+def transform_batch(bench):
+    """A revolution's valid samples through one cached rotation matrix."""
+    def work(samples):
+        samples = samples.ravel()
+        valid = ~samples['invalid']
+        rot.transform_polar(samples['angle'][valid], samples['dist_mm'][valid], 25.0, 7.0)
+    return [(lambda s=decode_packets(rev): work(s), len(rev)) for rev in bench.revolutions]
+
+@stage
+def transform_table(bench):
+    """A whole revolution through a precomputed per-pose projection table, as project_scan does."""
+    table = rot.ProjectionTable([{'id': 0, 'yaw': 25.0, 'pitch': 7.0}])
+    def work(samples):
+        samples = samples.ravel()
+        xyz = table.project(0, samples['dist_mm'])
+        xyz[samples['invalid']] = 0
+    return [(lambda s=decode_packets(rev): work(s), len(rev)) for rev in bench.revolutions]
+
+@stage
+def storage_loc(bench):
+    columns = ['x_pos', 'y_pos', 'z_pos', 'intensity', 'quality_warning']
+    lidar_df = pd.DataFrame(index=range(360), columns=columns)
+    def work(samples):
+        for s in samples.ravel().tolist():
+            angle, dist_mm, quality, invalid, warning, rpm = s
+            if not invalid:
+                lidar_df.loc[angle] = [float(dist_mm), 0.0, 0, quality, int(warning)]
+    return [(lambda s=decode_packets(rev): work(s), len(rev)) for rev in bench.revolutions]
+
+@stage
+def storage_buffer(bench):
+    """Revolutions written into a preallocated PointBuffer, one row per angle and location."""
+    points = PointBuffer(360 * len(bench.revolutions))
+    angle_rad = np.radians(np.arange(360))
+    unit = np.column_stack((np.cos(angle_rad), -np.sin(angle_rad), np.zeros(360)))
+    def work(loc, samples):
+        samples = samples.ravel()
+        angles = np.flatnonzero(~samples['invalid'])
+        xyz = unit[angles] * samples['dist_mm'][angles, None]
+        points.write(angles + 360 * loc, xyz, samples['quality'][angles], samples['warning'][angles], loc)
+    return [(lambda loc=loc, s=decode_packets(rev): work(loc, s), len(rev)) for loc, rev in enumerate(bench.revolutions)]
+
+@stage
+def storage_scan(bench):
+    assembler = RevolutionAssembler()
+    return [(lambda rev=rev: assembler.add_packets(rev), len(rev)) for rev in bench.revolutions]
+
+@stage
+def end_to_end_legacy(bench):
+    """Scalar checksum, decode, rotation and DataFrame.loc storage, as read_Lidar() did before the framer."""
+    columns = ['x_pos', 'y_pos', 'z_pos', 'intensity', 'quality_warning']
+    lidar_df = pd.DataFrame(index=range(360), columns=columns)
+    def work(rev):
+        for p in rev:
+            if checksum(p) == p[20] + (p[21] << 8):
+                compute_speed(p[2:4])
+                index = p[1] - INDEX_MIN
+                for k in range(4):
+                    legacy_sample(index * 4 + k, p[4 + 4 * k:8 + 4 * k], lidar_df)
+    return [(lambda rev=rev: work(rev), len(rev)) for rev in bench.lists]
+
+@stage
+def end_to_end(bench):
+    """Replayed port, framer, batch checksum, revolution assembly, projection and PointBuffer storage,
+as lidar3Dstore's reader, decoder, transform and storage stages do them."""
+    ser = ReplaySerial(bench.stream, speed=0)
+    framer = PacketFramer(ser)
+    assembler = RevolutionAssembler()
+    table = rot.ProjectionTable([{'id': 0, 'yaw': 25.0, 'pitch': 7.0}])
+    points = PointBuffer(360 * len(bench.revolutions))
+    def store(scan):
+        xyz = table.project(0, scan.dist_mm)
+        angles = np.flatnonzero(scan.valid)
+        points.write(angles + 360 * scan.sequence, xyz[angles], scan.quality[angles], scan.warning[angles], scan.sequence)
+    assembler.subscribe(store)
+    def work():
+        # one revolution per read, as a port read in real time would deliver
+        packets = framer.feed(ser.read(PACKETS_PER_REV * 22))
+        data = packets_to_array(packets)
+        assembler.add_packets(data, verify_checksums(data))
+    return [(work, PACKETS_PER_REV) for rev in bench.revolutions]
+
+def peak_alloc(name, bench):
+    """Peak bytes allocated by an untimed pass through a stage, or None if they can't be measured.
+
+With tracemalloc this is the peak of the memory it traced. Without it (Python 2) on Linux, the
+pass runs in a forked process and the figure is the growth of its peak resident size, leaving
+out the library code paged in and less that of a process doing nothing. That counts whole pages,
+so it is only a rough match for the tracemalloc figures.
+"""
+    work = STAGES[name](bench)
+    if tracemalloc:
+        # tracing slows everything down, hence the second pass
+        tracemalloc.start()
+        for fn, n in work:
+            fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+    if resource is None or not os.path.exists('/proc/self/status'):
+        return None
+    return max(0, peak_rss_growth(work) - peak_rss_growth([]))
+
+def file_rss():
+    """kB of the process's resident memory backed by files, mostly library code."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssFile:'):
+                return int(line.split()[1])
+    return 0
+
+def peak_rss_growth(work):
+    """Bytes the peak resident size, less file-backed memory, grows by running work in a forked process."""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        start, start_file = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, file_rss()
+        for fn, n in work:
+            fn()
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start - (file_rss() - start_file)
+        os.write(write_end, str(growth).encode())
+        os._exit(0)
+    os.close(write_end)
+    growth = os.read(read_end, 64)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return int(growth) * 1024 # both are in kB
+
+def run_stage(name, bench):
+    """Time one stage, returning its results as a dict."""
+    work = STAGES[name](bench)
+    latencies = []
+    packets = 0
+    start = timer()
+    for fn, n in work:
+        t = timer()
+        fn()
+        latencies.append(timer() - t)
+        packets += n
+    total = timer() - start
+    alloc = peak_alloc(name, bench)
+    if alloc is not None:
+        alloc /= float(packets)
+    latencies = np.array(latencies) * 1000.0 / np.array([n for fn, n in work]) * PACKETS_PER_REV
+    pps = packets / total
+    return collections.OrderedDict([
+        ('packets_per_s', pps),
+        ('lidar_headroom', pps / LIDAR_PACKET_RATE),
+        ('p50_ms_per_rev', float(np.percentile(latencies, 50))),
+        ('p90_ms_per_rev', float(np.percentile(latencies, 90))),
+        ('p99_ms_per_rev', float(np.percentile(latencies, 99))),
+        ('peak_alloc_bytes_per_packet', alloc),
+    ])
+
+def compare(results, baseline, tolerance):
+    """Return the names of stages whose packet rate fell more than tolerance below the baseline."""
+    slower = []
+    for name, result in results.items():
+        old = baseline['stages'].get(name)
+        if old is None:
+            continue
+        ratio = result['packets_per_s'] / old['packets_per_s']
+        flag = ''
+        if ratio < 1 - tolerance:
+            slower.append(name)
+            flag = '  <-- REGRESSION'
+        print('%-20s %6.2fx baseline%s' % (name, ratio, flag))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the lidar acquisition path')
+    parser.add_argument('--csv', default=DEFAULT_CSV, help='stored scan used to synthesize the stream')
+    parser.add_argument('--revolutions', type=int, default=50)
+    parser.add_argument('--stages', nargs='*', default=list(STAGES), choices=list(STAGES))
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fractional slowdown')
+    args = parser.parse_args()
+
+    bench = BenchData(args.csv, args.revolutions)
+    results = collections.OrderedDict()
+    print('%-20s %12s %9s %9s %9s %9s %11s' % ('stage', 'packets/s', 'x lidar', 'p50 ms', 'p90 ms', 'p99 ms', 'B/packet'))
+    for name in args.stages:
+        r = results[name] = run_stage(name, bench)
+        alloc = 'n/a' if r['peak_alloc_bytes_per_packet'] is None else '%.0f' % r['peak_alloc_bytes_per_packet']
+        print('%-20s %12.0f %9.2f %9.3f %9.3f %9.3f %11s' % (name, r['packets_per_s'], r['lidar_headroom'],
+              r['p50_ms_per_rev'], r['p90_ms_per_rev'], r['p99_ms_per_rev'], alloc))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                       'revolutions': args.revolutions, 'stages': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#Command latency benchmark for altMaestro
+#Drives a Device over a stand-in serial port that counts writes and flushes and sends the bytes
+#to the null device, so no Maestro is needed. Each write can also be made to take a fixed time,
+#standing in for the USB round trip of a real port, to show what the number of writes costs.
+#
+#Usage:
+#   python benchmark_maestro.py                        # writes cost only the system call
+#   python benchmark_maestro.py --write-latency 0.001  # and 1 ms per write, about a USB frame
+
+import os, time, argparse
+import altMaestro
+
+timer = getattr(time, 'perf_counter', time.time)
+
+class FakeSerial(object):
+    """Enough of serial.Serial for altMaestro.Device: writes go to the null device, reads get zeros."""
+    def __init__(self, write_latency=0.0):
+        self.fd = os.open(os.devnull, os.O_WRONLY)
+        self.write_latency = write_latency
+        self.writes = 0
+        self.flushes = 0
+        self.bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        os.write(self.fd, data)
+        if self.write_latency:
+            time.sleep(self.write_latency)
+        self.writes += 1
+        self.bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        self.flushes += 1
+
+    def read(self, size=1):
+        return b'\x00' * size
+
+    def close(self):
+        os.close(self.fd)
+
+    def reset(self):
+        self.writes = self.flushes = self.bytes = 0
+
+def legacy_write(device, *data):
+    """Device.write as it was: a write per byte, then a flush."""
+    for d in data:
+        device.ser.write(chr(d))
+    device.ser.flush()
+
+def legacy_set_target(device, servo, value):
+    highbits, lowbits = divmod(value, 32)
+    legacy_write(device, 0x84, servo, lowbits << 2, highbits)
+
+def legacy_two_targets(device, yaw, pitch):
+    legacy_set_target(device, 0, yaw)
+    legacy_set_target(device, 1, pitch)
+
+def set_target(device, yaw, pitch):
+    device.set_target(0, yaw)
+
+def two_targets(device, yaw, pitch):
+    device.set_target(0, yaw)
+    device.set_target(1, pitch)
+
+def batched_targets(device, yaw, pitch):
+    with device.batch():
+        device.set_target(0, yaw)
+        device.set_target(1, pitch)
+
+def multiple_targets(device, yaw, pitch):
+    device.set_multiple_targets(0, [yaw, pitch])
+
+def legacy_one_target(device, yaw, pitch):
+    legacy_set_target(device, 0, yaw)
+
+def target_and_errors(device, yaw, pitch):
+    with device.batch():
+        device.set_target(0, yaw)
+        device.set_target(1, pitch)
+        device.get_errors()
+
+CASES = [('set_target, per-byte writes', legacy_one_target),
+         ('set_target', set_target),
+         ('2 targets, per-byte writes', legacy_two_targets),
+         ('2 targets, set_target each', two_targets),
+         ('2 targets, batch', batched_targets),
+         ('2 targets, set_multiple_targets', multiple_targets),
+         ('2 targets + get_errors, batch', target_and_errors)]
+
+def run(device, fn, calls):
+    port = device.ser
+    port.reset()
+    start = timer()
+    for n in range(calls):
+        fn(device, 1000 + n % 1000, 2000 - n % 1000)
+    seconds = timer() - start
+    return seconds / calls, port.writes / float(calls), port.flushes / float(calls), port.bytes / float(calls)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Maestro command latency over a stand-in serial port')
+    parser.add_argument('--calls', type=int, default=2000, help='calls timed per case')
+    parser.add_argument('--write-latency', type=float, default=0.0, help='seconds each write takes')
+    args = parser.parse_args()
+    device = altMaestro.Device(FakeSerial(), FakeSerial(args.write_latency))
+    calls = args.calls if not args.write_latency else min(args.calls, 200)
+    print('')
+    print('%-32s  %10s  %7s  %8s  %6s' % ('case', 'us/call', 'writes', 'flushes', 'bytes'))
+    for name, fn in CASES:
+        seconds, writes, flushes, size = run(device, fn, calls)
+        print('%-32s  %10.1f  %7.1f  %8.1f  %6.1f' % (name, seconds * 1e6, writes, flushes, size))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#Batch conversion of stored CSV scans to .xvpc files, with a catalog of what was converted
+#Files are converted in parallel, one per worker process, each read a chunk of rows at a
+#time; empty rows are dropped. The catalog (catalog.json in the output directory) records
+#each scan's point count, bounding box and intensity histogram, so scans can be found
+#without reading them again
+#requires numpy and pandas
+#
+#Usage:
+#   python convert_scans.py convert old_scans/ more_scans/3D_Test_1.csv --output-dir converted
+#   python convert_scans.py list converted/catalog.json --min-points 1000 --contains 0 0 0
+
+import os, sys, json, glob, time, argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from point_buffer import PointBuffer
+from lidar_format import write_points
+
+CATALOG = 'catalog.json'
+# intensity histogram bins; the first three edges are display_lidar_data's color bands
+HISTOGRAM_EDGES = [0, 10, 30, 60, 100, 250, 500, 1000, 65536]
+
+def count_lines(fn, block_bytes=1 << 20):
+    lines = 0
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(block_bytes), b''):
+            lines += block.count(b'\n')
+    return lines
+
+def read_csv_points(fn, chunk_rows=50000):
+    """The points of a stored CSV scan, in either layout, read chunk_rows rows at a time.
+
+Each chunk's points are copied into one buffer sized from a count of the file's lines, so only
+a chunk at a time is ever held as a DataFrame.
+"""
+    points = PointBuffer(count_lines(fn)) # at least one row per point, as the header takes a line
+    n = 0
+    for chunk in pd.read_csv(fn, index_col=0, chunksize=chunk_rows):
+        part = PointBuffer.from_dataframe(chunk)
+        rows = slice(n, n + len(part))
+        for name in ('xyz', 'intensity', 'flags', 'pose', 'angle'):
+            getattr(points, name)[rows] = getattr(part, name)
+        n += len(part)
+    return PointBuffer.from_arrays(points.xyz[:n], points.intensity[:n], points.flags[:n], points.pose[:n], points.angle[:n])
+
+def summarise(points):
+    """Point count, bounding box and intensity histogram of a PointBuffer, for the catalog."""
+    entry = {'points': len(points),
+             'poses': len(np.unique(points.pose)),
+             'intensity_histogram': {'edges': HISTOGRAM_EDGES,
+                                     'counts': np.histogram(points.intensity, HISTOGRAM_EDGES)[0].tolist()}}
+    if len(points):
+        entry['bounds'] = {'min': points.xyz.min(axis=0).tolist(), 'max': points.xyz.max(axis=0).tolist()}
+    else:
+        entry['bounds'] = None
+    return entry
+
+def convert_file(job):
+    """Worker: convert one CSV file. Returns its catalog entry, or one with an 'error'."""
+    source, output, chunk_rows = job
+    started = time.time()
+    try:
+        points = read_csv_points(source, chunk_rows)
+        entry = summarise(points)
+        write_points(output, points, capture_time=os.path.getmtime(source), source=os.path.basename(source),
+                     bounds=entry['bounds'], intensity_histogram=entry['intensity_histogram'])
+    except Exception as e:
+        return {'source': source, 'error': '%s: %s' % (type(e).__name__, e)}
+    entry.update({'source': source, 'file': output, 'source_bytes': os.path.getsize(source),
+                  'bytes': os.path.getsize(output), 'seconds': time.time() - started})
+    return entry
+
+def find_csv_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.csv'))))
+        else:
+            files.append(path)
+    return files
+
+def load_catalog(fn):
+    if not os.path.exists(fn):
+        return {'version': 1, 'scans': []}
+    with open(fn) as f:
+        return json.load(f)
+
+def save_catalog(fn, catalog):
+    tmp = fn + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+    if os.path.exists(fn):
+        os.remove(fn) # os.rename won't replace a file on Windows
+    os.rename(tmp, fn)
+
+def convert(paths, output_dir, workers=None, chunk_rows=50000, force=False, out=sys.stdout):
+    """Convert every CSV file in paths (files or directories) into output_dir and update its catalog.
+
+Files whose .xvpc is already newer than the CSV are skipped unless force is set.
+Returns the catalog.
+"""
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    catalog_fn = os.path.join(output_dir, CATALOG)
+    catalog = load_catalog(catalog_fn)
+    scans = dict((entry['file'], entry) for entry in catalog['scans'])
+    jobs = []
+    for source in find_csv_files(paths):
+        output = os.path.join(output_dir, os.path.splitext(os.path.basename(source))[0] + '.xvpc')
+        if (not force and output in scans and os.path.exists(output)
+                and os.path.getmtime(output) >= os.path.getmtime(source)):
+            continue
+        jobs.append((source, output, chunk_rows))
+    if jobs:
+        pool = mp.Pool(workers or mp.cpu_count())
+        try:
+            for entry in pool.imap_unordered(convert_file, jobs):
+                if 'error' in entry:
+                    out.write('%s: failed, %s\n' % (entry['source'], entry['error']))
+                    continue
+                scans[entry['file']] = entry
+                out.write('%s: %d points, %d -> %d bytes\n' % (entry['source'], entry['points'],
+                                                              entry['source_bytes'], entry['bytes']))
+        finally:
+            pool.close()
+            pool.join()
+    catalog['scans'] = sorted(scans.values(), key=lambda entry: entry['file'])
+    save_catalog(catalog_fn, catalog)
+    return catalog
+
+def select(catalog, min_points=0, contains=None):
+    """Catalog entries with at least min_points points and, if given, a bounding box containing the point contains."""
+    found = []
+    for entry in catalog['scans']:
+        if entry['points'] < min_points:
+            continue
+        if contains is not None:
+            bounds = entry['bounds']
+            if bounds is None or not all(lo <= c <= hi for lo, c, hi in zip(bounds['min'], contains, bounds['max'])):
+                continue
+        found.append(entry)
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert stored CSV scans to .xvpc and catalog them')
+    commands = parser.add_subparsers(dest='command')
+    conv = commands.add_parser('convert', help='convert CSV files, or every CSV file in directories')
+    conv.add_argument('paths', nargs='+')
+    conv.add_argument('--output-dir', default='converted')
+    conv.add_argument('--workers', type=int, default=None, help='processes to use (default: one per core)')
+    conv.add_argument('--chunk-rows', type=int, default=50000, help='CSV rows parsed at a time')
+    conv.add_argument('--force', action='store_true', help='convert files even if they are up to date')
+    lst = commands.add_parser('list', help='list the scans in a catalog')
+    lst.add_argument('catalog')
+    lst.add_argument('--min-points', type=int, default=0)
+    lst.add_argument('--contains', type=float, nargs=3, metavar=('X', 'Y', 'Z'),
+                     help='only scans whose bounding box contains this point (mm)')
+    args = parser.parse_args()
+    if args.command == 'convert':
+        catalog = convert(args.paths, args.output_dir, args.workers, args.chunk_rows, args.force)
+        print('%d scans in %s' % (len(catalog['scans']), os.path.join(args.output_dir, CATALOG)))
+    elif args.command == 'list':
+        for entry in select(load_catalog(args.catalog), args.min_points, args.contains):
+            bounds = entry['bounds'] or {'min': [0, 0, 0], 'max': [0, 0, 0]}
+            print('%s  %d points  %d poses  x %.0f..%.0f  y %.0f..%.0f  z %.0f..%.0f' % (
+                entry['file'], entry['points'], entry['poses'], bounds['min'][0], bounds['max'][0],
+                bounds['min'][1], bounds['max'][1], bounds['min'][2], bounds['max'][2]))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
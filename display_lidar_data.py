@@ -7,6 +7,7 @@
 import math
 import pandas as pd
 from visual import *
+from lidar_format import load_points
 
 use_axes = True
 use_points = True
@@ -21,15 +22,15 @@ def init():
     # Ask user what file to display
     while True:
         try:
-            file_name = raw_input('Enter the filename of the csv file with the dataset: ')   
-            df = pd.read_csv(file_name, index_col = 0 )
+            file_name = raw_input('Enter the filename of the csv or xvpc file with the dataset: ')   
+            cloud = load_points(file_name) # only the stored points, no empty rows
             break
         except:
             print "That file name doesn't seem to be valid."
             #better try again... Return to the start of the loop
             continue
         
-    num_points = len(df)
+    num_points = len(cloud)
     # Set or reset the displayed sample and intensity points
     # point is for showing good data, displayed in green
     #pointb is for showing data with less intensity than expected for range
@@ -40,48 +41,49 @@ def init():
     pointh = points(pos=[(0,0,0) for i in range(num_points)], size=5, color=(0.4, 0, 0))    
     #lines
     outer_line= curve (pos=[(0,0,0) for i in range(num_points)], size=5, color=(1 , 0, 0))
-    lines=[curve(pos=[(offset*cos(i* pi / 180.0),0,offset*-sin(i* pi / 180.0)),(offset*cos(i* pi / 180.0),0,offset*-sin(i* pi / 180.0))], color=[(0.1, 0.1, 0.2),(1,0,0)]) for i in range(num_points)]
+    lines=[curve(pos=[(offset*cos(i* pi / 180.0),0,offset*-sin(i* pi / 180.0)),(offset*cos(i* pi / 180.0),0,offset*-sin(i* pi / 180.0))], color=[(0.1, 0.1, 0.2),(1,0,0)]) for i in cloud.angle.tolist()]
     lidar = cylinder(pos=(0,-15,0), axis=(0,30,0), radius=37)
     x_axis = arrow(axis=(500,0,0), shaftwidth=10)
     y_axis = arrow(axis=(0,500,0), shaftwidth=10)
     z_axis = arrow(axis=(0,0,500), shaftwidth=10)
     
-    for angle, row in df.iterrows():
-        if row['quality_warning'] == 1: # intensity less than expected for given range
-            pointb.pos[angle] = vector(row['x_pos'],row['z_pos'], row['y_pos'])
-            lines[angle].color[1] = (0.4,0,0)
-            outer_line.color[angle] = (0.4,0,0)
+    for i, (x_pos, y_pos, z_pos), intensity, warning in zip(range(num_points), cloud.xyz.tolist(),
+                                                            cloud.intensity.tolist(), cloud.warning.tolist()):
+        if warning: # intensity less than expected for given range
+            pointb.pos[i] = vector(x_pos,z_pos, y_pos)
+            lines[i].color[1] = (0.4,0,0)
+            outer_line.color[i] = (0.4,0,0)
     
         else:  # intensity is fine
-            point.pos[angle] = vector(row['x_pos'],row['z_pos'], row['y_pos'])
-            point.color[angle] = (0 , 1, 0)
-            lines[angle].color[1] = (1,0,0)
-            outer_line.color[angle] = (1,0,0)
+            point.pos[i] = vector(x_pos,z_pos, y_pos)
+            point.color[i] = (0 , 1, 0)
+            lines[i].color[1] = (1,0,0)
+            outer_line.color[i] = (1,0,0)
 
         # Set up a point set with intensity coded colors
-        pointc.pos[angle] = vector(row['x_pos'],row['z_pos'],row['y_pos'])
-        if row['intensity'] < 10:
-            pointc.color[angle] = (1,0.6,0)
-        elif row['intensity'] < 30:
-            pointc.color[angle] = (1,1,0)
-        elif row['intensity'] < 60:
-            pointc.color[angle] = (0,0,1)
+        pointc.pos[i] = vector(x_pos,z_pos,y_pos)
+        if intensity < 10:
+            pointc.color[i] = (1,0.6,0)
+        elif intensity < 30:
+            pointc.color[i] = (1,1,0)
+        elif intensity < 60:
+            pointc.color[i] = (0,0,1)
         else:
-            pointc.color[angle] = (0 , 1, 0)
+            pointc.color[i] = (0 , 1, 0)
             
         # Set up a point set with height coded colors
-        pointh.pos[angle] = vector(row['x_pos'],row['z_pos'], row['y_pos'])
-        if row['z_pos'] <= -10:
-            pointh.color[angle] = (1.,0.6,0.) # orange  
-        elif row['z_pos'] <= 200:
-            pointh.color[angle] = (1.,1,0.) # yellow
-        elif row['z_pos'] <= 500:
-            pointh.color[angle] = (0.,1,0.) # green 
+        pointh.pos[i] = vector(x_pos,z_pos, y_pos)
+        if z_pos <= -10:
+            pointh.color[i] = (1.,0.6,0.) # orange  
+        elif z_pos <= 200:
+            pointh.color[i] = (1.,1,0.) # yellow
+        elif z_pos <= 500:
+            pointh.color[i] = (0.,1,0.) # green 
         else:
-            pointh.color[angle] = (0.,0.,1.) # blue         
+            pointh.color[i] = (0.,0.,1.) # blue         
 
-        lines[angle].pos[1]= vector(row['x_pos'],row['z_pos'], row['y_pos'])
-        outer_line.pos[angle]= vector(row['x_pos'],row['z_pos'], row['y_pos'])
+        lines[i].pos[1]= vector(x_pos,z_pos, y_pos)
+        outer_line.pos[i]= vector(x_pos,z_pos, y_pos)
 
     if use_axes:
         x_axis.visible = True
@@ -92,9 +94,9 @@ def init():
         y_axis.visible = False
         z_axis.visible = False
     
-    return(df)
+    return(cloud)
 
-def checkKeys(df):
+def checkKeys(cloud):
     global use_outer_line, use_lines, use_points, use_intensity, use_height, use_axes
     global point, pointb, pointc, pointh, lines, outer_line, x_axis, y_axis, z_axis
     if scene.kb.keys: # event waiting to be processed?
@@ -130,11 +132,6 @@ def checkKeys(df):
             init()
     
     # Update view based on keys
-    for angle, row in df.iterrows():
-        angle_radians = math.radians(angle)
-        c = math.cos(angle_radians)
-        s = math.sin(angle_radians)
-
     if use_points:
         if use_intensity:
             point.visible = False
@@ -178,10 +175,10 @@ def checkKeys(df):
         y_axis.visible = False3D_Test2.c3D_
         z_axis.visible = False
 
-lidar_df = init()
+lidar_cloud = init()
 
 while True:
     rate(5) # synchonous repaint at 40fps
-    checkKeys(lidar_df)
+    checkKeys(lidar_cloud)
 
     
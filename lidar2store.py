@@ -4,26 +4,33 @@
 #requires vpython and pyserial
 
 import time, sys, traceback, math, serial
-from threading import Thread
-import pandas as pd
+import numpy as np
+from lidar_replay import ReplaySerial
+from lidar_pipeline import AcquisitionPipeline, DROP_OLDEST, BLOCK
+from lidar_metrics import start_logging, serve_metrics
+from point_buffer import PointBuffer, SampleBuffer
+from lidar_format import SnapshotWriter
+from lidar_recorder import RevolutionRecorder
 
 com_port = "COM3" # example: 5 == "COM6" == "/dev/tty5"
 baudrate = 115200
+replay_file = None # e.g. "capture.xvraw" plays back a recording made with lidar_replay.py instead of using com_port
 visualization = True
+metrics_log_interval = None # e.g. 10 prints acquisition health (packet rate, errors, RPM) every 10 seconds
+metrics_port = None # e.g. 8000 serves the same metrics on http://localhost:8000/metrics
+record_prefix = None # e.g. "walk" records every revolution to walk_<date-time>_<n>.xvrev files (see lidar_recorder.py)
+record_max_mb = 100 # start a new recording file after this many MB...
+record_max_minutes = None # ...or, if set, after this many minutes
+store_raw = False # True saves snapshots as raw samples, projected when the file is read (see lidar_format.py)
 
 # Ask user if they want to store the data set or not
-scanning = True # True until user later enters an 's' to save a snapshot
 storing = False
 input = raw_input('Do you want to save the dataset y/[n]? ')
 if input == 'y':
     storing = True
-    file_name = raw_input('Enter the filename to save the data to: ')
-    columns = ['x_pos', 'y_pos', 'z_pos', 'intensity', 'quality_warning']
-    lidar_df = pd.DataFrame(index = range(360), columns=columns)
+    file_name = raw_input('Enter the filename to save the data to (.xvpc for the binary format, anything else for CSV): ')
 
 offset = 140
-init_level = 0
-index = 0
 
 if visualization:
     from visual import *
@@ -37,6 +44,7 @@ if visualization:
     lidar = cylinder(pos=(0,-15,0), axis=(0,30,0), radius=37)
     label_speed = label(pos = (0,-500,0), xoffset=1, box=False, opacity=0.1)
     label_errors = label(pos = (0,-1000,0), xoffset=1, text="errors: 0", visible = False, box=False)
+    label_saving = label(pos = (0,-1500,0), xoffset=1, text="", box=False)
     # Display Coordinate Axes
     x_axis = arrow(axis=(500,0,0), shaftwidth=10)
     y_axis = arrow(axis=(0,500,0), shaftwidth=10)
@@ -46,25 +54,17 @@ use_outer_line = False
 use_lines = False
 use_intensity = True
 
-def update_view( angle, data ):
+def update_view( angle, dist_mm, quality, invalid, warning ):
     """Updates the view of a sample.
 
-Takes the angle (an int, from 0 to 359) and the list of four bytes of data in the order they arrived.
+Takes the angle (an int, from 0 to 359) and the decoded sample: distance, quality and the invalid and warning flags.
 """
     global offset, use_outer_line, use_line
 
-    #unpack data using the denomination used during the discussions
-    x = data[0]
-    x1= data[1]
-    x2= data[2]
-    x3= data[3]
-    
     angle_rad = angle * math.pi / 180.0
     c = math.cos(angle_rad)
     s = -math.sin(angle_rad)
 
-    dist_mm = x | (( x1 & 0x3f) << 8) # distance is coded on 13 bits ? 14 bits ?
-    quality = x2 | (x3 << 8) # quality is on 16 bits
     dist_x = dist_mm*c
     dist_y = dist_mm*s
     if visualization:
@@ -79,14 +79,14 @@ Takes the angle (an int, from 0 to 359) and the list of four bytes of data in th
         
         
         # display the sample
-        if x1 & 0x80: # is the flag for "bad data" set?
+        if invalid: # is the flag for "bad data" set?
             # yes it's bad data
             lines[angle].pos[1]=(offset*c,0,offset*s)
             outer_line.pos[angle]=(offset*c,0,offset*s)
             outer_line.color[angle] = (0.1, 0.1, 0.2)
         else:
             # no, it's cool
-            if not x1 & 0x40:
+            if not warning:
                 # X+1:6 not set : quality is OK
                 if use_points : point.pos[angle] = vector( dist_x,0, dist_y)
                 if use_intensity:
@@ -98,119 +98,32 @@ Takes the angle (an int, from 0 to 359) and the list of four bytes of data in th
                         point.color[angle] = (0,0,1)
                 if use_lines : lines[angle].color[1] = (1,0,0)
                 if use_outer_line : outer_line.color[angle] = (1,0,0)
-                if storing == True:
-                    lidar_df.loc[angle] = [dist_x, dist_y, 0, quality, 0]  # z_pos always zero
             else:
                 # X+1:6 set : Warning, the quality is not as good as expected
                 if use_points : pointb.pos[angle] = vector( dist_x,0.0, dist_y)
                 if use_lines : lines[angle].color[1] = (0.4,0,0)
                 if use_outer_line : outer_line.color[angle] = (0.4,0,0)
-                if storing == True:
-                    lidar_df.loc[angle] = [dist_x, dist_y, 0.0, quality, 1]  # z_pos always zero
             if use_lines : lines[angle].pos[1]=( dist_x, 0, dist_y)
             if use_outer_line : outer_line.pos[angle]=( dist_x, 0, dist_y)
 
-def checksum(data):
-    """Compute and return the checksum as an int.
-
-data -- list of 20 bytes (as ints), in the order they arrived in.
-"""
-    # group the data by word, little-endian
-    data_list = []
-    for t in range(10):
-        data_list.append( data[2*t] + (data[2*t+1]<<8) )
-    
-    # compute the checksum on 32 bits
-    chk32 = 0
-    for d in data_list:
-        chk32 = (chk32 << 1) + d
-
-    # return a value wrapped around on 15bits, and truncated to still fit into 15 bits
-    checksum = (chk32 & 0x7FFF) + ( chk32 >> 15 ) # wrap around to fit into 15 bits
-    checksum = checksum & 0x7FFF # truncate to 15 bits
-    return int( checksum )
-
-
 def gui_update_speed(speed_rpm):
     label_speed.text = "RPM : " + str(speed_rpm)
 
-def compute_speed(data):
-    speed_rpm = float( data[0] | (data[1] << 8) ) / 64.0
-    return speed_rpm
+def show_scan(scan):
+    """Display sink: redraws every sample of a complete revolution."""
+    gui_update_speed(scan.mean_rpm)
+    label_errors.text = "errors: "+str(pipeline.metrics.snapshot()['total_checksum_errors'])
+    for angle, sample in enumerate(zip(scan.dist_mm.tolist(), scan.quality.tolist(),
+                                       scan.invalid.tolist(), scan.warning.tolist())):
+        update_view(angle, *sample)
 
-def read_Lidar():
-    global init_level, angle, index
-    
-    nb_errors = 0
-    while True: 
-        if scanning == True: # scanning is turned off while writing data set to file
-            try:
-                time.sleep(0.00001) # do not hog the processor power
-                if init_level == 0 :
-                    b = ord(ser.read(1))
-                    # start byte
-                    if b == 0xFA :
-                        init_level = 1
-                        #print lidarData
-                    else:
-                        init_level = 0
-                elif init_level == 1:
-                    # position index
-                    b = ord(ser.read(1))
-                    if b >= 0xA0 and b <= 0xF9 :
-                        index = b - 0xA0
-                        init_level = 2
-                    elif b != 0xFA:
-                        init_level = 0
-                elif init_level == 2 :
-                    # speed
-                    b_speed = [ ord(b) for b in ser.read(2)]
-                    
-                    # data
-                    b_data0 = [ ord(b) for b in ser.read(4)]
-                    b_data1 = [ ord(b) for b in ser.read(4)]
-                    b_data2 = [ ord(b) for b in ser.read(4)]
-                    b_data3 = [ ord(b) for b in ser.read(4)]
-    
-                    # for the checksum, we need all the data of the packet...
-                    # this could be collected in a more elegent fashion...
-                    all_data = [ 0xFA, index+0xA0 ] + b_speed + b_data0 + b_data1 + b_data2 + b_data3
-    
-                    # checksum
-                    b_checksum = [ ord(b) for b in ser.read(2) ]
-                    incoming_checksum = int(b_checksum[0]) + (int(b_checksum[1]) << 8)
-    
-                    # verify that the received checksum is equal to the one computed from the data
-                    if checksum(all_data) == incoming_checksum:
-                        speed_rpm = compute_speed(b_speed)
-                        if visualization:
-                            gui_update_speed(speed_rpm)
-                        
-                        update_view(index * 4 + 0, b_data0)
-                        update_view(index * 4 + 1, b_data1)
-                        update_view(index * 4 + 2, b_data2)
-                        update_view(index * 4 + 3, b_data3)
-                    else:
-                        # the checksum does not match, something went wrong...
-                        nb_errors +=1
-                        if visualization:
-                            label_errors.text = "errors: "+str(nb_errors)
-                        
-                        # display the samples in an error state
-                        update_view(index * 4 + 0, [0, 0x80, 0, 0])
-                        update_view(index * 4 + 1, [0, 0x80, 0, 0])
-                        update_view(index * 4 + 2, [0, 0x80, 0, 0])
-                        update_view(index * 4 + 3, [0, 0x80, 0, 0])
-                        
-                    init_level = 0 # reset and wait for the next packet
-                    
-                else: # default, should never happen...
-                    init_level = 0
-            except :
-                traceback.print_exc(file=sys.stdout)
+def keep_scan(scan):
+    """Storage sink: holds on to the last complete revolution for the next snapshot."""
+    global latest_scan
+    latest_scan = scan
 
 def checkKeys():
-    global use_outer_line, use_lines, use_points, use_intensity, scanning
+    global use_outer_line, use_lines, use_points, use_intensity
     if scene.kb.keys: # event waiting to be processed?
         s = scene.kb.getkey() # get keyboard info
 
@@ -228,24 +141,70 @@ def checkKeys():
             label_speed.visible = not label_speed.visible
         elif s=="k": # Toggle errors
             label_errors.visible = not label_errors.visible  
-        elif s=='s': # store the data
-            scanning = False
+        elif s=='s' and storing: # store the data, acquisition and the display carry on meanwhile
             print 'Storing snapshot in ' + file_name
             store_snapshot(file_name)
-            print 'Resuming scanning'
-            scanning = True
             
 def store_snapshot(fn):
-    lidar_df.to_csv(file_name)
+    # save the last complete revolution, so the file never mixes two of them
+    scan = latest_scan
+    if scan is None:
+        print 'No complete revolution received yet'
+        return()
+    angles = np.flatnonzero(scan.valid)
+    if store_raw:
+        lidar_points = SampleBuffer(360)
+        lidar_points.write(angles, scan.dist_mm[angles], scan.quality[angles], scan.warning[angles], 0,
+                           scan.sample_times()[angles])
+    else:
+        angle_rad = np.radians(angles)
+        xyz = np.column_stack((scan.dist_mm[angles] * np.cos(angle_rad), scan.dist_mm[angles] * -np.sin(angle_rad),
+                               np.zeros(len(angles)))) # z_pos always zero
+        lidar_points = PointBuffer(360)
+        lidar_points.write(angles, xyz, scan.quality[angles], scan.warning[angles])
+    writer.submit(fn, lidar_points, poses=[{'id': 0, 'yaw': 0.0, 'pitch': 0.0}], capture_time=scan.start_time,
+                  rpm=[scan.mean_rpm])
     return()
 
-ser = serial.Serial(com_port, baudrate)
-th1 = Thread(target=read_Lidar)
-th1.daemon = True
-th1.start()
+if replay_file:
+    ser = ReplaySerial(replay_file, loop=True)
+else:
+    ser = serial.Serial(com_port, baudrate)
 
-while True:
-    if visualization:
-        rate(60) # synchonous repaint at 60fps
-        checkKeys()
+def snapshot_done(fn, error):
+    print 'Snapshot stored in ' + fn if error is None else 'Snapshot not stored: ' + str(error)
+
+# The reader never waits on the display or the disk: the display only ever wants the newest
+# revolution, while storage keeps every one
+latest_scan = None
+writer = SnapshotWriter(snapshot_done) # snapshots are written on their own thread
+pipeline = AcquisitionPipeline(ser)
+if visualization:
+    pipeline.add_sink('display', show_scan, maxsize=1, policy=DROP_OLDEST)
+if storing:
+    pipeline.add_sink('storage', keep_scan, maxsize=8, policy=BLOCK)
+if record_prefix:
+    recorder = RevolutionRecorder(record_prefix, max_bytes=record_max_mb * 1e6 if record_max_mb else None,
+                                  max_seconds=record_max_minutes * 60 if record_max_minutes else None)
+    pipeline.add_sink('recording', recorder.add, maxsize=64, policy=BLOCK)
+pipeline.start()
+if metrics_log_interval:
+    start_logging(pipeline.metrics, metrics_log_interval)
+if metrics_port:
+    serve_metrics(pipeline.metrics, metrics_port)
+
+try:
+    while True:
+        if visualization:
+            rate(60) # synchonous repaint at 60fps
+            checkKeys()
+            label_saving.text = writer.status()
+        else:
+            time.sleep(0.1)
+finally:
+    writer.close() # finish any snapshot still being written
+    if record_prefix:
+        pipeline.stop() # lets the recording sink write what it has queued
+        recorder.close()
+        print 'Recorded %d revolutions to %s' % (recorder.revolutions, ', '.join(recorder.files))
     
@@ -2,35 +2,54 @@
 #based on code from Nicolas "Xevel" Saugnier
 #requires vpython and pyserial
 
-from threading import Thread
 import time, sys, traceback, math, serial, collections, json
-import pandas as pd
+import numpy as np
 import altMaestro
 import rotation as rot
+from lidar_replay import ReplaySerial
+from lidar_pipeline import AcquisitionPipeline, DROP_OLDEST, BLOCK
+from lidar_metrics import start_logging, serve_metrics
+from point_buffer import PointBuffer, SampleBuffer
+from lidar_format import SnapshotWriter
+from lidar_recorder import RevolutionRecorder
+from scan_scheduler import DwellScheduler
+from servo_model import ServoModel
+from scan_planner import PosePlanner, grid_poses, predict_duration, sweep_rows, predict_sweep
+from servo_timeline import ServoTimeline, load_calibration
 #import moveUnit as move
 
 com_port = "COM3" # example: 5 == "COM6" == "/dev/tty5"
 baudrate = 115200
+maestro_moving_state = False # True for a Mini Maestro (12, 18 or 24 channels), which can say whether the servos are still moving
+replay_file = None # e.g. "capture.xvraw" plays back a recording made with lidar_replay.py instead of using com_port
 visualization = True
+metrics_log_interval = None # e.g. 10 prints acquisition health (packet rate, errors, RPM) every 10 seconds
+metrics_port = None # e.g. 8000 serves the same metrics on http://localhost:8000/metrics
+archive_prefix = None # e.g. "room" also archives every raw revolution, compressed, to room_<date-time>_<n>.xvrev (see lidar_recorder.py)
+dwell_revolutions = 2 # move to the next pose after this many complete, checksum-clean revolutions...
+settle_seconds = 0.05 # ...that started at least this long after the servos stopped
+max_missing_packets = 0 # packets (of 90) a revolution may lack and still count as clean
+pose_order = 'serpentine' # 'serpentine' sweeps the pitch up and down alternately, 'optimized' plans a tour for any pose set, 'grid' is the original order
+servo_speed = 10 # Maestro speed and acceleration settings of both servos, also used to predict the scan time
+servo_acceleration = 10
+servo_timeout = 10 # seconds to wait for the servos to reach a pose before logging the Maestro's errors and going on
+store_raw = False # True saves the raw samples, to be projected when the file is read; .xvpc files can then be reprojected after recalibrating
+scan_mode = 'poses' # 'poses' stops at each pose in scan_angles.json; 'sweep' moves one servo steadily across its range while the lidar spins
+sweep_axis = 'pitch' # the servo that moves steadily in sweep mode, the other steps through its angles in scan_angles.json
+sweep_speed = 4 # Maestro speed of the sweeping servo: 4 crosses the pitch range in about 5 s
+sweep_check_interval = 0.25 # seconds between reading the servo positions in a sweep, predicted in between; None reads them all the time
+if scan_mode == 'sweep':
+    store_raw = False # every sample of a sweep has its own pose, which raw files can't hold
 
 offset = 140
-init_level = 0
-index = 0
-
-# Read the set of yaw and pitch angles to be scanned from 
-with open('scan_angles.json', 'r') as f:
-    positions =  json.load(f)
-    
-yaw_set = positions['yaw_angles']
-yaw_set = { float(x): yaw_set[x] for x in yaw_set.keys() } # json insists on keys being strings, this converts to floats
-pitch_set = positions['pitch_angles']
-pitch_set = { float(x): pitch_set[x] for x in pitch_set.keys() } # json insists on keys being strings, this converts to floats
-# Want to proceed smoothly from left to right, down to up, so put in order          
-yaw_set = collections.OrderedDict(sorted(yaw_set.items(), key=lambda t: t[0]))  
-pitch_set = collections.OrderedDict(sorted(pitch_set.items(), key=lambda t: t[0]))           
-            
-       
-num_locations = len(yaw_set) * len(pitch_set)
+
+# Read the set of yaw and pitch angles to be scanned, with their servo targets, from scan_angles.json
+poses = grid_poses('scan_angles.json')
+num_locations = len(poses)
+# Where each angle of each pose points, worked out once for the whole scan; pose ids count up
+# through the pitch angles, then the yaw angles, as in the main loop
+projection = rot.ProjectionTable.from_angle_file('scan_angles.json')
+pose_table = projection.poses
 
 # Ask user if they want to store the data set or not
 scan = True # True until full scan completed
@@ -38,19 +57,42 @@ storing = False
 input = raw_input('Do you want to save the dataset y/[n]? ')
 if input == 'y':
     storing = True
-    file_name = raw_input('Enter the filename to save the data to: ')
-    columns = ['x_pos', 'y_pos', 'z_pos', 'intensity', 'quality_warning']
-    lidar_df = pd.DataFrame(index = range(360*num_locations), columns=columns)
+    file_name = raw_input('Enter the filename to save the data to (.xvpc for the binary format, anything else for CSV): ')
+    # raw samples are saved as they are, so points below the floor are kept too
+    lidar_points = SampleBuffer(360*num_locations) if store_raw else PointBuffer(360*num_locations)
+    stored_rpm = [] # RPM of each stored revolution, summarised in .xvpc files
+    sweep_parts = [] # in sweep mode, the points of each revolution, joined when the scan is saved
 
 
-servo = altMaestro.Device('COM4','COM5')
-servo.set_acceleration(0, 10)
-servo.set_acceleration(1, 10)
-servo.set_speed(0, 10)
-servo.set_speed(1, 10)
-               
+servo = altMaestro.Device('COM4','COM5', moving_state=maestro_moving_state)
+servo.set_acceleration(0, servo_acceleration)
+servo.set_acceleration(1, servo_acceleration)
+servo.set_speed(0, servo_speed)
+servo.set_speed(1, servo_speed)
 
-lidarData = [[] for i in range(360)] #A list of 360 elements Angle, Distance , quality
+# Visit the poses in the order that spends least time moving the servos between them
+servo_model = ServoModel(servo_speed, servo_acceleration)
+start = (servo.get_position(0), servo.get_position(1))
+planner = PosePlanner(servo_model, servo_model, start if None not in start else None)
+if scan_mode == 'sweep':
+    rows = sweep_rows(poses, sweep_axis)
+    sweep_channel = 1 if sweep_axis == 'pitch' else 0
+    sweep_model = ServoModel(sweep_speed, servo_acceleration)
+    travel, predicted = predict_sweep(planner, rows, sweep_model, sweep_axis)
+    print '%d rows sweeping the %s, predicted scan time %.0f s (%.0f s of it stepping between rows)' % (
+        len(rows), sweep_axis, predicted, travel)
+else:
+    plan = planner.plan(poses, pose_order)
+    # at each pose, the settle time, the revolution under way and the clean revolutions wanted, at 300 RPM
+    travel, predicted = predict_duration(planner, plan, settle_seconds + (dwell_revolutions + 1) * 0.2)
+    print '%d poses in %s order, predicted scan time %.0f s (%.0f s of it moving the servos; %.0f s in the grid order)' % (
+        len(plan), pose_order, predicted, travel, planner.travel_time(planner.grid(poses)))
+# Where the servos are during a sweep, read continuously, and the angles their positions correspond to
+timeline = ServoTimeline(servo, check_interval=sweep_check_interval)
+yaw_calibration, pitch_calibration = load_calibration('scan_angles.json')
+sweep_poses = [] # pose table of a sweep: one entry per revolution, at its mean yaw and pitch
+sweep_started = {} # row -> time its sweep began
+               
 
 
 if visualization:
@@ -64,6 +106,7 @@ if visualization:
     lidar = cylinder(pos=(0,-15,0), axis=(0,30,0), radius=37)
     label_speed = label(pos = (0,-500,0), xoffset=1, box=False, opacity=0.1)
     label_errors = label(pos = (0,-1000,0), xoffset=1, text="errors: 0", visible = False, box=False)
+    label_saving = label(pos = (0,-1500,0), xoffset=1, text="", box=False)
     # Display Coordinate Axes
     x_axis = arrow(axis=(500,0,0), shaftwidth=10)
     y_axis = arrow(axis=(0,500,0), shaftwidth=10)
@@ -74,30 +117,16 @@ use_lines = False
 use_intensity = False
 use_height = True
 
-def update_view(angle, data ):
+def update_view(angle, loc, dist_x, dist_y, dist_z, quality, invalid, warning):
     """Updates the view of a sample.
-    Takes the angle (an int, from 0 to 359) and the list of four bytes of data in the order they arrived.
+    Takes the angle (an int, from 0 to 359), the scan location it was taken at, its 3D position
+    (see project_scan), quality and the invalid and warning flags.
 """
     global offset, scan
-    # unpack data using the denomination used during the discussions
-    x = data[0]
-    x1= data[1]
-    x2= data[2]
-    x3= data[3]
-    
     angle_rad = angle * math.pi / 180.0
     c = math.cos(angle_rad)
     s = -math.sin(angle_rad)
 
-    dist_mm = x | (( x1 & 0x3f) << 8) # distance is coded on 13 bits ? 14 bits ?
-    quality = x2 | (x3 << 8) # quality is on 16 bits
-    lidarData[angle] = [dist_mm,quality]
-
-    # Modified for 3D vectors
-    raw_dist_x = dist_mm*c
-    raw_dist_y = dist_mm*s
-    dist_x, dist_y, dist_z = rot.rotation(raw_dist_x, raw_dist_y, 0, yaw_angle, pitch_angle)
-    dist_z = -dist_z
     if visualization:
         #reset the point display
         point.pos[angle+(360*loc)] = vector( 0, 0, 0 )
@@ -110,14 +139,14 @@ def update_view(angle, data ):
         
         
         # display the sample
-        if x1 & 0x80: # is the flag for "bad data" set?
+        if invalid: # is the flag for "bad data" set?
             # yes it's bad data
             lines[angle+(360*loc)].pos[1]=(offset*c,0,offset*s)
             outer_line.pos[angle+(360*loc)]=(offset*c,0,offset*s)
             outer_line.color[angle+(360*loc)] = (0.1, 0.1, 0.2)
         else:
             # no, it's cool
-            if not x1 & 0x40:
+            if not warning:
                 # X+1:6 not set : quality is OK
                 if use_intensity or use_height:
                     if use_height:
@@ -141,163 +170,230 @@ def update_view(angle, data ):
                             print "blue"
                 if use_points and dist_z > -10: 
                     point.pos[angle+(360*loc)] = vector( dist_x, dist_z, dist_y)
-                    if storing == True:
-                        lidar_df.loc[angle+(360*loc)] = [dist_x, dist_y, dist_z, quality, 0]                             
                 if use_lines : lines[angle+(360*loc)].color[1] = (1,0,0)
                 if use_outer_line : outer_line.color[angle+(360*loc)] = (1,0,0)
             else:
                 # X+1:6 set : Warning, the quality is not as good as expected
                 if use_points and dist_z > -10: 
                     pointb.pos[angle+(360*loc)] = vector( dist_x,dist_z, dist_y)
-                    if storing == True:
-                        lidar_df.loc[angle+(360*loc)] = [dist_x, dist_y, dist_z, quality, 1] 
                 if use_lines : lines[angle+(360*loc)].color[1] = (0.4,0,0)
                 if use_outer_line : outer_line.color[angle+(360*loc)] = (0.4,0,0)
             if use_lines : lines[angle+(360*loc)].pos[1]=( dist_x, dist_z, dist_y)
             if use_outer_line : outer_line.pos[angle+(360*loc)]=( dist_x, dist_z, dist_y)            
               
             
-def checksum(data):
-    """Compute and return the checksum as an int.
+def gui_update_speed(speed_rpm):
+    label_speed.text = "RPM : " + str(speed_rpm)
+
+def project_scan(rev):
+    """Transform stage: converts a revolution to 3D using the pose it was captured at.
 
-data -- list of 20 bytes (as ints), in the order they arrived in.
+Returns the revolution and a (360, 3) array of x, y, z positions (z positive up), or None
+for a revolution captured while the servos were moving or settling. With store_raw and no
+display, nothing needs the positions, so the array is left out (None).
 """
-    # group the data by word, little-endian
-    data_list = []
-    for t in range(10):
-        data_list.append( data[2*t] + (data[2*t+1]<<8) )
-    
-    # compute the checksum on 32 bits
-    chk32 = 0
-    for d in data_list:
-        chk32 = (chk32 << 1) + d
-
-    # return a value wrapped around on 15bits, and truncated to still fit into 15 bits
-    checksum = (chk32 & 0x7FFF) + ( chk32 >> 15 ) # wrap around to fit into 15 bits
-    checksum = checksum & 0x7FFF # truncate to 15 bits
-    return int( checksum )
+    if rev.pose is None:
+        return None
+    scheduler.add(rev)
+    if not scheduler.accepts(rev):
+        return None
+    if store_raw and not visualization:
+        return rev, None
+    loc, yaw_angle, pitch_angle = rev.pose
+    xyz = projection.project(loc, rev.dist_mm)
+    xyz[rev.invalid] = 0
+    xyz[:, 2] = -xyz[:, 2]
+    return rev, xyz
 
+def project_sweep(rev):
+    """Transform stage for sweeps: converts a revolution to 3D giving each sample its own pose,
+interpolated from the servo timeline at the time the sample was taken.
 
-def gui_update_speed(speed_rpm):
-    label_speed.text = "RPM : " + str(speed_rpm)
+Returns the revolution, with its pose replaced by (revolution number, mean yaw, mean pitch),
+and a (360, 3) array of x, y, z positions (z positive up), or None for a revolution that
+began before its row's sweep did.
+"""
+    if rev.pose is None or rev.start_time < sweep_started[rev.pose]:
+        return None
+    yaw_target, pitch_target = timeline.positions_at(rev.sample_times()).T
+    yaw = yaw_calibration.angle(yaw_target)
+    pitch = pitch_calibration.angle(pitch_target)
+    xyz = rot.transform_polar_each(np.arange(360), rev.dist_mm, yaw, pitch)
+    xyz[rev.invalid] = 0
+    xyz[:, 2] = -xyz[:, 2]
+    loc = len(sweep_poses)
+    sweep_poses.append({'id': loc, 'yaw': float(yaw.mean()), 'pitch': float(pitch.mean()), 'row': rev.pose,
+                        'yaw_range': [float(yaw.min()), float(yaw.max())],
+                        'pitch_range': [float(pitch.min()), float(pitch.max())]})
+    rev.pose = (loc, sweep_poses[-1]['yaw'], sweep_poses[-1]['pitch'])
+    return rev, xyz
+
+def show_scan(item):
+    """Display sink: redraws every sample of a complete revolution."""
+    rev, xyz = item
+    loc = rev.pose[0] % num_locations # a sweep has more revolutions than there are places to show them, the newest replace the oldest
+    gui_update_speed(rev.mean_rpm)
+    label_errors.text = "errors: "+str(pipeline.metrics.snapshot()['total_checksum_errors'])
+    for angle, sample in enumerate(zip(xyz.tolist(), rev.quality.tolist(), rev.invalid.tolist(), rev.warning.tolist())):
+        (dist_x, dist_y, dist_z), quality, invalid, warning = sample
+        update_view(angle, loc, dist_x, dist_y, dist_z, quality, invalid, warning)
 
-def compute_speed(data):
-    speed_rpm = float( data[0] | (data[1] << 8) ) / 64.0
-    return speed_rpm
-
-def read_Lidar():
-    global init_level, angle, index
-    nb_errors = 0
-    while scan:
-        try:            
-            time.sleep(0.00001) # do not hog the processor power
-            if init_level == 0 :
-                b = ord(ser.read(1))
-                # start byte
-                if b == 0xFA :
-                    init_level = 1
-                else:
-                    init_level = 0
-            elif init_level == 1:
-                # position index
-                b = ord(ser.read(1))
-                if b >= 0xA0 and b <= 0xF9 :
-                    index = b - 0xA0
-                    init_level = 2
-                elif b != 0xFA:
-                    init_level = 0
-            elif init_level == 2 :
-                # speed
-                b_speed = [ ord(b) for b in ser.read(2)]
-                
-                # data
-                b_data0 = [ ord(b) for b in ser.read(4)]
-                b_data1 = [ ord(b) for b in ser.read(4)]
-                b_data2 = [ ord(b) for b in ser.read(4)]
-                b_data3 = [ ord(b) for b in ser.read(4)]
-
-                # for the checksum, we need all the data of the packet...
-                # this could be collected in a more elegent fashion...
-                all_data = [ 0xFA, index+0xA0 ] + b_speed + b_data0 + b_data1 + b_data2 + b_data3
-
-                # checksum
-                b_checksum = [ ord(b) for b in ser.read(2) ]
-                incoming_checksum = int(b_checksum[0]) + (int(b_checksum[1]) << 8)
-    
-                # verify that the received checksum is equal to the one computed from the data
-                if checksum(all_data) == incoming_checksum:
-                    speed_rpm = compute_speed(b_speed)
-                    if visualization:
-                        gui_update_speed(speed_rpm)
-                    update_view(index * 4 + 1, b_data1)
-                    update_view(index * 4 + 2, b_data2)
-                    update_view(index * 4 + 3, b_data3)
-                else:
-                    # the checksum does not match, something went wrong...
-                    nb_errors +=1
-                    if visualization:
-                        label_errors.text = "errors: "+str(nb_errors)
-                    
-                    # display the samples in an error state
-                    update_view(index * 4 + 0, [0, 0x80, 0, 0])
-                    update_view(index * 4 + 1, [0, 0x80, 0, 0])
-                    update_view(index * 4 + 2, [0, 0x80, 0, 0])
-                    update_view(index * 4 + 3, [0, 0x80, 0, 0])
-                    
-                init_level = 0 # reset and wait for the next packet
-                
-            else: # default, should never happen...
-                init_level = 0
-                                     
-        except :
-            traceback.print_exc(file=sys.stdout)
-    return()
+def store_scan(item):
+    """Storage sink: copies the good samples of a revolution into lidar_points."""
+    rev, xyz = item
+    loc = rev.pose[0]
+    stored_rpm.append(rev.mean_rpm)
+    if store_raw:
+        angles = np.flatnonzero(rev.valid)
+        lidar_points.write(angles + 360*loc, rev.dist_mm[angles], rev.quality[angles], rev.warning[angles], loc,
+                           rev.sample_times()[angles])
+        return
+    keep = rev.valid & (xyz[:, 2] > -10) # points below the floor are not stored
+    angles = np.flatnonzero(keep)
+    lidar_points.write(angles + 360*loc, xyz[angles], rev.quality[angles], rev.warning[angles], loc)
+
+def store_sweep(item):
+    """Storage sink for sweeps: keeps the good samples of a revolution, each revolution being a pose of its own."""
+    rev, xyz = item
+    loc = rev.pose[0]
+    stored_rpm.append(rev.mean_rpm)
+    keep = rev.valid & (xyz[:, 2] > -10) # points below the floor are not stored
+    angles = np.flatnonzero(keep)
+    points = PointBuffer(360)
+    points.write(angles, xyz[angles], rev.quality[angles], rev.warning[angles], loc)
+    sweep_parts.append(points.compact())
 
 def store_snapshot(fn):
-    lidar_df.to_csv(file_name)
+    # the scan is over, so the buffer itself is handed to the writer rather than a copy
+    if scan_mode == 'sweep':
+        writer.submit(fn, PointBuffer.concatenate(sweep_parts), poses=sweep_poses, capture_time=scan_start_time,
+                      rpm=stored_rpm, sweep={'axis': sweep_axis, 'speed': sweep_speed, 'rows': len(rows)})
+    else:
+        writer.submit(fn, lidar_points, poses=pose_table, capture_time=scan_start_time, rpm=stored_rpm,
+                      pose_stats=scheduler.stats)
     return()  
+
+def finish_scan():
+    """Stops acquisition after the last pose or row, then archives and stores what was captured."""
+    pipeline.pose = None
+    pipeline.stop() # waits for the storage sink to catch up
+    if archive_prefix:
+        archive.close()
+        print 'Archived %d revolutions to %s' % (archive.revolutions, ', '.join(archive.files))
+    if storing == True:
+        print 'Storing snapshot in ' + file_name
+        store_snapshot(file_name)
+
+def wait_for_servos():
+    # sleeps until the servos should have arrived, then checks; after a timeout the Maestro's error flags are logged
+    servo.wait_for_motion([0, 1], timeout=servo_timeout)
+
+def sweep_scan():
+    """Sweep mode: moves to the start of each row, then sweeps one servo to the row's end at
+sweep_speed while the lidar spins and the timeline records where the servos are.
+"""
+    for row, (start, end) in enumerate(rows):
+        pipeline.pose = None # revolutions captured while stepping between rows are thrown away
+        servo.set_speed(sweep_channel, servo_speed)
+        servo.set_targets({0: start['yaw_target'], 1: start['pitch_target']})
+        wait_for_servos()
+        servo.set_speed(sweep_channel, sweep_speed)
+        end_target = end[sweep_axis + '_target']
+        deadline = time.time() + 1.5 * float(sweep_model.move_time(start[sweep_axis + '_target'], end_target)) + 2
+        # the servos can't be read while a command is sent, so the timeline starts once the sweep has
+        timeline.add(time.time(), [start['yaw_target'], start['pitch_target']])
+        sweep_started[row] = time.time()
+        servo.set_target(sweep_channel, end_target)
+        timeline.start()
+        pipeline.pose = row
+        while True:
+            if visualization:
+                rate(24)
+            else:
+                time.sleep(0.01)
+            latest = timeline.latest()
+            if (latest is not None and latest[1][sweep_channel] == end_target) or time.time() > deadline:
+                break
+        pipeline.pose = None
+        timeline.stop()
+    servo.set_speed(sweep_channel, servo_speed)
           
-ser = serial.Serial(com_port, baudrate)
+writer = SnapshotWriter()
+scheduler = DwellScheduler(dwell_revolutions, settle_seconds, max_missing_packets)
 
-th1 = Thread(target=read_Lidar)
-th1.daemon = True
-th1.start()
+if replay_file:
+    ser = ReplaySerial(replay_file, loop=True)
+else:
+    ser = serial.Serial(com_port, baudrate)
 
-start_time = time.time()
+# The reader never waits on the display or the disk: the display only ever wants the newest
+# revolution, while storage keeps every one
+pipeline = AcquisitionPipeline(ser, transform=project_sweep if scan_mode == 'sweep' else project_scan)
+if visualization:
+    pipeline.add_sink('display', show_scan, maxsize=1, policy=DROP_OLDEST)
+if storing:
+    pipeline.add_sink('storage', store_sweep if scan_mode == 'sweep' else store_scan, maxsize=32, policy=BLOCK)
+if archive_prefix:
+    # sweep revolutions are archived raw, without their poses
+    archive = RevolutionRecorder(archive_prefix, poses=pose_table if scan_mode != 'sweep' else None)
+    pipeline.add_sink('archive', lambda item: archive.add(item[0]), maxsize=32, policy=BLOCK)
+pipeline.start()
+if metrics_log_interval:
+    start_logging(pipeline.metrics, metrics_log_interval)
+if metrics_port:
+    serve_metrics(pipeline.metrics, metrics_port)
+
+scan_start_time = time.time()
+if scan_mode == 'sweep':
+    sweep_scan()
+    print 'Sweep complete: %d rows, %d revolutions in %.1f s (predicted %.0f s)' % (
+        len(rows), len(sweep_poses), time.time() - scan_start_time, predicted)
+    finish_scan()
+    scan = False
 move_flag = True
-yaw_index = 0
-pitch_index = 0
-loc = -1   
+step = 0
 while scan:
     if visualization:
         rate(24) # synchonous repaint at 24fps
-        yaw_angle = yaw_set.keys()[yaw_index]
-        pitch_angle = pitch_set.keys()[pitch_index]
-        if move_flag == True:
-            loc += 1
-            servo.set_target(0,yaw_set.values()[yaw_index]) 
-            servo.set_target(1,pitch_set.values()[pitch_index])
-            while (servo.is_moving(0) or servo.is_moving(1))  == True:
-                time.sleep(0.001)
-        elapsed_time = time.time() - start_time
-        if elapsed_time < 3: 
-            move_flag = False
+    else:
+        time.sleep(0.01)
+    if move_flag == True:
+        target = plan[step]
+        pipeline.pose = None # revolutions captured while moving are thrown away
+        move_start = time.time()
+        servo.set_targets({0: target['yaw_target'], 1: target['pitch_target']})
+        wait_for_servos()
+        pose = (target['id'], target['yaw'], target['pitch'])
+        scheduler.start_pose(pose, time.time() - move_start)
+        pipeline.pose = pose
+    # stay until enough clean revolutions have been captured here, see DwellScheduler
+    if not scheduler.done:
+        move_flag = False
+    else:
+        move_flag = True
+        scheduler.finish_pose()
+        if step < len(plan) - 1:
+            step += 1
         else:
-            move_flag = True
-            start_time = time.time()
-            if pitch_index < len(pitch_set) - 1:
-                pitch_index += 1
-            else:
-                pitch_index = 0
-                if yaw_index < len(yaw_set) - 1:
-                    yaw_index += 1
-                else:
-                    print 'Scan complete'
-                    if storing == True:
-                        print 'Storing snapshot in ' + file_name
-                        store_snapshot(file_name)
-                        print 'Finished'
-                    scan = False
+            summary = scheduler.summary()
+            print 'Scan complete: %d poses in %.1f s (predicted %.0f s; %.1f s moving, %.1f s at the poses), %d clean revolutions, %.0f angles per pose' % (
+                summary['poses'], summary['seconds'], predicted, summary['move_seconds'], summary['dwell_seconds'],
+                summary['clean'], summary['mean_angles'])
+            if summary['timed_out']:
+                print '%d poses timed out before %d clean revolutions' % (summary['timed_out'], dwell_revolutions)
+            finish_scan()
+            scan = False
+
+# keep the display responsive, showing progress, until the file is written
+while writer.busy:
+    if visualization:
+        rate(10)
+        label_saving.text = writer.status()
+    else:
+        time.sleep(0.1)
+writer.close()
+if writer.last:
+    print writer.last
 
 
 
@@ -0,0 +1,322 @@
+#Compact binary point-cloud files (.xvpc) for lidar scans
+#A small JSON header (pose table, capture time, RPM statistics, units) followed by one
+#fixed-dtype column after another, so readers can memory-map just the columns they use.
+#Only the points themselves are stored, each with its pose and angle, plus an optional
+#bitmap per pose of the angles that have one. Files can instead hold the raw samples
+#(distance and time in place of position), which are projected when they are read with
+#the pose table and the current calibration in rotation.py, so they can be reprojected
+#requires numpy and pandas
+#
+#Usage:
+#   python lidar_format.py info scan.xvpc
+#   python lidar_format.py export scan.xvpc scan.csv
+#   python lidar_format.py export raw_scan.xvpc scan.csv --angles corrected_angles.json
+
+import json, struct, time, argparse, collections
+import numpy as np
+import pandas as pd
+import rotation as rot
+from point_buffer import PointBuffer, SampleBuffer
+from lidar_pipeline import Sink, BLOCK
+
+# File layout:
+#   PREFIX: magic, format version, header length, offset of the first column
+#   header: UTF-8 JSON, see write_points
+#   columns: each one contiguous, little-endian, starting on a 64 byte boundary
+MAGIC = b'XVPC'
+VERSION = 1
+PREFIX = struct.Struct('<4sHIQ')
+ALIGN = 64
+
+# name -> (dtype, shape of one row)
+COLUMN_TYPES = collections.OrderedDict([
+    ('xyz', ('<f4', (3,))),
+    ('intensity', ('<u2', ())),
+    ('flags', ('<u1', ())),
+    ('pose', ('<u2', ())),
+    ('angle', ('<u2', ())),
+])
+# the columns of raw sample files, time being seconds from the capture time
+SAMPLE_COLUMN_TYPES = collections.OrderedDict([
+    ('dist_mm', ('<u2', ())),
+    ('intensity', ('<u2', ())),
+    ('flags', ('<u1', ())),
+    ('pose', ('<u2', ())),
+    ('angle', ('<u2', ())),
+    ('time', ('<f4', ())),
+])
+VALIDITY_TYPE = ('u1', (45,)) # np.packbits of 360 flags per pose
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def rpm_stats(rpm):
+    """Summary of a list of per-revolution RPMs, as stored in the header."""
+    rpm = np.asarray(rpm, dtype=float)
+    if not len(rpm):
+        return None
+    return {'mean': float(rpm.mean()), 'std': float(rpm.std()), 'min': float(rpm.min()),
+            'max': float(rpm.max()), 'revolutions': len(rpm)}
+
+def projection_table(poses, size=0):
+    """A rotation.ProjectionTable for a stored pose table; pose ids without yaw and pitch angles are flat."""
+    return rot.ProjectionTable([p for p in poses if 'yaw' in p and 'pitch' in p], size)
+
+def calibration(poses):
+    """What positions projected with a pose table depend on, to tell when they need working out again."""
+    return json.dumps(poses, sort_keys=True), float(rot.VERTICAL_OFFSET)
+
+def write_points(fn, points, poses=None, capture_time=None, rpm=None, validity=True, progress=None, **metadata):
+    """Write the points held in a PointBuffer, or the raw samples in a SampleBuffer, to an .xvpc file.
+
+poses -- list of dicts describing each pose id, e.g. {'id': 3, 'yaw': -80.0, 'pitch': 7.0}
+capture_time -- seconds since the epoch the scan was started (now, if omitted)
+rpm -- list of per-revolution RPMs, summarised in the header
+validity -- also store the bitmap of which angles of each pose have a point
+progress -- called with the fraction written after each column
+Any other keyword arguments are stored in the header as they are.
+"""
+    if capture_time is None:
+        capture_time = time.time()
+    n_poses = max(len(poses or []), int(points.pose[points.valid].max()) + 1 if points.valid.any() else 0)
+    points = points.compact()
+    raw = isinstance(points, SampleBuffer)
+    if raw:
+        arrays = collections.OrderedDict([('dist_mm', points.dist_mm), ('intensity', points.intensity),
+                                          ('flags', points.flags), ('pose', points.pose), ('angle', points.angle),
+                                          ('time', points.time - capture_time)])
+        types = collections.OrderedDict(SAMPLE_COLUMN_TYPES)
+    else:
+        arrays = collections.OrderedDict([('xyz', points.xyz), ('intensity', points.intensity),
+                                          ('flags', points.flags), ('pose', points.pose), ('angle', points.angle)])
+        types = collections.OrderedDict(COLUMN_TYPES)
+    lengths = dict((name, len(points)) for name in types)
+    if validity:
+        arrays['validity'] = np.packbits(points.validity(n_poses), axis=1)
+        types['validity'] = VALIDITY_TYPE
+        lengths['validity'] = n_poses
+    columns = []
+    offset = 0
+    for name, (dtype, shape) in types.items():
+        nbytes = lengths[name] * np.dtype(dtype).itemsize * int(np.prod(shape))
+        columns.append({'name': name, 'dtype': dtype, 'shape': list(shape), 'offset': offset, 'length': lengths[name]})
+        offset = _aligned(offset + nbytes)
+    header = {
+        'points': len(points),
+        'pose_count': n_poses,
+        'columns': columns,
+        'units': {'position': 'mm', 'angles': 'degrees', 'intensity': 'lidar quality'},
+        'flags': {'valid': 1, 'warning': 2},
+        'capture_time': capture_time,
+        'capture_time_utc': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(capture_time)),
+        'sensor': 'Neato XV-11',
+        'poses': poses or [],
+        'rpm': rpm_stats(rpm or []),
+        'geometry': 'raw' if raw else 'projected',
+        'vertical_offset': float(rot.VERTICAL_OFFSET),
+    }
+    header.update(metadata)
+    header = json.dumps(header).encode('utf-8')
+    data_offset = _aligned(PREFIX.size + len(header))
+    with open(fn, 'wb') as f:
+        f.write(PREFIX.pack(MAGIC, VERSION, len(header), data_offset))
+        f.write(header)
+        for column in columns:
+            f.write(b'\0' * (data_offset + column['offset'] - f.tell()))
+            dtype, shape = types[column['name']]
+            np.ascontiguousarray(arrays[column['name']], dtype=dtype).tofile(f)
+            if progress:
+                progress((column['offset'] + 1.0) / (offset + 1.0))
+        if progress:
+            progress(1.0)
+
+class PointCloudFile(object):
+    """An .xvpc file opened for reading.
+
+Only the header is read on opening. Each column is memory-mapped the first time it is
+used, so opening a huge file is instant and unused columns are never read. The positions
+of raw sample files are projected when first asked for, and projected again only if the
+pose table used or rotation.VERTICAL_OFFSET has changed since.
+"""
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as f:
+            magic, version, header_len, self.data_offset = PREFIX.unpack(f.read(PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError('%s is not a point-cloud file' % fn)
+            if version > VERSION:
+                raise ValueError('%s is format version %d, this reader only knows up to %d' % (fn, version, VERSION))
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        self.columns = dict((c['name'], c) for c in self.header['columns'])
+        self._mapped = {}
+        self._projected = (None, None) # (calibration, xyz)
+
+    def __len__(self):
+        return self.header['points']
+
+    def __getitem__(self, name):
+        """A read-only memory map of one column."""
+        if name not in self._mapped:
+            column = self.columns[name]
+            shape = (column.get('length', len(self)),) + tuple(column['shape'])
+            if shape[0] == 0:
+                self._mapped[name] = np.zeros(shape, dtype=column['dtype'])
+            else:
+                self._mapped[name] = np.memmap(self.fn, dtype=column['dtype'], mode='r',
+                                               offset=self.data_offset + column['offset'], shape=shape)
+        return self._mapped[name]
+
+    @property
+    def poses(self):
+        return self.header['poses']
+
+    @property
+    def raw(self):
+        """True if the file holds raw samples, projected when read."""
+        return 'dist_mm' in self.columns
+
+    def samples(self):
+        """The raw samples of a raw file as a SampleBuffer backed by the memory maps (times are a copy)."""
+        return SampleBuffer.from_arrays(self['dist_mm'], self['intensity'], self['flags'], self['pose'],
+                                        self['angle'], self['time'] + self.header['capture_time'])
+
+    def xyz(self, poses=None, chunk_rows=100000):
+        """(points, 3) positions. For raw files they are projected, chunk_rows at a time, with poses
+(a pose table, by default the stored one) and the current calibration.
+"""
+        if not self.raw:
+            return self['xyz']
+        if poses is None:
+            poses = self.poses
+        key = calibration(poses)
+        if self._projected[0] != key:
+            table = projection_table(poses, self.header.get('pose_count', 0))
+            self._projected = (key, self.samples().project_xyz(table, chunk_rows))
+        return self._projected[1]
+
+    def points(self, poses=None):
+        """The stored points as a PointBuffer backed by the memory maps (no copy), see xyz() for raw files."""
+        if self.raw:
+            return PointBuffer.from_arrays(self.xyz(poses), self['intensity'], self['flags'], self['pose'], self['angle'])
+        return PointBuffer.from_arrays(self['xyz'], self['intensity'], self['flags'], self['pose'], self['angle'])
+
+    def validity(self):
+        """(poses, 360) bool array, True where a pose has a point at that angle."""
+        if 'validity' in self.columns:
+            return np.unpackbits(self['validity'], axis=1).astype(np.bool_)
+        return self.points().validity(self.header.get('pose_count'))
+
+    def dense(self, poses=None):
+        """The points rebuilt into the acquisition layout of 360 rows per pose (a copy)."""
+        return self.points(poses).expand(self.header.get('pose_count'))
+
+    def to_dataframe(self, dense=False, poses=None):
+        if dense:
+            return self.dense(poses).to_dataframe(dense=True)
+        return self.points(poses).to_dataframe()
+
+    def to_csv(self, fn, dense=False, poses=None):
+        self.to_dataframe(dense, poses).to_csv(fn)
+
+def load_points(fn, poses=None):
+    """Load the points of a stored scan, .xvpc or CSV in either layout, as a compact PointBuffer.
+
+poses -- for raw .xvpc files, a pose table to project with in place of the stored one
+"""
+    if fn.endswith('.xvpc'):
+        return PointCloudFile(fn).points(poses)
+    return PointBuffer.from_dataframe(pd.read_csv(fn, index_col=0))
+
+def save_points(fn, points, progress=None, **metadata):
+    """Save a PointBuffer or SampleBuffer as .xvpc (with metadata, see write_points) or, for any other
+extension, as CSV, projecting raw samples with the poses in metadata.
+"""
+    if fn.endswith('.xvpc'):
+        write_points(fn, points, progress=progress, **metadata)
+    else:
+        if isinstance(points, SampleBuffer):
+            points = points.compact()
+            size = int(points.pose.max()) + 1 if len(points) else 0
+            points = points.project(projection_table(metadata.get('poses') or [], size))
+        points.to_csv(fn, progress=progress)
+
+class SnapshotWriter(object):
+    """Saves point buffers on a background thread, so acquisition and the display never wait on the disk.
+
+submit() only queues the buffer: hand it one nothing will write to again, e.g. a fresh
+copy or a buffer whose scan is finished. status() describes what the writer is doing, for
+the display, and on_done(fn, error) is called from the writer thread after each file.
+"""
+    def __init__(self, on_done=None):
+        self.on_done = on_done
+        self.current = None # file being written
+        self.progress = 0.0
+        self.last = None # message about the last file finished
+        self.submitted = 0
+        self.finished = 0
+        self.sink = Sink('snapshot writer', self._write, maxsize=8, policy=BLOCK)
+        self.sink.thread.start()
+
+    def submit(self, fn, points, **metadata):
+        """Queue points to be saved to fn, see save_points."""
+        self.submitted += 1
+        self.sink.queue.put((fn, points, metadata))
+
+    @property
+    def busy(self):
+        return self.finished < self.submitted
+
+    def status(self):
+        queued = len(self.sink.queue)
+        if self.current is not None:
+            text = 'Saving %s: %d%%' % (self.current, self.progress * 100)
+            return text + (' (%d more queued)' % queued if queued else '')
+        return self.last or ''
+
+    def _set_progress(self, fraction):
+        self.progress = fraction
+
+    def _write(self, job):
+        fn, points, metadata = job
+        self.progress = 0.0
+        self.current = fn
+        error = None
+        try:
+            save_points(fn, points, progress=self._set_progress, **metadata)
+            self.last = 'Saved ' + fn
+        except Exception as e:
+            error = e
+            self.last = 'Failed to save %s: %s' % (fn, e)
+        self.current = None
+        self.finished += 1
+        if self.on_done:
+            self.on_done(fn, error)
+
+    def close(self, timeout=None):
+        """Finish writing everything queued, then stop the thread."""
+        self.sink.queue.close()
+        self.sink.thread.join(timeout)
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or export .xvpc point-cloud files')
+    commands = parser.add_subparsers(dest='command')
+    info = commands.add_parser('info', help='print the header')
+    info.add_argument('file')
+    export = commands.add_parser('export', help='write the points out as CSV')
+    export.add_argument('file')
+    export.add_argument('output')
+    export.add_argument('--dense', action='store_true', help='one row per angle and pose, with empty rows, as older files were')
+    export.add_argument('--angles', help='for raw files, project with the poses in this angle file (e.g. a recalibrated '
+                                         'scan_angles.json) rather than the stored pose table')
+    args = parser.parse_args()
+    if args.command == 'info':
+        cloud = PointCloudFile(args.file)
+        print(json.dumps(cloud.header, indent=2, sort_keys=True))
+    elif args.command == 'export':
+        poses = rot.ProjectionTable.from_angle_file(args.angles).poses if args.angles else None
+        PointCloudFile(args.file).to_csv(args.output, args.dense, poses)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#Health metrics for lidar acquisition: packet and revolution rates, checksum errors,
+#bytes lost resyncing, missing packets and RPM, over a rolling time window
+#Can be read with snapshot(), printed periodically, or served over HTTP
+
+import sys, time, json, math, collections
+from threading import Thread, Lock
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler # Python 2
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Counters kept per one second bucket
+FIELDS = ('packets', 'checksum_errors', 'resync_bytes', 'revolutions', 'missing_packets',
+          'duplicate_packets', 'rpm_count', 'rpm_sum', 'rpm_sumsq')
+FIELD_INDEX = dict((name, i) for i, name in enumerate(FIELDS))
+
+class AcquisitionMetrics(object):
+    """Rolling-window counters, safe to update from the acquisition threads and read from any other."""
+    def __init__(self, window=10.0):
+        self.window = window
+        self.lock = Lock()
+        self.buckets = collections.deque() # [second, counter values in FIELDS order]
+        self.totals = [0] * len(FIELDS)
+        self.started = time.time()
+        self.gauges = collections.OrderedDict() # name -> function returning a current value
+
+    def add_gauge(self, name, fn):
+        """Report fn() under name in every snapshot, e.g. a queue's drop count."""
+        self.gauges[name] = fn
+
+    def _add(self, now, values):
+        if now is None:
+            now = time.time()
+        second = int(now)
+        with self.lock:
+            if not self.buckets or self.buckets[-1][0] != second:
+                self.buckets.append([second] + [0] * len(FIELDS))
+                while self.buckets[0][0] <= second - self.window:
+                    self.buckets.popleft()
+            bucket = self.buckets[-1]
+            for name, value in values:
+                i = FIELD_INDEX[name]
+                bucket[i + 1] += value
+                self.totals[i] += value
+
+    def record_packets(self, packets, checksum_errors, rpm, now=None):
+        """Count a batch of packets. rpm is an array of the RPM of the good ones."""
+        self._add(now, (('packets', packets), ('checksum_errors', checksum_errors),
+                        ('rpm_count', len(rpm)), ('rpm_sum', float(rpm.sum())),
+                        ('rpm_sumsq', float((rpm.astype(float) ** 2).sum()))))
+
+    def record_resync(self, discarded, now=None):
+        """Count bytes thrown away by the framer while looking for a packet start."""
+        if discarded:
+            self._add(now, (('resync_bytes', discarded),))
+
+    def record_revolution(self, scan, now=None):
+        self._add(now, (('revolutions', 1), ('missing_packets', scan.missing),
+                        ('duplicate_packets', scan.duplicates)))
+
+    def snapshot(self, now=None):
+        """The current rates over the window, and totals since start, as a dict."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            window = [0] * len(FIELDS)
+            for bucket in self.buckets:
+                if bucket[0] > now - self.window:
+                    for i, value in enumerate(bucket[1:]):
+                        window[i] += value
+            totals = list(self.totals)
+        w = dict(zip(FIELDS, window))
+        span = max(min(self.window, now - self.started), 1e-6)
+        revolutions = w['revolutions']
+        rpm_mean = w['rpm_sum'] / w['rpm_count'] if w['rpm_count'] else 0.0
+        rpm_var = max(w['rpm_sumsq'] / w['rpm_count'] - rpm_mean ** 2, 0.0) if w['rpm_count'] else 0.0
+        snap = collections.OrderedDict([
+            ('uptime_s', now - self.started),
+            ('packets_per_s', w['packets'] / span),
+            ('revolutions_per_s', revolutions / span),
+            ('checksum_errors_per_s', w['checksum_errors'] / span),
+            ('resync_bytes_per_s', w['resync_bytes'] / span),
+            ('missing_packets_per_rev', w['missing_packets'] / float(revolutions) if revolutions else 0.0),
+            ('duplicate_packets_per_rev', w['duplicate_packets'] / float(revolutions) if revolutions else 0.0),
+            ('rpm_mean', rpm_mean),
+            ('rpm_var', rpm_var),
+        ])
+        for name in ('packets', 'checksum_errors', 'resync_bytes', 'revolutions', 'missing_packets'):
+            snap['total_' + name] = totals[FIELD_INDEX[name]]
+        for name, fn in self.gauges.items():
+            snap[name] = fn()
+        return snap
+
+def format_line(snap):
+    """One human readable line summarising a snapshot."""
+    return ('packets/s %.0f  revs/s %.2f  checksum errors/s %.2f  resync bytes/s %.1f  '
+            'missing/rev %.2f  RPM %.1f +/- %.2f' % (snap['packets_per_s'], snap['revolutions_per_s'],
+            snap['checksum_errors_per_s'], snap['resync_bytes_per_s'], snap['missing_packets_per_rev'],
+            snap['rpm_mean'], math.sqrt(snap['rpm_var'])))
+
+def format_prometheus(snap, prefix='xv11_'):
+    """A snapshot in the Prometheus text exposition format."""
+    return ''.join('%s%s %r\n' % (prefix, name, float(value)) for name, value in snap.items())
+
+def start_logging(metrics, interval=10.0, out=sys.stdout):
+    """Write a summary line to out every interval seconds, from a daemon thread."""
+    def run():
+        while True:
+            time.sleep(interval)
+            out.write(time.strftime('%H:%M:%S ') + format_line(metrics.snapshot()) + '\n')
+            out.flush()
+    th = Thread(target=run, name='metrics log')
+    th.daemon = True
+    th.start()
+    return th
+
+def serve_metrics(metrics, port=8000, host='127.0.0.1'):
+    """Serve the metrics over HTTP from a daemon thread.
+
+/metrics gives the Prometheus text format, /metrics.json the snapshot as JSON.
+"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = format_prometheus(metrics.snapshot())
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps(metrics.snapshot())
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass # keep the console for the acquisition program
+
+    server = HTTPServer((host, port), Handler)
+    th = Thread(target=server.serve_forever, name='metrics http')
+    th.daemon = True
+    th.start()
+    return server
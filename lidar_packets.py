@@ -0,0 +1,165 @@
+#Packet framing for the Neato XV-11 lidar serial stream
+#Shared by lidar2store and lidar3Dstore
+#requires numpy and pyserial (or any object with a serial-like read())
+
+import numpy as np
+
+# Each packet is 22 bytes:
+#   0xFA, index (0xA0-0xF9), speed (2 bytes), 4 x 4 bytes of sample data, checksum (2 bytes)
+PACKET_SIZE = 22
+START_BYTE = 0xFA
+INDEX_MIN = 0xA0
+INDEX_MAX = 0xF9
+PACKETS_PER_REV = INDEX_MAX - INDEX_MIN + 1 # 90 packets of 4 samples = 360 degrees
+
+# One decoded sample. Flags are the top two bits of the second data byte:
+# 0x80 "invalid data", 0x40 "strength warning"
+SAMPLE_DTYPE = np.dtype([('angle', np.uint16), ('dist_mm', np.uint16), ('quality', np.uint16),
+                         ('invalid', np.bool_), ('warning', np.bool_), ('rpm', np.float32)])
+
+class PacketFramer(object):
+    """Splits a raw byte stream into 22 byte XV-11 packets.
+
+Incoming bytes are kept in one reusable bytearray, so a packet split across two reads
+is picked up on the next read. Packets are handed out as memoryview slices of that
+buffer (no copy), and are only valid until the next call to feed() or read_packets().
+"""
+    def __init__(self, ser=None, size=4096):
+        self.ser = ser
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0 # first unconsumed byte
+        self.end = 0 # one past the last byte received
+        self.discarded = 0 # bytes thrown away while looking for a packet start
+
+    def _append(self, data):
+        n = len(data)
+        pending = self.end - self.start
+        # move the leftover partial packet to the front of the buffer
+        if self.start > 0:
+            self.buf[0:pending] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        if pending + n > len(self.buf):
+            # grow into a new buffer, so packets already handed out stay valid
+            buf = bytearray(max(2 * len(self.buf), pending + n))
+            buf[0:pending] = self.buf[0:pending]
+            self.buf = buf
+            self.view = memoryview(buf)
+        self.buf[self.end:self.end + n] = data
+        self.end += n
+
+    def feed(self, data):
+        """Add raw bytes to the stream and return the list of complete packets found."""
+        if data:
+            self._append(data)
+        buf = self.buf
+        i = self.start
+        end = self.end
+        packets = []
+        while end - i >= PACKET_SIZE:
+            if buf[i] != START_BYTE:
+                j = buf.find(b'\xfa', i, end)
+                if j < 0:
+                    self.discarded += end - i
+                    i = end
+                    break
+                self.discarded += j - i
+                i = j
+                if end - i < PACKET_SIZE:
+                    break
+            if INDEX_MIN <= buf[i + 1] <= INDEX_MAX:
+                packets.append(self.view[i:i + PACKET_SIZE])
+                i += PACKET_SIZE
+            else:
+                # not a packet start after all, look again from the next byte
+                self.discarded += 1
+                i += 1
+        self.start = i
+        return packets
+
+    def read_packets(self):
+        """Read everything waiting on the serial port and return the complete packets.
+
+Blocks until at least one packet's worth of bytes has arrived, rather than spinning.
+"""
+        waiting = self.in_waiting()
+        return self.feed(self.ser.read(max(PACKET_SIZE, waiting)))
+
+    def in_waiting(self):
+        if hasattr(self.ser, 'in_waiting'):
+            return self.ser.in_waiting
+        return self.ser.inWaiting() # pyserial 2.x
+
+def checksum(data):
+    """Compute and return the checksum as an int.
+
+data -- list of 20 bytes (as ints), in the order they arrived in.
+"""
+    # group the data by word, little-endian
+    data_list = []
+    for t in range(10):
+        data_list.append( data[2*t] + (data[2*t+1]<<8) )
+    
+    # compute the checksum on 32 bits
+    chk32 = 0
+    for d in data_list:
+        chk32 = (chk32 << 1) + d
+
+    # return a value wrapped around on 15bits, and truncated to still fit into 15 bits
+    checksum = (chk32 & 0x7FFF) + ( chk32 >> 15 ) # wrap around to fit into 15 bits
+    checksum = checksum & 0x7FFF # truncate to 15 bits
+    return int( checksum )
+
+def compute_speed(data):
+    speed_rpm = float( data[0] | (data[1] << 8) ) / 64.0
+    return speed_rpm
+
+# Shifting the accumulator left once per word means word t ends up multiplied by 2**(9-t),
+# so the 32 bit sum is a dot product with these weights (at most 65535 * 1023, no overflow)
+CHECKSUM_WEIGHTS = (1 << np.arange(9, -1, -1)).astype(np.uint32)
+
+def checksums(data):
+    """Vector form of checksum: the computed checksum of each packet in an (N, 22) array."""
+    data = np.ascontiguousarray(data, dtype=np.uint8).reshape(-1, PACKET_SIZE)
+    words = data.view('<u2') # (N, 11) little-endian words, the last one is the received checksum
+    chk32 = words[:, :10].dot(CHECKSUM_WEIGHTS)
+    return ((chk32 & 0x7FFF) + (chk32 >> 15)) & 0x7FFF
+
+def verify_checksums(data):
+    """Return a boolean mask, True for each packet whose received checksum matches its data."""
+    data = np.ascontiguousarray(data, dtype=np.uint8).reshape(-1, PACKET_SIZE)
+    return checksums(data) == data.view('<u2')[:, 10]
+
+def packets_to_array(packets):
+    """Stack a list of framed packets (memoryviews, bytes or bytearrays) into an (N, 22) uint8 array."""
+    data = np.empty((len(packets), PACKET_SIZE), dtype=np.uint8)
+    for i, packet in enumerate(packets):
+        if isinstance(packet, memoryview):
+            data[i] = np.asarray(packet) # Python 2 numpy can't frombuffer a memoryview
+        else:
+            data[i] = np.frombuffer(packet, dtype=np.uint8)
+    return data
+
+def decode_packets(data):
+    """Decode a batch of packets in one pass.
+
+data -- (N, 22) uint8 array of framed packets (or anything reshapeable to it).
+Returns an (N, 4) array of SAMPLE_DTYPE, one row per packet and one column per sample.
+"""
+    data = np.asarray(data, dtype=np.uint8).reshape(-1, PACKET_SIZE)
+    n = len(data)
+    samples = data[:, 4:20].reshape(n, 4, 4)
+    x1 = samples[:, :, 1]
+    out = np.empty((n, 4), dtype=SAMPLE_DTYPE)
+    out['angle'] = (data[:, 1:2].astype(np.uint16) - INDEX_MIN) * 4 + np.arange(4, dtype=np.uint16)
+    out['dist_mm'] = samples[:, :, 0] | ((x1 & 0x3f).astype(np.uint16) << 8) # 14 bits
+    out['quality'] = samples[:, :, 2] | (samples[:, :, 3].astype(np.uint16) << 8) # 16 bits
+    out['invalid'] = (x1 & 0x80) != 0
+    out['warning'] = (x1 & 0x40) != 0
+    out['rpm'] = compute_speeds(data)[:, None]
+    return out
+
+def compute_speeds(data):
+    """Vector form of compute_speed: the RPM of each packet in an (N, 22) array."""
+    return (data[:, 2] | (data[:, 3].astype(np.uint16) << 8)) / 64.0
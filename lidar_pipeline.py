@@ -0,0 +1,234 @@
+#Threaded acquisition pipeline for the XV-11 lidar
+#serial reader -> decoder -> transform -> sinks, connected by bounded queues
+#requires numpy
+
+import os, sys, time, pickle, tempfile, traceback, collections
+from threading import Thread, Condition
+from lidar_packets import PacketFramer, packets_to_array, verify_checksums, compute_speeds
+from lidar_scan import RevolutionAssembler
+from lidar_metrics import AcquisitionMetrics
+
+# What a full queue does with a new item
+DROP_OLDEST = 'drop_oldest' # throw away the oldest item (display: only the newest matters)
+BLOCK = 'block' # make the producer wait (storage: nothing may be lost)
+SPILL = 'spill' # keep the overflow in a temporary file (storage, without holding anyone up)
+
+class Closed(Exception):
+    """Raised by BoundedQueue.get once the queue is closed and empty."""
+    pass
+
+class BoundedQueue(object):
+    """A thread-safe FIFO holding at most maxsize items in memory.
+
+policy says what put() does when it is full: DROP_OLDEST, BLOCK or SPILL.
+Spilled items are pickled to a temporary file and come back out in order.
+"""
+    def __init__(self, maxsize, policy=DROP_OLDEST):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.cond = Condition()
+        self.closed = False
+        self.dropped = 0 # items thrown away by DROP_OLDEST
+        self.spill_file = None
+        self.spilled = 0 # items currently waiting in the spill file
+        self.spill_read = 0 # offset of the next spilled item
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items) + self.spilled
+
+    def put(self, item):
+        with self.cond:
+            if self.policy == SPILL and (self.spilled or len(self.items) >= self.maxsize):
+                self._spill(item)
+            else:
+                while len(self.items) >= self.maxsize:
+                    if self.policy == BLOCK and not self.closed:
+                        self.cond.wait()
+                    else:
+                        self.items.popleft()
+                        self.dropped += 1
+                self.items.append(item)
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """Return the oldest item, waiting for one if need be.
+
+Raises Closed once the queue has been closed and emptied, or returns None on timeout.
+"""
+        with self.cond:
+            end = None if timeout is None else time.time() + timeout
+            while not self.items and not self.spilled:
+                if self.closed:
+                    raise Closed()
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            if self.items:
+                item = self.items.popleft()
+            else:
+                item = self._unspill()
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        """Mark the queue closed: consumers finish what is queued, then get Closed."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until every queued item has been taken."""
+        end = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.items or self.spilled:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _spill(self, item):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+        self.spill_file.seek(0, os.SEEK_END)
+        pickle.dump(item, self.spill_file, pickle.HIGHEST_PROTOCOL)
+        self.spilled += 1
+
+    def _unspill(self):
+        self.spill_file.seek(self.spill_read)
+        item = pickle.load(self.spill_file)
+        self.spill_read = self.spill_file.tell()
+        self.spilled -= 1
+        if not self.spilled:
+            self.spill_file.seek(0)
+            self.spill_file.truncate()
+            self.spill_read = 0
+        return item
+
+class Sink(object):
+    """A consumer running on its own thread, fed from its own BoundedQueue."""
+    def __init__(self, name, callback, maxsize=4, policy=DROP_OLDEST):
+        self.name = name
+        self.callback = callback
+        self.queue = BoundedQueue(maxsize, policy)
+        self.thread = Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.handled = 0
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get()
+            except Closed:
+                return
+            try:
+                self.callback(item)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+            self.handled += 1
+
+class AcquisitionPipeline(object):
+    """Runs acquisition as separate stages, each on its own thread:
+
+reader -- reads the serial port and frames packets; never waits on anything downstream,
+          a full batch queue loses its oldest batch instead.
+decoder -- checks checksums and assembles revolutions (RevolutionAssembler).
+transform -- applies transform(scan) to each complete revolution, a copy tagged with
+             the pose that was current when it completed. Returning None drops it.
+sinks -- each gets every transformed revolution through its own queue and policy.
+
+Health counters for every stage are kept in self.metrics (see lidar_metrics).
+"""
+    def __init__(self, ser, transform=None, batch_queue_size=256, scan_queue_size=16):
+        self.framer = PacketFramer(ser)
+        self.assembler = RevolutionAssembler()
+        self.assembler.subscribe(self._on_scan)
+        self.transform = transform
+        self.batches = BoundedQueue(batch_queue_size, DROP_OLDEST)
+        self.scans = BoundedQueue(scan_queue_size, BLOCK)
+        self.sinks = []
+        self.pose = None # set by the caller, copied onto each revolution as it completes
+        self.running = False
+        self.threads = []
+        self.metrics = AcquisitionMetrics()
+        self.metrics.add_gauge('dropped_batches', lambda: self.batches.dropped)
+
+    def add_sink(self, name, callback, maxsize=4, policy=DROP_OLDEST):
+        """Call callback(item) on a separate thread for every revolution, after transform."""
+        sink = Sink(name, callback, maxsize, policy)
+        self.sinks.append(sink)
+        self.metrics.add_gauge(name + '_dropped', lambda: sink.queue.dropped)
+        self.metrics.add_gauge(name + '_queued', lambda: len(sink.queue))
+        if self.running:
+            sink.thread.start()
+        return sink
+
+    def start(self):
+        self.running = True
+        for target, name in ((self._read, 'reader'), (self._decode, 'decoder'), (self._transform, 'transform')):
+            th = Thread(target=target, name=name)
+            th.daemon = True
+            th.start()
+            self.threads.append(th)
+        for sink in self.sinks:
+            sink.thread.start()
+
+    def stop(self, drain=True):
+        """Stop reading; with drain, wait for everything already read to reach the sinks."""
+        self.running = False
+        if not self.threads: # never started, or stopped already
+            return
+        threads, self.threads = self.threads, []
+        threads[0].join(1.0) # the reader may still be waiting on the port, it exits after that read
+        self.batches.close()
+        for th in threads[1:]:
+            th.join()
+        for sink in self.sinks:
+            sink.queue.close()
+            if drain and sink.thread.ident is not None: # not started if start() failed before the sinks
+                sink.thread.join()
+
+    def _read(self):
+        discarded = 0
+        while self.running:
+            try:
+                packets = self.framer.read_packets()
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                continue
+            self.metrics.record_resync(self.framer.discarded - discarded)
+            discarded = self.framer.discarded
+            if packets:
+                self.batches.put((packets_to_array(packets), time.time()))
+
+    def _decode(self):
+        while True:
+            try:
+                data, timestamp = self.batches.get()
+            except Closed:
+                self.scans.close()
+                return
+            valid = verify_checksums(data)
+            self.metrics.record_packets(len(data), len(data) - int(valid.sum()), compute_speeds(data[valid]), timestamp)
+            self.assembler.add_packets(data, valid, timestamp)
+
+    def _on_scan(self, scan):
+        self.metrics.record_revolution(scan)
+        scan = scan.copy()
+        scan.pose = self.pose
+        self.scans.put(scan)
+
+    def _transform(self):
+        while True:
+            try:
+                scan = self.scans.get()
+            except Closed:
+                return
+            item = self.transform(scan) if self.transform else scan
+            if item is None:
+                continue
+            for sink in self.sinks:
+                sink.queue.put(item)
@@ -0,0 +1,388 @@
+#Continuous recording of every revolution to chunked, append-only files (.xvrev)
+#Memory use is constant: revolutions are collected in one preallocated chunk that is written
+#out as a whole, checksummed, and indexed by time so readers can jump straight to any moment.
+#Samples are kept raw (uint16 distance and quality per angle, plus a pose id per revolution)
+#and each chunk is delta encoded against the previous revolution and compressed on its own,
+#so chunks can be decompressed independently and in parallel
+#requires numpy
+#
+#Usage:
+#   python lidar_recorder.py info walk_20240101-120000_0000.xvrev
+#   python lidar_recorder.py extract walk_20240101-120000_0000.xvrev 60 65 walk.xvpc
+
+import os, glob, time, json, zlib, struct, argparse
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from point_buffer import PointBuffer, FLAG_VALID, FLAG_WARNING
+
+# File layout: MAGIC, a FILE_HEADER giving the length of a UTF-8 JSON header (pose table,
+# creation time), then chunks, each a CHUNK_HEADER followed by its payload:
+#   marker, count, crc32 of the payload, start time of the first and end time of the last
+#   revolution, payload length, encoding (RAW or DELTA_ZLIB)
+# A chunk is only ever written whole, so after a crash every chunk but possibly the last is
+# intact, and a torn last chunk is recognised by its length or checksum and ignored.
+MAGIC = b'XVREC\x02'
+FILE_HEADER = struct.Struct('<I')
+CHUNK_MARKER = b'XVCK'
+CHUNK_HEADER = struct.Struct('<4sIIddIB')
+
+# Chunk encodings
+RAW = 0 # count REV_DTYPE records as they are
+DELTA_ZLIB = 1 # see encode_chunk
+
+# The time index, kept beside the recording as <file>.idx: one entry per chunk of
+#   file offset of the chunk, count, start time of the first and end time of the last
+#   revolution, payload length
+# It is only a cache: readers rebuild whatever is missing from the chunk headers.
+INDEX_ENTRY = struct.Struct('<QIddI')
+
+# One revolution of raw samples. flags uses FLAG_VALID and FLAG_WARNING from point_buffer.
+REV_DTYPE = np.dtype([('sequence', '<i8'), ('start_time', '<f8'), ('end_time', '<f8'), ('rpm', '<f4'),
+                      ('missing', '<u2'), ('bad_packets', '<u2'), ('pose', '<u2'), ('dist_mm', '<u2', 360),
+                      ('quality', '<u2', 360), ('flags', 'u1', 360)])
+SAMPLE_FIELDS = ('dist_mm', 'quality', 'flags')
+SCALAR_FIELDS = tuple(name for name in REV_DTYPE.names if name not in SAMPLE_FIELDS)
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def _split_bytes(a):
+    """uint16 array -> its low bytes followed by its high bytes, which compress better than interleaved."""
+    return np.ascontiguousarray(a.astype('<u2').view(np.uint8).reshape(a.shape + (2,)).transpose(2, 0, 1)).tobytes()
+
+def _join_bytes(data, shape):
+    planes = np.frombuffer(data, dtype=np.uint8).reshape((2,) + shape)
+    return np.ascontiguousarray(planes.transpose(1, 2, 0)).view('<u2').reshape(shape)
+
+def encode_chunk(records, level=6):
+    """Compress a chunk of REV_DTYPE records.
+
+The per-revolution fields are stored a field at a time. Distances and qualities are stored
+as the zigzag-encoded difference from the same angle in the previous revolution (the first
+revolution as it is, so each chunk decodes on its own), flags as the XOR with the previous
+revolution's, then the whole lot is zlib compressed.
+"""
+    parts = [np.ascontiguousarray(records[name]).tobytes() for name in SCALAR_FIELDS]
+    for name in ('dist_mm', 'quality'):
+        values = records[name]
+        delta = values.copy()
+        delta[1:] = values[1:] - values[:-1] # wraps around modulo 2**16
+        signed = delta[1:].view(np.int16).astype(np.int32)
+        delta[1:] = ((signed << 1) ^ (signed >> 15)) & 0xffff # zigzag: small changes either way stay small
+        parts.append(_split_bytes(delta))
+    flags = records['flags'].copy()
+    flags[1:] ^= records['flags'][:-1]
+    parts.append(flags.tobytes())
+    return zlib.compress(b''.join(parts), level)
+
+def decode_chunk(payload, count):
+    """The REV_DTYPE records of a chunk compressed by encode_chunk."""
+    data = zlib.decompress(payload)
+    records = np.zeros(count, dtype=REV_DTYPE)
+    pos = 0
+    for name in SCALAR_FIELDS:
+        size = count * REV_DTYPE.fields[name][0].itemsize
+        records[name] = np.frombuffer(data[pos:pos + size], dtype=REV_DTYPE.fields[name][0])
+        pos += size
+    for name in ('dist_mm', 'quality'):
+        size = count * 360 * 2
+        delta = _join_bytes(data[pos:pos + size], (count, 360)).astype(np.int32)
+        pos += size
+        delta[1:] = (delta[1:] >> 1) ^ -(delta[1:] & 1)
+        records[name] = np.cumsum(delta.astype(np.uint16), axis=0, dtype=np.uint16)
+    flags = np.frombuffer(data[pos:pos + count * 360], dtype=np.uint8).reshape(count, 360)
+    records['flags'] = np.bitwise_xor.accumulate(flags, axis=0)
+    return records
+
+class RevolutionRecorder(object):
+    """Appends every revolution it is given to a series of .xvrev files.
+
+prefix -- file names are <prefix>_<date-time>_<number>.xvrev
+chunk_revolutions, chunk_seconds -- a chunk is written when it holds this many revolutions
+    or spans this many seconds, whichever comes first; at most that much is lost in a crash
+max_bytes, max_seconds -- start a new file once the current one is this large or this long
+sync -- fsync every chunk, so it is on disk and not just in the OS cache
+compress -- zlib level for delta-encoded chunks, or 0 to store them raw
+poses -- the pose table saved in each file's header, e.g. [{'id': 0, 'yaw': -80.0, 'pitch': -32.75}, ...]
+
+The pose id of a revolution is scan.pose[0] if its pose is a tuple (as lidar3Dstore sets it),
+scan.pose if it is a number, and 0 if it has none.
+"""
+    def __init__(self, prefix, chunk_revolutions=64, chunk_seconds=2.0, max_bytes=None, max_seconds=None, sync=True,
+                 compress=6, poses=None):
+        self.prefix = prefix
+        self.chunk = np.zeros(chunk_revolutions, dtype=REV_DTYPE)
+        self.count = 0
+        self.chunk_seconds = chunk_seconds
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.sync = sync
+        self.compress = compress
+        self.poses = poses or []
+        self.f = None
+        self.index = None
+        self.files = [] # every file written so far
+        self.file_number = 0
+        self.revolutions = 0
+
+    def add(self, scan):
+        """Record one revolution (a lidar_scan.Scan)."""
+        rec = self.chunk[self.count]
+        rec['sequence'] = scan.sequence
+        rec['start_time'] = scan.start_time
+        rec['end_time'] = scan.end_time
+        rec['rpm'] = scan.mean_rpm
+        rec['missing'] = scan.missing
+        rec['bad_packets'] = min(scan.bad_packets, 0xffff)
+        pose = scan.pose[0] if isinstance(scan.pose, (tuple, list)) else scan.pose
+        rec['pose'] = pose or 0
+        rec['dist_mm'] = scan.dist_mm
+        rec['quality'] = scan.quality
+        rec['flags'] = np.where(scan.invalid, 0, FLAG_VALID) | (scan.warning * FLAG_WARNING)
+        self.count += 1
+        self.revolutions += 1
+        if self.count == len(self.chunk) or scan.end_time - self.chunk['start_time'][0] >= self.chunk_seconds:
+            self.flush()
+
+    def _open(self, start_time):
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(start_time))
+        fn = '%s_%s_%04d.xvrev' % (self.prefix, stamp, self.file_number)
+        self.file_number += 1
+        self.f = open(fn, 'wb')
+        header = json.dumps({'created': start_time, 'poses': self.poses,
+                             'units': {'distance': 'mm', 'angles': 'degrees'}}).encode('utf-8')
+        self.f.write(MAGIC + FILE_HEADER.pack(len(header)) + header)
+        self.index = open(fn + '.idx', 'wb')
+        self.file_start = start_time
+        self.files.append(fn)
+
+    def _close_file(self):
+        if self.f is not None:
+            self.f.close()
+            self.index.close()
+            self.f = self.index = None
+
+    def flush(self):
+        """Write out the revolutions collected so far as one chunk."""
+        if not self.count:
+            return
+        records = self.chunk[:self.count]
+        first, last = float(records['start_time'][0]), float(records['end_time'][-1])
+        if self.f is None:
+            self._open(first)
+        if self.compress:
+            payload, encoding = encode_chunk(records, self.compress), DELTA_ZLIB
+        else:
+            payload, encoding = records.tobytes(), RAW
+        offset = self.f.tell()
+        self.f.write(CHUNK_HEADER.pack(CHUNK_MARKER, self.count, _crc(payload), first, last, len(payload), encoding) + payload)
+        self.f.flush()
+        if self.sync:
+            os.fsync(self.f.fileno())
+        self.index.write(INDEX_ENTRY.pack(offset, self.count, first, last, len(payload)))
+        self.index.flush()
+        self.count = 0
+        if ((self.max_bytes and self.f.tell() >= self.max_bytes) or
+                (self.max_seconds and last - self.file_start >= self.max_seconds)):
+            self._close_file()
+
+    def close(self):
+        self.flush()
+        self._close_file()
+
+class RecordingReader(object):
+    """Random access to the revolutions of one .xvrev file.
+
+Uses the .idx file where it is complete and rebuilds the rest from the chunk headers, so
+finding the chunk for a given time never means reading the whole recording. A torn chunk
+at the end of the file, left by a crash, is ignored.
+
+workers -- threads used to decompress chunks when several are read at once
+"""
+    def __init__(self, fn, workers=4):
+        self.fn = fn
+        self.workers = workers
+        self.f = open(fn, 'rb')
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(fn + ' is not a revolution recording')
+        self.header = json.loads(self.f.read(FILE_HEADER.unpack(self.f.read(FILE_HEADER.size))[0]).decode('utf-8'))
+        data_start = self.f.tell()
+        size = os.fstat(self.f.fileno()).st_size
+        entries = [] # (offset, count, first time, last time, payload length)
+        if os.path.exists(fn + '.idx'):
+            with open(fn + '.idx', 'rb') as idx:
+                data = idx.read()
+            for i in range(len(data) // INDEX_ENTRY.size):
+                entry = INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+                if entry[0] + CHUNK_HEADER.size + entry[4] > size:
+                    break
+                entries.append(entry)
+        offset = entries[-1][0] + CHUNK_HEADER.size + entries[-1][4] if entries else data_start
+        while offset + CHUNK_HEADER.size <= size: # chunks the index doesn't cover yet
+            self.f.seek(offset)
+            header = CHUNK_HEADER.unpack(self.f.read(CHUNK_HEADER.size))
+            entry = (offset,) + header[1:2] + header[3:5] + header[5:6]
+            end = offset + CHUNK_HEADER.size + entry[4]
+            if header[0] != CHUNK_MARKER or end > size:
+                break
+            entries.append(entry)
+            offset = end
+        entries = np.array(entries, dtype=float).reshape(-1, 5)
+        self.offsets = entries[:, 0].astype(np.int64)
+        self.counts = entries[:, 1].astype(np.int64)
+        self.first_times = entries[:, 2]
+        self.last_times = entries[:, 3]
+        self.starts = np.concatenate(([0], np.cumsum(self.counts))) # revolution number of each chunk's first
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    @property
+    def poses(self):
+        return self.header['poses']
+
+    @property
+    def start_time(self):
+        return float(self.first_times[0]) if len(self.first_times) else None
+
+    @property
+    def end_time(self):
+        return float(self.last_times[-1]) if len(self.last_times) else None
+
+    def _read_payload(self, i):
+        self.f.seek(self.offsets[i])
+        marker, count, crc, first, last, length, encoding = CHUNK_HEADER.unpack(self.f.read(CHUNK_HEADER.size))
+        payload = self.f.read(length)
+        if _crc(payload) != crc:
+            raise ValueError('chunk %d of %s is corrupt' % (i, self.fn))
+        return payload, count, encoding
+
+    def _decode(self, chunk):
+        payload, count, encoding = chunk
+        if encoding == DELTA_ZLIB:
+            return decode_chunk(payload, count)
+        return np.frombuffer(payload, dtype=REV_DTYPE)
+
+    def read_chunk(self, i):
+        """The revolutions of chunk i as a REV_DTYPE array. Raises ValueError if it fails its checksum."""
+        return self._decode(self._read_payload(i))
+
+    def read_chunks(self, indices):
+        """The revolutions of several chunks, decompressed in parallel, as one array."""
+        payloads = [self._read_payload(i) for i in indices] # file reads stay on this thread
+        if len(payloads) > 1 and self.workers > 1:
+            pool = ThreadPool(min(self.workers, len(payloads))) # zlib releases the GIL
+            try:
+                chunks = pool.map(self._decode, payloads)
+            finally:
+                pool.close()
+        else:
+            chunks = [self._decode(p) for p in payloads]
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=REV_DTYPE)
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            for rec in self.read_chunk(i):
+                yield rec
+
+    def find(self, t):
+        """(chunk, position in chunk) of the first revolution ending at or after time t, or None."""
+        i = int(np.searchsorted(self.last_times, t))
+        if i == len(self.last_times):
+            return None
+        chunk = self.read_chunk(i)
+        return i, int(np.searchsorted(chunk['end_time'], t))
+
+    def revolution_at(self, t):
+        """The revolution in progress (or the next one to start) at time t, or None after the end."""
+        found = self.find(t)
+        if found is None:
+            return None
+        i, j = found
+        return self.read_chunk(i)[j]
+
+    def between(self, t0, t1):
+        """Every revolution that started at or after t0 and before t1."""
+        i = int(np.searchsorted(self.last_times, t0))
+        j = int(np.searchsorted(self.first_times, t1))
+        records = self.read_chunks(range(i, j))
+        return records[(records['start_time'] >= t0) & (records['start_time'] < t1)]
+
+    def close(self):
+        self.f.close()
+
+class RecordingSet(object):
+    """All the files of one recording (as rotated by RevolutionRecorder), read as one."""
+    def __init__(self, prefix, workers=4):
+        self.readers = [RecordingReader(fn, workers) for fn in sorted(glob.glob(prefix + '_*.xvrev'))]
+        self.readers = [r for r in self.readers if len(r)]
+        self.readers.sort(key=lambda r: r.start_time)
+        self.end_times = np.array([r.end_time for r in self.readers])
+
+    def __len__(self):
+        return sum(len(r) for r in self.readers)
+
+    def __iter__(self):
+        for reader in self.readers:
+            for rec in reader:
+                yield rec
+
+    def revolution_at(self, t):
+        i = int(np.searchsorted(self.end_times, t))
+        return self.readers[i].revolution_at(t) if i < len(self.readers) else None
+
+    def between(self, t0, t1):
+        parts = [r.between(t0, t1) for r in self.readers if r.end_time >= t0 and r.start_time < t1]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=REV_DTYPE)
+
+def to_points(records, poses=None):
+    """Points of recorded revolutions, in order, as a compact PointBuffer tagged with each revolution's pose id.
+
+poses -- the recording's pose table. Revolutions whose pose id has yaw and pitch angles in it
+are turned into 3D with the rotation module's projection table, as lidar3Dstore does; the
+rest are left flat.
+"""
+    import rotation as rot
+    poses = [p for p in poses or [] if 'yaw' in p]
+    known = set(p['id'] for p in poses)
+    flat = [{'id': int(i), 'yaw': 0.0, 'pitch': 0.0} for i in np.unique(records['pose']) if int(i) not in known]
+    table = rot.ProjectionTable(poses + flat)
+    revolution, angle = np.nonzero(records['flags'] & FLAG_VALID)
+    pose = records['pose'][revolution]
+    xyz = table.project_samples(pose, angle, records['dist_mm'][revolution, angle])
+    rotated = np.isin(pose, list(known))
+    xyz[rotated, 2] = -xyz[rotated, 2] # rotation's z is positive down
+    points = PointBuffer(360 * len(records))
+    points.write(angle + 360 * revolution, xyz, records['quality'][revolution, angle],
+                 records['flags'][revolution, angle] & FLAG_WARNING, pose)
+    return points.compact()
+
+def main():
+    from lidar_format import save_points
+    parser = argparse.ArgumentParser(description='Inspect or extract from continuous revolution recordings')
+    commands = parser.add_subparsers(dest='command')
+    info = commands.add_parser('info', help='summarise a recording')
+    info.add_argument('file')
+    extract = commands.add_parser('extract', help='save the revolutions between two times as points')
+    extract.add_argument('file')
+    extract.add_argument('start', type=float, help='seconds from the start of the recording')
+    extract.add_argument('end', type=float)
+    extract.add_argument('output', help='.xvpc or .csv file')
+    args = parser.parse_args()
+    if args.command == 'info':
+        reader = RecordingReader(args.file)
+        duration = reader.end_time - reader.start_time if len(reader) else 0.0
+        print('%d revolutions in %d chunks, %.1f s from %s, %d bytes per revolution' % (
+              len(reader), len(reader.offsets), duration, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reader.start_time or 0)),
+              os.path.getsize(args.file) // max(len(reader), 1)))
+    elif args.command == 'extract':
+        reader = RecordingReader(args.file)
+        records = reader.between(reader.start_time + args.start, reader.start_time + args.end)
+        save_points(args.output, to_points(records, reader.poses),
+                    capture_time=float(records['start_time'][0]) if len(records) else None, rpm=records['rpm'].tolist())
+        print('Saved %d revolutions to %s' % (len(records), args.output))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+#Record, replay and synthesize raw XV-11 controller streams
+#Lets lidar2store, lidar3Dstore and the benchmarks run without the lidar attached
+#requires numpy, pandas and pyserial (for recording only)
+#
+#Usage:
+#   python lidar_replay.py record COM3 capture.xvraw --seconds 60
+#   python lidar_replay.py synth 2D_kitchen_test.csv synthetic.xvraw --revolutions 300 --rpm 300
+
+import time, struct, argparse
+import numpy as np
+import pandas as pd
+from lidar_packets import PACKET_SIZE, PACKETS_PER_REV, INDEX_MIN, START_BYTE, checksums
+from point_buffer import PointBuffer
+
+# File layout: MAGIC, then one record per chunk read from the port:
+#   float64 seconds since the recording started, uint32 length, the bytes themselves
+MAGIC = b'XVRAW\x01'
+RECORD_HEADER = struct.Struct('<dI')
+
+class RecordingSerial(object):
+    """Wraps an open serial port and writes every chunk read from it to a recording file.
+
+Anything other than read() is passed straight through to the port.
+"""
+    def __init__(self, ser, fn):
+        self.ser = ser
+        self.f = open(fn, 'wb')
+        self.f.write(MAGIC)
+        self.start = time.time()
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self.f.write(RECORD_HEADER.pack(time.time() - self.start, len(data)))
+            self.f.write(data)
+        return data
+
+    def close(self):
+        self.f.close()
+        self.ser.close()
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+def record(port, fn, seconds, baudrate=115200):
+    """Capture the raw controller stream on port to fn for the given number of seconds."""
+    import serial
+    ser = RecordingSerial(serial.Serial(port, baudrate, timeout=0.1), fn)
+    end = time.time() + seconds
+    total = 0
+    while time.time() < end:
+        waiting = ser.in_waiting if hasattr(ser.ser, 'in_waiting') else ser.inWaiting()
+        total += len(ser.read(max(PACKET_SIZE, waiting)))
+    ser.close()
+    return total
+
+def save_recording(fn, data, ends, times):
+    """Write a stream held in memory (see load_recording) to fn."""
+    with open(fn, 'wb') as f:
+        f.write(MAGIC)
+        begin = 0
+        for end, t in zip(ends, times):
+            f.write(RECORD_HEADER.pack(t, end - begin))
+            f.write(bytes(data[begin:end]))
+            begin = end
+
+def load_recording(fn):
+    """Read a recording file.
+
+Returns (data, ends, times): all the bytes as one bytearray, the end offset of each
+chunk in data, and the time in seconds at which each chunk arrived.
+"""
+    with open(fn, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(fn + ' is not a raw lidar recording')
+        data = bytearray()
+        ends = []
+        times = []
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            t, length = RECORD_HEADER.unpack(header)
+            data += f.read(length)
+            ends.append(len(data))
+            times.append(t)
+    return data, np.array(ends, dtype=np.int64), np.array(times)
+
+class ReplaySerial(object):
+    """A serial-like object that plays back a recorded or synthesized stream.
+
+source -- a recording file name, or a (data, ends, times) tuple as returned by
+          load_recording or synthesize_stream.
+speed -- 1.0 plays back in real time, 10.0 ten times faster, 0 as fast as possible.
+loop -- start again from the beginning when the stream runs out; otherwise read()
+        returns whatever is left, then empty strings, like a port that timed out.
+"""
+    def __init__(self, source, speed=1.0, loop=False):
+        if not isinstance(source, tuple):
+            source = load_recording(source)
+        self.data, self.ends, self.times = source
+        self.speed = speed
+        self.loop = loop
+        self.pos = 0
+        self.start = None
+        self.is_open = True
+
+    def _available(self):
+        if self.start is None:
+            self.start = time.time()
+        if self.speed <= 0:
+            return len(self.data)
+        elapsed = (time.time() - self.start) * self.speed
+        arrived = np.searchsorted(self.times, elapsed, side='right')
+        return int(self.ends[arrived - 1]) if arrived else 0
+
+    @property
+    def in_waiting(self):
+        return self._available() - self.pos
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        while True:
+            available = self._available()
+            if available - self.pos >= size or available == len(self.data):
+                break
+            # sleep until the next chunk is due
+            arrived = np.searchsorted(self.ends, available, side='right')
+            due = self.start + self.times[arrived] / self.speed
+            time.sleep(max(0.0, min(due - time.time(), 0.1)))
+        end = min(self.pos + size, available)
+        chunk = bytes(self.data[self.pos:end])
+        self.pos = end
+        if self.pos == len(self.data) and self.loop:
+            self.pos = 0
+            self.start = None
+        return chunk
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+def load_csv_revolutions(fn):
+    """Turn a stored 2D scan CSV back into raw samples.
+
+The distances are the lengths of the stored x, y, z positions, which only holds for 2D files:
+3D files are rotated and offset to each pose, with calibrations the file doesn't record, so
+they are rejected with a ValueError. Returns arrays of shape (1, 360): dist_mm, quality,
+warning and invalid, where angles without a stored point are invalid samples.
+"""
+    points = PointBuffer.from_dataframe(pd.read_csv(fn, index_col=0)).expand()
+    if len(points.xyz) > 360:
+        raise ValueError('%s holds %d poses; only 2D scans can be turned back into samples'
+                         % (fn, len(points.xyz) // 360))
+    dist_mm = np.sqrt((points.xyz.astype(float) ** 2).sum(axis=1)).round()
+    shape = (-1, 360)
+    return (dist_mm.reshape(shape), points.intensity.reshape(shape), points.warning.reshape(shape),
+            ~points.valid.reshape(shape))
+
+def synthesize_packets(dist_mm, quality, warning, invalid, revolutions, rpm=300.0,
+                       noise_mm=0.0, rpm_noise=0.0, seed=None):
+    """Build an (N, 22) uint8 array of valid packets from sample profiles.
+
+The (R, 360) profiles from load_csv_revolutions are cycled through to make the given
+number of revolutions, with gaussian noise of noise_mm on distances and rpm_noise on speed.
+"""
+    rng = np.random.RandomState(seed)
+    profile = np.arange(revolutions) % len(dist_mm)
+    dist = dist_mm[profile].astype(float)
+    if noise_mm:
+        dist += rng.normal(0, noise_mm, dist.shape)
+    dist = np.clip(dist.round(), 0, 0x3fff).astype(np.uint16)
+    dist[invalid[profile]] = 0
+    qual = np.clip(quality[profile], 0, 0xffff).astype(np.uint16)
+    n = revolutions * PACKETS_PER_REV
+    packets = np.zeros((n, PACKET_SIZE), dtype=np.uint8)
+    packets[:, 0] = START_BYTE
+    packets[:, 1] = INDEX_MIN + np.arange(n) % PACKETS_PER_REV
+    speed = rpm + (rng.normal(0, rpm_noise, n) if rpm_noise else np.zeros(n))
+    speed = np.clip((speed * 64).round(), 0, 0xffff).astype(np.uint16)
+    packets[:, 2] = speed & 0xff
+    packets[:, 3] = speed >> 8
+    samples = packets[:, 4:20].reshape(n, 4, 4)
+    dist = dist.reshape(n, 4)
+    qual = qual.reshape(n, 4)
+    samples[:, :, 0] = dist & 0xff
+    samples[:, :, 1] = (dist >> 8) | (invalid[profile].reshape(n, 4) * 0x80) | (warning[profile].reshape(n, 4) * 0x40)
+    samples[:, :, 2] = qual & 0xff
+    samples[:, :, 3] = qual >> 8
+    chk = checksums(packets)
+    packets[:, 20] = chk & 0xff
+    packets[:, 21] = chk >> 8
+    return packets
+
+def synthesize_stream(packets, rpm=300.0, corrupt_rate=0.0, drop_rate=0.0, seed=None):
+    """Turn packets into a (data, ends, times) stream that ReplaySerial can play back.
+
+corrupt_rate -- fraction of packets with one data byte flipped, so their checksum fails.
+drop_rate -- fraction of bytes lost from the stream.
+Each packet is one chunk, timed as if the lidar were turning at rpm.
+"""
+    rng = np.random.RandomState(seed)
+    packets = packets.copy()
+    n = len(packets)
+    if corrupt_rate:
+        hit = np.flatnonzero(rng.random_sample(n) < corrupt_rate)
+        cols = rng.randint(4, 20, len(hit))
+        packets[hit, cols] ^= rng.randint(1, 256, len(hit)).astype(np.uint8)
+    keep = np.ones(packets.shape, dtype=np.bool_)
+    if drop_rate:
+        keep = rng.random_sample(packets.shape) >= drop_rate
+    data = bytearray(packets[keep].tobytes())
+    ends = np.cumsum(keep.sum(axis=1))
+    times = np.arange(1, n + 1) * (60.0 / rpm / PACKETS_PER_REV)
+    return data, ends, times
+
+def synthesize_from_csv(fn, revolutions, rpm=300.0, noise_mm=0.0, rpm_noise=0.0,
+                        corrupt_rate=0.0, drop_rate=0.0, seed=None):
+    """A (data, ends, times) stream built from a stored scan CSV such as 2D_kitchen_test.csv."""
+    profiles = load_csv_revolutions(fn)
+    packets = synthesize_packets(*profiles, revolutions=revolutions, rpm=rpm, noise_mm=noise_mm,
+                                 rpm_noise=rpm_noise, seed=seed)
+    return synthesize_stream(packets, rpm=rpm, corrupt_rate=corrupt_rate, drop_rate=drop_rate, seed=seed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Record or synthesize raw XV-11 lidar streams')
+    commands = parser.add_subparsers(dest='command')
+    rec = commands.add_parser('record', help='capture the controller stream from a serial port')
+    rec.add_argument('port')
+    rec.add_argument('output')
+    rec.add_argument('--seconds', type=float, default=60)
+    rec.add_argument('--baudrate', type=int, default=115200)
+    syn = commands.add_parser('synth', help='build a stream from a stored scan CSV')
+    syn.add_argument('csv')
+    syn.add_argument('output')
+    syn.add_argument('--revolutions', type=int, default=100)
+    syn.add_argument('--rpm', type=float, default=300.0)
+    syn.add_argument('--noise', type=float, default=0.0, help='distance noise, mm')
+    syn.add_argument('--rpm-noise', type=float, default=0.0)
+    syn.add_argument('--corrupt', type=float, default=0.0, help='fraction of packets with a bad checksum')
+    syn.add_argument('--drop', type=float, default=0.0, help='fraction of bytes lost')
+    syn.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    if args.command == 'record':
+        total = record(args.port, args.output, args.seconds, args.baudrate)
+        print('Recorded %d bytes to %s' % (total, args.output))
+    elif args.command == 'synth':
+        stream = synthesize_from_csv(args.csv, args.revolutions, args.rpm, args.noise, args.rpm_noise,
+                                     args.corrupt, args.drop, args.seed)
+        save_recording(args.output, *stream)
+        print('Wrote %d bytes to %s' % (len(stream[0]), args.output))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#Assembles XV-11 packets into complete 360 degree revolutions
+#requires numpy
+
+import time
+from threading import Lock
+import numpy as np
+from lidar_packets import PACKETS_PER_REV, INDEX_MIN, decode_packets
+
+class Scan(object):
+    """One revolution of the lidar, held in preallocated arrays.
+
+Sample arrays have 360 entries indexed by angle, packet arrays have 90 entries indexed
+by packet index (angle // 4). Samples from packets that never arrived, or arrived with
+a bad checksum, are marked invalid.
+"""
+    def __init__(self):
+        self.dist_mm = np.zeros(360, dtype=np.uint16)
+        self.quality = np.zeros(360, dtype=np.uint16)
+        self.invalid = np.ones(360, dtype=np.bool_)
+        self.warning = np.zeros(360, dtype=np.bool_)
+        self.rpm = np.zeros(PACKETS_PER_REV, dtype=np.float32)
+        self.timestamps = np.zeros(PACKETS_PER_REV, dtype=np.float64)
+        self.received = np.zeros(PACKETS_PER_REV, dtype=np.uint8) # good packets seen per index
+        self.sequence = 0 # revolution number since the assembler started
+        self.bad_packets = 0 # packets dropped for a bad checksum
+        self.duplicates = 0 # packets whose index had already been filled this revolution
+        self.pose = None # whatever the caller tags the revolution with, e.g. the servo angles
+
+    def clear(self):
+        self.invalid[:] = True
+        self.warning[:] = False
+        self.dist_mm[:] = 0
+        self.quality[:] = 0
+        self.rpm[:] = 0
+        self.timestamps[:] = 0
+        self.received[:] = 0
+        self.bad_packets = 0
+        self.duplicates = 0
+
+    def copy(self):
+        scan = Scan()
+        for name in ('dist_mm', 'quality', 'invalid', 'warning', 'rpm', 'timestamps', 'received'):
+            getattr(scan, name)[:] = getattr(self, name)
+        scan.sequence = self.sequence
+        scan.bad_packets = self.bad_packets
+        scan.duplicates = self.duplicates
+        scan.pose = self.pose
+        return scan
+
+    @property
+    def missing(self):
+        """Number of packet indices with no good packet this revolution."""
+        return int(np.count_nonzero(self.received == 0))
+
+    @property
+    def valid(self):
+        """Boolean mask of the samples that carry a usable distance."""
+        return ~self.invalid
+
+    @property
+    def start_time(self):
+        seen = self.timestamps[self.received > 0]
+        return float(seen.min()) if len(seen) else 0.0
+
+    @property
+    def end_time(self):
+        return float(self.timestamps.max())
+
+    @property
+    def mean_rpm(self):
+        seen = self.rpm[self.received > 0]
+        return float(seen.mean()) if len(seen) else 0.0
+
+    def sample_times(self):
+        """Estimated time of each of the 360 samples.
+
+Packets are timestamped when the batch holding them was read, which may be a little after
+they arrived. The lidar sends them evenly spaced at its measured RPM, so they are put on
+that spacing, anchored at the packet that was read soonest after it arrived.
+"""
+        rpm = self.mean_rpm
+        spacing = 60.0 / (rpm if rpm else 300.0) / PACKETS_PER_REV
+        seen = np.flatnonzero(self.received)
+        if not len(seen):
+            return np.zeros(360)
+        start = float((self.timestamps[seen] - seen * spacing).min())
+        return np.repeat(start + np.arange(PACKETS_PER_REV) * spacing, 4)
+
+class RevolutionAssembler(object):
+    """Collects packets into Scans and publishes each one when the packet index wraps.
+
+Two Scans are used in turn: packets are written into the back buffer while the last
+complete revolution stays readable in the front one. Subscribers are called from the
+writer's thread with the front Scan, which stays untouched until the next revolution
+completes, so a subscriber that keeps it longer (or hands it to another thread) should
+take a copy().
+"""
+    def __init__(self):
+        self.subscribers = []
+        self.front = Scan()
+        self.back = Scan()
+        self.lock = Lock()
+        self.last_index = -1
+        self.revolutions = 0
+
+    def subscribe(self, callback):
+        """Call callback(scan) for every completed revolution."""
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def latest(self):
+        """A copy of the last completed revolution, or None before the first one."""
+        with self.lock:
+            return self.front.copy() if self.revolutions else None
+
+    def add_packets(self, data, valid=None, timestamp=None):
+        """Add a batch of framed packets.
+
+data -- (N, 22) uint8 array of packets, in the order they arrived.
+valid -- optional boolean mask of packets that passed the checksum (all, if omitted).
+timestamp -- arrival time of the batch, time.time() if omitted.
+"""
+        if len(data) == 0:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        if valid is None:
+            valid = np.ones(len(data), dtype=np.bool_)
+        indices = data[:, 1].astype(np.int16) - INDEX_MIN
+        # a revolution ends wherever the index goes backwards. Only good packets count,
+        # as the index byte of a packet with a bad checksum can't be trusted
+        good = np.flatnonzero(valid)
+        if len(good) == 0:
+            self.back.bad_packets += len(data)
+            return
+        steps = np.diff(np.concatenate(([self.last_index], indices[good])))
+        cuts = list(good[steps < 0]) + [len(data)]
+        begin = 0
+        for cut in cuts:
+            if cut > begin:
+                self._fill(data[begin:cut], indices[begin:cut], valid[begin:cut], timestamp)
+            if cut < len(data):
+                self._publish()
+            begin = cut
+        self.last_index = int(indices[good[-1]])
+
+    def _fill(self, data, indices, valid, timestamp):
+        scan = self.back
+        scan.bad_packets += int(np.count_nonzero(~valid))
+        data = data[valid]
+        indices = indices[valid]
+        if len(indices) == 0:
+            return
+        scan.duplicates += int(np.count_nonzero(scan.received[indices])) + len(indices) - len(np.unique(indices))
+        samples = decode_packets(data)
+        angles = samples['angle'].ravel()
+        scan.dist_mm[angles] = samples['dist_mm'].ravel()
+        scan.quality[angles] = samples['quality'].ravel()
+        scan.invalid[angles] = samples['invalid'].ravel()
+        scan.warning[angles] = samples['warning'].ravel()
+        scan.rpm[indices] = samples['rpm'][:, 0]
+        scan.timestamps[indices] = timestamp
+        np.add.at(scan.received, indices, 1) # counts an index repeated within the batch each time
+
+    def _publish(self):
+        with self.lock:
+            self.front, self.back = self.back, self.front
+            self.front.sequence = self.revolutions
+            self.revolutions += 1
+        self.back.clear()
+        for callback in list(self.subscribers):
+            callback(self.front)
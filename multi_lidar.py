@@ -0,0 +1,216 @@
+#Acquire from several XV-11 lidars at once, one worker process per sensor
+#Each worker does its own framing, checksums and revolution assembly, and hands complete
+#revolutions to the coordinator through shared memory, so throughput scales with cores
+#requires numpy, pandas and pyserial
+#
+#Usage:
+#   python multi_lidar.py sensors.json --seconds 60 --output merged.csv
+#
+#sensors.json lists each sensor's port (or a replay file from lidar_replay.py) and how it is
+#mounted on the rig, offsets in mm and angles in degrees:
+#   {"sensors": [
+#       {"id": 0, "port": "COM3", "mount": {"x": 0, "y": 0, "z": 300, "yaw": 0, "pitch": 0, "roll": 0}},
+#       {"id": 1, "port": "COM6", "mount": {"x": 0, "y": 0, "z": 600, "yaw": 90, "pitch": -20, "roll": 0}},
+#       {"id": 2, "replay": "capture.xvraw", "mount": {}}
+#   ]}
+
+import sys, time, math, json, ctypes, argparse, traceback
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from lidar_packets import PacketFramer, packets_to_array, verify_checksums
+from lidar_scan import RevolutionAssembler
+
+try:
+    from Queue import Empty # Python 2
+except ImportError:
+    from queue import Empty
+
+# One revolution as laid out in shared memory. sequence is -1 while a slot is being written.
+REV_DTYPE = np.dtype([('sequence', np.int64), ('dist_mm', np.uint16, 360), ('quality', np.uint16, 360),
+                      ('invalid', np.bool_, 360), ('warning', np.bool_, 360), ('rpm', np.float32),
+                      ('start_time', np.float64), ('end_time', np.float64), ('missing', np.uint16),
+                      ('bad_packets', np.uint16)])
+
+# A merged point, tagged with the sensor it came from
+POINT_DTYPE = np.dtype([('x', np.float32), ('y', np.float32), ('z', np.float32), ('intensity', np.uint16),
+                        ('quality_warning', np.uint8), ('sensor', np.uint8)])
+
+def mount_transform(mount):
+    """The 3x3 rotation and offset vector for a sensor mounting (yaw about z, then pitch about y, then roll about x)."""
+    yaw, pitch, roll = [math.radians(mount.get(k, 0.0)) for k in ('yaw', 'pitch', 'roll')]
+    cy, sy = math.cos(yaw), math.sin(yaw)
+    cp, sp = math.cos(pitch), math.sin(pitch)
+    cr, sr = math.cos(roll), math.sin(roll)
+    yaw_m = np.array(((cy, -sy, 0), (sy, cy, 0), (0, 0, 1)))
+    pitch_m = np.array(((cp, 0, sp), (0, 1, 0), (-sp, 0, cp)))
+    roll_m = np.array(((1, 0, 0), (0, cr, -sr), (0, sr, cr)))
+    offset = np.array([mount.get(k, 0.0) for k in ('x', 'y', 'z')], dtype=float)
+    return yaw_m.dot(pitch_m).dot(roll_m), offset
+
+def open_port(sensor):
+    if sensor.get('replay'):
+        from lidar_replay import ReplaySerial
+        return ReplaySerial(sensor['replay'], speed=sensor.get('speed', 1.0), loop=True)
+    import serial
+    return serial.Serial(sensor['port'], sensor.get('baudrate', 115200))
+
+def sensor_worker(sensor, raw, notify, stop):
+    """Runs in its own process: read one sensor and publish its revolutions to a shared ring of slots."""
+    ring = np.frombuffer(raw, dtype=REV_DTYPE)
+    ring['sequence'] = -1
+    ser = open_port(sensor)
+    framer = PacketFramer(ser)
+    assembler = RevolutionAssembler()
+
+    def publish(scan):
+        slot = ring[scan.sequence % len(ring)]
+        slot['sequence'] = -1
+        slot['dist_mm'] = scan.dist_mm
+        slot['quality'] = scan.quality
+        slot['invalid'] = scan.invalid
+        slot['warning'] = scan.warning
+        slot['rpm'] = scan.mean_rpm
+        slot['start_time'] = scan.start_time
+        slot['end_time'] = scan.end_time
+        slot['missing'] = scan.missing
+        slot['bad_packets'] = min(scan.bad_packets, 0xffff)
+        slot['sequence'] = scan.sequence
+        notify.put((sensor['id'], scan.sequence))
+    assembler.subscribe(publish)
+
+    while not stop.is_set():
+        try:
+            packets = framer.read_packets()
+            if packets:
+                data = packets_to_array(packets)
+                assembler.add_packets(data, verify_checksums(data))
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+    ser.close()
+
+class MultiLidar(object):
+    """Starts a worker process per sensor and merges their revolutions.
+
+sensors -- list of sensor dicts as in the sensors.json example above.
+slots -- revolutions each sensor's shared ring holds; a revolution is lost if the
+         coordinator falls that many revolutions behind.
+"""
+    def __init__(self, sensors, slots=8):
+        self.sensors = dict((s['id'], s) for s in sensors)
+        self.slots = slots
+        self.notify = mp.Queue()
+        self.stop_event = mp.Event()
+        self.rings = {}
+        self.processes = []
+        self.transforms = dict((s['id'], mount_transform(s.get('mount', {}))) for s in sensors)
+        self.latest = {} # sensor id -> points of its last revolution
+        self.revolutions = dict((s['id'], 0) for s in sensors)
+        self.overrun = dict((s['id'], 0) for s in sensors) # revolutions overwritten before they were read
+        angle_rad = np.radians(np.arange(360))
+        self.unit = np.column_stack((np.cos(angle_rad), -np.sin(angle_rad), np.zeros(360)))
+
+    def start(self):
+        for sensor_id, sensor in self.sensors.items():
+            raw = mp.RawArray(ctypes.c_ubyte, REV_DTYPE.itemsize * self.slots)
+            self.rings[sensor_id] = np.frombuffer(raw, dtype=REV_DTYPE)
+            p = mp.Process(target=sensor_worker, args=(sensor, raw, self.notify, self.stop_event),
+                           name='lidar %s' % sensor_id)
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+
+    def stop(self):
+        self.stop_event.set()
+        for p in self.processes:
+            p.join(2.0)
+            if p.is_alive():
+                p.terminate()
+
+    def read_revolution(self, sensor_id, sequence):
+        """Copy a revolution out of shared memory, or None if the worker has already reused its slot."""
+        slot = self.rings[sensor_id][sequence % self.slots]
+        if slot['sequence'] != sequence:
+            return None
+        rev = slot.copy()
+        if slot['sequence'] != sequence: # overwritten while we copied
+            return None
+        return rev
+
+    def to_points(self, sensor_id, rev):
+        """Project a revolution's good samples into the rig frame."""
+        valid = ~rev['invalid']
+        rotation, offset = self.transforms[sensor_id]
+        xyz = (self.unit[valid] * rev['dist_mm'][valid][:, None]).dot(rotation.T) + offset
+        points = np.empty(len(xyz), dtype=POINT_DTYPE)
+        points['x'] = xyz[:, 0]
+        points['y'] = xyz[:, 1]
+        points['z'] = xyz[:, 2]
+        points['intensity'] = rev['quality'][valid]
+        points['quality_warning'] = rev['warning'][valid]
+        points['sensor'] = sensor_id
+        return points
+
+    def poll(self, timeout=0.1):
+        """Collect every revolution published since the last call.
+
+Returns a list of (sensor id, revolution, points) and updates latest.
+"""
+        received = []
+        while True:
+            try:
+                sensor_id, sequence = self.notify.get(timeout=timeout if not received else 0)
+            except Empty:
+                break
+            rev = self.read_revolution(sensor_id, sequence)
+            if rev is None:
+                self.overrun[sensor_id] += 1
+                continue
+            points = self.to_points(sensor_id, rev)
+            self.latest[sensor_id] = points
+            self.revolutions[sensor_id] += 1
+            received.append((sensor_id, rev, points))
+        return received
+
+    def merged(self):
+        """One cloud holding the last revolution of every sensor."""
+        if not self.latest:
+            return np.empty(0, dtype=POINT_DTYPE)
+        return np.concatenate(list(self.latest.values()))
+
+def append_csv(fn, points, revolution, header):
+    df = pd.DataFrame({'x_pos': points['x'], 'y_pos': points['y'], 'z_pos': points['z'],
+                       'intensity': points['intensity'], 'quality_warning': points['quality_warning'],
+                       'sensor': points['sensor'], 'revolution': revolution},
+                      columns=['x_pos', 'y_pos', 'z_pos', 'intensity', 'quality_warning', 'sensor', 'revolution'])
+    df.to_csv(fn, mode='w' if header else 'a', header=header, index=False)
+
+def main():
+    parser = argparse.ArgumentParser(description='Acquire from several lidars, one process per sensor')
+    parser.add_argument('config', help='JSON file listing the sensors')
+    parser.add_argument('--seconds', type=float, default=None, help='stop after this long (default: until Ctrl-C)')
+    parser.add_argument('--output', help='append every revolution of every sensor to this CSV file')
+    args = parser.parse_args()
+    with open(args.config) as f:
+        sensors = json.load(f)['sensors']
+
+    rig = MultiLidar(sensors)
+    rig.start()
+    end = None if args.seconds is None else time.time() + args.seconds
+    first = True
+    last_report = time.time()
+    try:
+        while end is None or time.time() < end:
+            for sensor_id, rev, points in rig.poll():
+                if args.output:
+                    append_csv(args.output, points, int(rev['sequence']), first)
+                    first = False
+            if time.time() - last_report > 5:
+                last_report = time.time()
+                print('revolutions %s  overruns %s  merged points %d' % (rig.revolutions, rig.overrun, len(rig.merged())))
+    except KeyboardInterrupt:
+        pass
+    rig.stop()
+
+if __name__ == '__main__':
+    main()
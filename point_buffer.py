@@ -0,0 +1,223 @@
+#Preallocated point storage for lidar scans
+#Points are written by row into typed numpy arrays during acquisition; pandas is only
+#used when the buffer is exported. SampleBuffer holds raw samples instead, to be
+#converted to points when they are read
+#requires numpy and pandas
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['x_pos', 'y_pos', 'z_pos', 'intensity', 'quality_warning', 'pose', 'angle']
+DENSE_COLUMNS = COLUMNS[:5] # the original layout: one row per angle and pose, empty rows for missing points
+
+# bits in PointBuffer.flags
+FLAG_VALID = 0x01 # the row holds a point
+FLAG_WARNING = 0x02 # the lidar flagged the sample's strength as lower than expected for its range
+
+class PointBuffer(object):
+    """A fixed number of point rows, e.g. 360 per scan location.
+
+xyz -- (size, 3) float32 positions in mm
+intensity -- uint16 sample quality
+flags -- uint8, FLAG_VALID and FLAG_WARNING
+pose -- uint16 scan location (pose id) each point was taken at
+angle -- uint16 lidar angle of each point, in degrees
+
+During acquisition row angle + 360*pose holds the sample at that angle and pose. compact()
+keeps only the rows holding a point, which is how scans are stored; expand() goes back.
+"""
+    def __init__(self, size):
+        self.xyz = np.zeros((size, 3), dtype=np.float32)
+        self.intensity = np.zeros(size, dtype=np.uint16)
+        self.flags = np.zeros(size, dtype=np.uint8)
+        self.pose = np.zeros(size, dtype=np.uint16)
+        self.angle = (np.arange(size) % 360).astype(np.uint16)
+
+    @classmethod
+    def from_arrays(cls, xyz, intensity, flags, pose, angle):
+        """A buffer over existing arrays (e.g. memory-mapped file columns), without copying them."""
+        points = cls(0)
+        points.xyz, points.intensity, points.flags, points.pose, points.angle = xyz, intensity, flags, pose, angle
+        return points
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """The points of a stored CSV scan, in either layout, as a compact buffer."""
+        if 'angle' in df:
+            rows = np.arange(len(df))
+            pose = df['pose'].values
+            angle = df['angle'].values
+        else:
+            # dense layout: the index is angle + 360*pose and missing points are empty rows
+            rows = np.flatnonzero(df['x_pos'].notnull().values)
+            pose = df.index.values[rows] // 360
+            angle = df.index.values[rows] % 360
+        warning = df['quality_warning'].values[rows] != 0
+        return cls.from_arrays(df[['x_pos', 'y_pos', 'z_pos']].values[rows].astype(np.float32),
+                               df['intensity'].values[rows].astype(np.uint16),
+                               (FLAG_VALID | warning * FLAG_WARNING).astype(np.uint8),
+                               pose.astype(np.uint16), angle.astype(np.uint16))
+
+    @classmethod
+    def concatenate(cls, parts):
+        """One buffer holding the rows of several, in order."""
+        if not parts:
+            return cls(0)
+        return cls.from_arrays(*[np.concatenate([getattr(p, name) for p in parts])
+                                 for name in ('xyz', 'intensity', 'flags', 'pose', 'angle')])
+
+    def __len__(self):
+        return len(self.flags)
+
+    def write(self, rows, xyz, intensity, warning, pose=0):
+        """Store points at the given rows (an index array), marking them valid."""
+        self.xyz[rows] = xyz
+        self.intensity[rows] = intensity
+        self.flags[rows] = FLAG_VALID | (np.asarray(warning, dtype=np.uint8) * FLAG_WARNING)
+        self.pose[rows] = pose
+
+    def clear(self, rows=slice(None)):
+        self.flags[rows] = 0
+
+    @property
+    def valid(self):
+        return (self.flags & FLAG_VALID) != 0
+
+    @property
+    def warning(self):
+        return (self.flags & FLAG_WARNING) != 0
+
+    def compact(self):
+        """A new buffer holding only the rows with a point."""
+        rows = np.flatnonzero(self.valid)
+        return PointBuffer.from_arrays(self.xyz[rows], self.intensity[rows], self.flags[rows],
+                                       self.pose[rows], self.angle[rows])
+
+    def expand(self, poses=None):
+        """A new buffer in the acquisition layout, 360 rows per pose, with the points at their (pose, angle) rows."""
+        if poses is None:
+            poses = int(self.pose.max()) + 1 if len(self) else 0
+        dense = PointBuffer(360 * poses)
+        valid = self.valid
+        rows = self.pose[valid].astype(np.int64) * 360 + self.angle[valid]
+        dense.xyz[rows] = self.xyz[valid]
+        dense.intensity[rows] = self.intensity[valid]
+        dense.flags[rows] = self.flags[valid]
+        dense.pose[rows] = self.pose[valid]
+        return dense
+
+    def validity(self, poses=None):
+        """(poses, 360) bool array, True where a pose has a point at that angle."""
+        if poses is None:
+            poses = int(self.pose.max()) + 1 if len(self) else 0
+        bits = np.zeros((poses, 360), dtype=np.bool_)
+        valid = self.valid
+        bits[self.pose[valid], self.angle[valid]] = True
+        return bits
+
+    def to_dataframe(self, dense=False):
+        """The buffer as a DataFrame with one row per point.
+
+With dense=True, the original layout is produced instead: one row per buffer row, rows
+without a point left empty and no pose or angle columns.
+"""
+        valid = self.valid
+        if not dense:
+            return pd.DataFrame({'x_pos': self.xyz[valid, 0], 'y_pos': self.xyz[valid, 1], 'z_pos': self.xyz[valid, 2],
+                                 'intensity': self.intensity[valid], 'quality_warning': self.warning[valid].astype(np.uint8),
+                                 'pose': self.pose[valid], 'angle': self.angle[valid]}, columns=COLUMNS)
+        xyz = np.array(self.xyz)
+        xyz[~valid] = np.nan
+        intensity = self.intensity.astype(object) # object, so ints aren't written as floats beside the empty rows
+        intensity[~valid] = None
+        warning = self.warning.astype(int).astype(object)
+        warning[~valid] = None
+        return pd.DataFrame({'x_pos': xyz[:, 0], 'y_pos': xyz[:, 1], 'z_pos': xyz[:, 2],
+                             'intensity': intensity, 'quality_warning': warning}, columns=DENSE_COLUMNS)
+
+    def to_csv(self, fn, dense=False, progress=None, chunk_rows=20000):
+        """Write the buffer as CSV, calling progress(fraction done) after each chunk of rows if given."""
+        df = self.to_dataframe(dense)
+        for begin in range(0, max(len(df), 1), chunk_rows):
+            df.iloc[begin:begin + chunk_rows].to_csv(fn, mode='w' if begin == 0 else 'a', header=begin == 0)
+            if progress:
+                progress(min(begin + chunk_rows, len(df)) / float(max(len(df), 1)))
+
+class SampleBuffer(object):
+    """Raw lidar samples in the same row layout as PointBuffer, not yet converted to x, y, z.
+
+dist_mm -- uint16 measured distance in mm
+intensity, flags, pose, angle -- as in PointBuffer
+time -- float64 time the sample's packet was received, in seconds since the epoch
+
+Writing a sample is just a copy, so nothing is projected during acquisition. project()
+places the samples with a projection table for their poses (see rotation.ProjectionTable)
+whenever positions are wanted, so they can be placed again after recalibrating.
+"""
+    def __init__(self, size):
+        self.dist_mm = np.zeros(size, dtype=np.uint16)
+        self.intensity = np.zeros(size, dtype=np.uint16)
+        self.flags = np.zeros(size, dtype=np.uint8)
+        self.pose = np.zeros(size, dtype=np.uint16)
+        self.angle = (np.arange(size) % 360).astype(np.uint16)
+        self.time = np.zeros(size, dtype=np.float64)
+
+    @classmethod
+    def from_arrays(cls, dist_mm, intensity, flags, pose, angle, time):
+        """A buffer over existing arrays (e.g. memory-mapped file columns), without copying them."""
+        samples = cls(0)
+        samples.dist_mm, samples.intensity, samples.flags = dist_mm, intensity, flags
+        samples.pose, samples.angle, samples.time = pose, angle, time
+        return samples
+
+    def __len__(self):
+        return len(self.flags)
+
+    def write(self, rows, dist_mm, intensity, warning, pose=0, time=0.0):
+        """Store samples at the given rows (an index array), marking them valid."""
+        self.dist_mm[rows] = dist_mm
+        self.intensity[rows] = intensity
+        self.flags[rows] = FLAG_VALID | (np.asarray(warning, dtype=np.uint8) * FLAG_WARNING)
+        self.pose[rows] = pose
+        self.time[rows] = time
+
+    def clear(self, rows=slice(None)):
+        self.flags[rows] = 0
+
+    @property
+    def valid(self):
+        return (self.flags & FLAG_VALID) != 0
+
+    @property
+    def warning(self):
+        return (self.flags & FLAG_WARNING) != 0
+
+    def compact(self):
+        """A new buffer holding only the rows with a sample."""
+        rows = np.flatnonzero(self.valid)
+        return SampleBuffer.from_arrays(self.dist_mm[rows], self.intensity[rows], self.flags[rows],
+                                        self.pose[rows], self.angle[rows], self.time[rows])
+
+    def validity(self, poses=None):
+        """(poses, 360) bool array, True where a pose has a sample at that angle."""
+        if poses is None:
+            poses = int(self.pose.max()) + 1 if len(self) else 0
+        bits = np.zeros((poses, 360), dtype=np.bool_)
+        valid = self.valid
+        bits[self.pose[valid], self.angle[valid]] = True
+        return bits
+
+    def project_xyz(self, table, chunk_rows=100000):
+        """(size, 3) float32 positions of the samples, z positive up, worked out chunk_rows rows at a time."""
+        xyz = np.zeros((len(self), 3), dtype=np.float32)
+        for begin in range(0, len(self), chunk_rows):
+            end = begin + chunk_rows
+            chunk = table.project_samples(self.pose[begin:end], self.angle[begin:end], self.dist_mm[begin:end])
+            chunk[:, 2] = 0.0 - chunk[:, 2] # the table's z is positive down (0 - z, so flat scans don't get -0)
+            xyz[begin:end] = chunk
+        return xyz
+
+    def project(self, table, chunk_rows=100000):
+        """The samples as a PointBuffer, placed with table (see project_xyz)."""
+        return PointBuffer.from_arrays(self.project_xyz(table, chunk_rows), self.intensity, self.flags,
+                                       self.pose, self.angle)
@@ -5,29 +5,156 @@ Created on Sun Sep 06 22:17:54 2015
 @author: mike
 """
 
-import math
+import os, math, json, hashlib, collections
+from threading import Lock
 import numpy as np
 VERTICAL_OFFSET = 85
-    
-def rotation(x, y, z, psi, theta):
-    """ Converts from Vehicle-2 (yaw,pitch) reference frame to original frame
-    Input x, y, z in the rotated frame, along with psi and theta
-    returns the position in the original frame. Also handles the translation, since
-    lidar center is not at the center of the pitch rotation servo axis
-    Remember that Z is positive down.
+CACHE_SIZE = 256 # poses whose transforms are kept, most recently used first
+
+_cache = collections.OrderedDict() # (psi, theta, VERTICAL_OFFSET) -> (matrix, offset)
+_cache_lock = Lock()
+
+def pose_transform(psi, theta):
+    """ The 3x3 rotation matrix and offset vector for yaw psi and pitch theta, in degrees,
+    such that position in the original frame = matrix . position in the rotated frame + offset.
+    Composed once per pose and kept in a bounded LRU cache.
     """
-    pos = np.matrix((x, y, z)).T
+    key = (float(psi), float(theta), float(VERTICAL_OFFSET))
+    with _cache_lock:
+        found = _cache.pop(key, None)
+        if found is not None:
+            _cache[key] = found # now the most recently used
+            return found
     theta_rad = math.radians(theta)
     psi_rad = math.radians(psi)
     c_theta = math.cos(theta_rad)
     s_theta = math.sin(theta_rad)
     c_psi = math.cos(psi_rad)
     s_psi = math.sin(psi_rad)
-    Yaw = np.matrix(((c_psi, -s_psi, 0),(s_psi, c_psi, 0),(0, 0, 1)))
-    Pitch = np.matrix(((c_theta, 0, s_theta),(0, 1, 0),(-s_theta, 0, c_theta)))
-    new_pos = (Yaw*Pitch)*pos
-    new_x = float(new_pos[0]) - VERTICAL_OFFSET * math.sin(theta)
-    new_y = float(new_pos[1])
-    new_z = float(new_pos[2]) + VERTICAL_OFFSET * math.cos(theta) - VERTICAL_OFFSET
-    return new_x, new_y, new_z
-   
\ No newline at end of file
+    Yaw = np.array(((c_psi, -s_psi, 0),(s_psi, c_psi, 0),(0, 0, 1)))
+    Pitch = np.array(((c_theta, 0, s_theta),(0, 1, 0),(-s_theta, 0, c_theta)))
+    # the lidar center is VERTICAL_OFFSET above the pitch servo axis
+    offset = np.array((-VERTICAL_OFFSET * s_theta, 0, VERTICAL_OFFSET * c_theta - VERTICAL_OFFSET))
+    found = (Yaw.dot(Pitch), offset)
+    for a in found:
+        a.flags.writeable = False # shared by every caller through the cache
+    with _cache_lock:
+        _cache[key] = found
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return found
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+def transform(xyz, psi, theta):
+    """ Converts an (N, 3) array of x, y, z positions in the rotated frame to the original
+    frame in one matrix multiply. Z is positive down, as in rotation().
+    """
+    matrix, offset = pose_transform(psi, theta)
+    return np.asarray(xyz, dtype=float).dot(matrix.T) + offset
+
+def transform_polar(angle, dist_mm, psi, theta):
+    """ Converts lidar samples (angles in degrees and distances) taken at yaw psi and
+    pitch theta to an (N, 3) array of positions in the original frame.
+    """
+    angle_rad = np.radians(angle)
+    dist_mm = np.asarray(dist_mm, dtype=float)
+    xyz = np.column_stack((dist_mm * np.cos(angle_rad), dist_mm * -np.sin(angle_rad), np.zeros(len(dist_mm))))
+    return transform(xyz, psi, theta)
+
+def transform_polar_each(angle, dist_mm, psi, theta):
+    """ As transform_polar, but with a yaw psi and pitch theta (degrees) for every sample, e.g. for
+    samples taken while the servos were moving. All four are arrays of the same length.
+    """
+    angle_rad = np.radians(angle)
+    dist_mm = np.asarray(dist_mm, dtype=float)
+    theta_rad = np.radians(theta)
+    psi_rad = np.radians(psi)
+    c_theta = np.cos(theta_rad)
+    s_theta = np.sin(theta_rad)
+    x = dist_mm * np.cos(angle_rad)
+    y = dist_mm * -np.sin(angle_rad)
+    # Pitch then Yaw, as pose_transform composes them, applied to (x, y, 0)
+    pitched_x = c_theta * x
+    new_x = np.cos(psi_rad) * pitched_x - np.sin(psi_rad) * y
+    new_y = np.sin(psi_rad) * pitched_x + np.cos(psi_rad) * y
+    new_z = -s_theta * x
+    return np.column_stack((new_x - VERTICAL_OFFSET * s_theta, new_y, new_z + VERTICAL_OFFSET * c_theta - VERTICAL_OFFSET))
+
+def rotation(x, y, z, psi, theta):
+    """ Converts from Vehicle-2 (yaw,pitch) reference frame to original frame
+    Input x, y, z in the rotated frame, along with psi and theta
+    returns the position in the original frame. Also handles the translation, since
+    lidar center is not at the center of the pitch rotation servo axis
+    Remember that Z is positive down.
+    For many points at one pose, transform() does them all at once.
+    """
+    matrix, offset = pose_transform(psi, theta)
+    new_x, new_y, new_z = matrix.dot((x, y, z)) + offset
+    return float(new_x), float(new_y), float(new_z)
+
+class ProjectionTable(object):
+    """ Per-pose unit directions of the 360 lidar angles, and offsets, for a fixed set of poses,
+    so that a sample's position in the original frame is
+        dist_mm * directions[pose, angle] + offsets[pose]
+    Z is positive down, as in rotation().
+    poses is a list of dicts with the id, yaw and pitch (degrees) of each pose, as in the pose
+    tables saved with scans. Ids with no entry, up to size if that is larger, are treated as
+    yaw 0, pitch 0 (a flat 2D scan).
+    """
+    def __init__(self, poses, size=0):
+        self.poses = list(poses)
+        size = max([p['id'] + 1 for p in self.poses] + [size])
+        angle_rad = np.radians(np.arange(360))
+        unit = np.column_stack((np.cos(angle_rad), -np.sin(angle_rad), np.zeros(360)))
+        self.directions = np.tile(unit, (size, 1, 1))
+        self.offsets = np.zeros((size, 3))
+        for p in self.poses:
+            matrix, offset = pose_transform(p['yaw'], p['pitch'])
+            self.directions[p['id']] = unit.dot(matrix.T)
+            self.offsets[p['id']] = offset
+
+    def project(self, pose, dist_mm, angles=None):
+        """ Positions of one revolution's samples at a pose: all 360, or just the given angles. """
+        if angles is None:
+            return self.directions[pose] * np.asarray(dist_mm, dtype=float)[:, None] + self.offsets[pose]
+        return self.directions[pose, angles] * np.asarray(dist_mm, dtype=float)[:, None] + self.offsets[pose]
+
+    def project_samples(self, pose, angle, dist_mm):
+        """ Positions of samples given as arrays of pose id, angle and distance, from any mix of poses. """
+        return self.directions[pose, angle] * np.asarray(dist_mm, dtype=float)[:, None] + self.offsets[pose]
+
+    @classmethod
+    def from_angle_file(cls, fn='scan_angles.json'):
+        """ The table for the scan grid in an angle file such as scan_angles.json, with poses numbered
+        as lidar3Dstore does: through the pitch angles in order, then the yaw angles.
+        Tables are cached beside the angle file, and rebuilt when it or VERTICAL_OFFSET changes.
+        """
+        with open(fn, 'rb') as f:
+            contents = f.read()
+        key = hashlib.sha1(contents + repr(float(VERTICAL_OFFSET)).encode('ascii')).hexdigest()
+        cache = fn + '.projection.npz'
+        if os.path.exists(cache):
+            try:
+                cached = np.load(cache)
+                if str(cached['key']) == key:
+                    table = cls([])
+                    table.poses = json.loads(str(cached['poses']))
+                    table.directions = cached['directions']
+                    table.offsets = cached['offsets']
+                    return table
+            except Exception:
+                pass # unreadable, rebuild it
+        angles = json.loads(contents.decode('utf-8'))
+        yaws = sorted(float(x) for x in angles['yaw_angles'])
+        pitches = sorted(float(x) for x in angles['pitch_angles'])
+        table = cls([{'id': i*len(pitches) + j, 'yaw': yaw, 'pitch': pitch}
+                     for i, yaw in enumerate(yaws) for j, pitch in enumerate(pitches)])
+        try:
+            np.savez(cache, key=np.array(key), poses=np.array(json.dumps(table.poses)),
+                     directions=table.directions, offsets=table.offsets)
+        except (IOError, OSError):
+            pass # read-only directory, the table just isn't cached
+        return table
@@ -0,0 +1,170 @@
+#Plans the order a 3D scan visits its poses in, to cut the time spent moving the servos
+#Move times come from the Maestro's speed and acceleration limits for each channel; the
+#pan and tilt servos move together, so a move takes as long as the slower of the two
+#requires numpy
+#
+#Usage:
+#   python scan_planner.py scan_angles.json --speed 10 --acceleration 10 --sweep-speed 4
+
+import json, argparse
+import numpy as np
+from servo_model import ServoModel
+
+ORDERS = ('grid', 'serpentine', 'optimized')
+MOVE_OVERHEAD = 0.02 # seconds per move for the commands and seeing the servos have stopped
+
+def grid_poses(fn='scan_angles.json'):
+    """The poses of the scan grid in an angle file such as scan_angles.json, as dicts of id, yaw and
+pitch angles (degrees) and the servo targets for them. Ids count through the pitch angles,
+then the yaw angles, as rotation.ProjectionTable.from_angle_file numbers them.
+"""
+    with open(fn) as f:
+        angles = json.load(f)
+    yaws = sorted((float(angle), target) for angle, target in angles['yaw_angles'].items())
+    pitches = sorted((float(angle), target) for angle, target in angles['pitch_angles'].items())
+    return [{'id': i*len(pitches) + j, 'yaw': yaw, 'pitch': pitch, 'yaw_target': yaw_target, 'pitch_target': pitch_target}
+            for i, (yaw, yaw_target) in enumerate(yaws) for j, (pitch, pitch_target) in enumerate(pitches)]
+
+class PosePlanner(object):
+    """Orders poses (dicts with yaw_target and pitch_target, see grid_poses) to cut the time spent moving.
+
+yaw, pitch -- ServoModels of the pan (channel 0) and tilt (channel 1) servos
+start -- (yaw target, pitch target) the servos are at before the scan, if known
+"""
+    def __init__(self, yaw, pitch, start=None):
+        self.yaw = yaw
+        self.pitch = pitch
+        self.start = start
+
+    def move_time(self, a, b):
+        return float(max(self.yaw.move_time(a['yaw_target'], b['yaw_target']),
+                         self.pitch.move_time(a['pitch_target'], b['pitch_target']))) + MOVE_OVERHEAD
+
+    def travel_time(self, order):
+        """Seconds spent moving to visit the poses in order, including the move to the first from start."""
+        total = sum(self.move_time(a, b) for a, b in zip(order[:-1], order[1:]))
+        if self.start is not None and order:
+            total += self.move_time({'yaw_target': self.start[0], 'pitch_target': self.start[1]}, order[0])
+        return total
+
+    def grid(self, poses):
+        """Yaw by yaw, each time from the lowest pitch up: the original order."""
+        return sorted(poses, key=lambda p: (p['yaw'], p['pitch']))
+
+    def serpentine(self, poses):
+        """Row by row, reversing direction every row so the servos never swing back across the grid.
+
+Rows of equal yaw and rows of equal pitch are both tried, each from either corner, and the
+quickest is used.
+"""
+        candidates = []
+        for major, minor in (('yaw', 'pitch'), ('pitch', 'yaw')):
+            rows = {}
+            for p in poses:
+                rows.setdefault(p[major], []).append(p)
+            for reverse in (False, True):
+                order = []
+                for n, key in enumerate(sorted(rows, reverse=reverse)):
+                    order.extend(sorted(rows[key], key=lambda p: p[minor], reverse=(n % 2 == 1) != reverse))
+                candidates.append(order)
+        return min(candidates, key=self.travel_time)
+
+    def optimized(self, poses, passes=20):
+        """A tour for any set of poses: the serpentine order improved by 2-opt, reversing any stretch of
+the tour that makes it quicker, until no reversal helps or after passes rounds.
+"""
+        order = self.serpentine(poses)
+        n = len(order)
+        if n < 3:
+            return order
+        yaw = np.array([p['yaw_target'] for p in order], dtype=float)
+        pitch = np.array([p['pitch_target'] for p in order], dtype=float)
+        cost = np.maximum(self.yaw.move_time(yaw[:, None], yaw[None, :]),
+                          self.pitch.move_time(pitch[:, None], pitch[None, :])) + MOVE_OVERHEAD
+        fixed = 0
+        if self.start is not None:
+            # the start position goes in as a first stop that is never moved
+            first = np.maximum(self.yaw.move_time(self.start[0], yaw),
+                               self.pitch.move_time(self.start[1], pitch)) + MOVE_OVERHEAD
+            cost = np.vstack((np.hstack(([0.0], first)), np.column_stack((first, cost))))
+            fixed = 1
+        tour = np.arange(n + fixed)
+        for _ in range(passes):
+            improved = False
+            for i in range(len(tour) - 2):
+                # reversing tour[i+1..j] swaps edges (i, i+1) and (j, j+1) for (i, j) and (i+1, j+1)
+                a, b = tour[i], tour[i + 1]
+                c = tour[i + 2:] # every j
+                d = np.append(tour[i + 3:], -1) # j+1, if the tour goes on after j
+                change = cost[a, c] - cost[a, b] + np.where(d >= 0, cost[b, d] - cost[c, d], 0.0)
+                j = int(np.argmin(change))
+                if change[j] < -1e-9:
+                    tour[i + 1:i + 3 + j] = tour[i + 1:i + 3 + j][::-1]
+                    improved = True
+            if not fixed:
+                # the tour may also start anywhere: reversing tour[0..j] only swaps edge (j, j+1) for (0, j+1)
+                change = cost[tour[0], tour[2:]] - cost[tour[1:-1], tour[2:]]
+                j = int(np.argmin(change))
+                if change[j] < -1e-9:
+                    tour[:j + 2] = tour[:j + 2][::-1]
+                    improved = True
+            if not improved:
+                break
+        return [order[k - fixed] for k in tour[fixed:]]
+
+    def plan(self, poses, order='serpentine'):
+        """The poses in the given order, one of ORDERS."""
+        if order not in ORDERS:
+            raise ValueError('unknown pose order %r, expected one of %s' % (order, ', '.join(ORDERS)))
+        return getattr(self, order)(poses)
+
+def predict_duration(planner, order, dwell_seconds):
+    """(seconds moving, seconds in all) to visit the poses in order, staying dwell_seconds at each."""
+    travel = planner.travel_time(order)
+    return travel, travel + dwell_seconds * len(order)
+
+def sweep_rows(poses, axis='pitch'):
+    """Rows for a continuous sweep of one servo (axis, 'pitch' or 'yaw') across the poses' grid, with the
+other servo stepping through its angles. Each row is a (start, end) pair of poses; the sweep
+direction alternates from row to row, so the sweeping servo never swings back.
+"""
+    other = 'yaw' if axis == 'pitch' else 'pitch'
+    rows = {}
+    for p in poses:
+        rows.setdefault(p[other], []).append(p)
+    sweeps = []
+    for n, key in enumerate(sorted(rows)):
+        row = sorted(rows[key], key=lambda p: p[axis], reverse=n % 2 == 1)
+        sweeps.append((row[0], row[-1]))
+    return sweeps
+
+def predict_sweep(planner, rows, sweep, axis='pitch'):
+    """(seconds stepping between rows, seconds in all) for a continuous sweep of rows (see sweep_rows),
+with the sweeping servo moving as the ServoModel sweep and stepping as the planner's.
+"""
+    starts = [start for start, end in rows]
+    stepping = planner.travel_time(starts[:1]) + sum(planner.move_time(a[1], b[0]) for a, b in zip(rows[:-1], rows[1:]))
+    sweeping = sum(float(sweep.move_time(start[axis + '_target'], end[axis + '_target'])) for start, end in rows)
+    return stepping, stepping + sweeping
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare pose orders for a 3D scan')
+    parser.add_argument('angles', nargs='?', default='scan_angles.json')
+    parser.add_argument('--speed', type=int, default=10, help='Maestro speed setting of both servos')
+    parser.add_argument('--acceleration', type=int, default=10, help='Maestro acceleration setting of both servos')
+    parser.add_argument('--dwell', type=float, default=0.6, help='seconds spent at each pose')
+    parser.add_argument('--sweep-speed', type=int, default=4, help='Maestro speed of the sweeping servo in a continuous sweep')
+    args = parser.parse_args()
+    servo = ServoModel(args.speed, args.acceleration)
+    planner = PosePlanner(servo, servo)
+    poses = grid_poses(args.angles)
+    for order in ORDERS:
+        travel, total = predict_duration(planner, planner.plan(poses, order), args.dwell)
+        print('%-11s  %3d poses  %6.1f s moving    %6.1f s in all' % (order, len(poses), travel, total))
+    for axis in ('pitch', 'yaw'):
+        rows = sweep_rows(poses, axis)
+        stepping, total = predict_sweep(planner, rows, ServoModel(args.sweep_speed, args.acceleration), axis)
+        print('%-11s  %3d rows   %6.1f s stepping  %6.1f s in all' % (axis + ' sweep', len(rows), stepping, total))
+
+if __name__ == '__main__':
+    main()
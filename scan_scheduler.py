@@ -0,0 +1,136 @@
+#Decides how long a 3D scan stays at each pose
+#Rather than waiting a fixed time, the scan moves on as soon as enough complete,
+#checksum-clean revolutions have been captured after the servos settled, and records
+#what each pose took so scan time and coverage can be compared between settings
+#requires numpy
+
+import time
+from threading import Lock
+import numpy as np
+
+class DwellScheduler(object):
+    """Counts the clean revolutions captured at the current pose.
+
+revolutions -- clean revolutions wanted at each pose
+settle_seconds -- revolutions that started less than this after the servos stopped are rejected
+max_missing -- packets a revolution may lack and still count as clean
+rpm_range -- (low, high) measured RPM a clean revolution must have, e.g. to wait out a motor spinning up
+timeout_revolutions -- give up on a pose after this many revolution periods, at the measured RPM
+default_rpm -- RPM assumed for the timeout until one has been measured
+
+Call start_pose() once the servos have stopped at a pose, add() with every revolution
+captured there (from any thread), and move on when done is True; finish_pose() then
+records the pose's statistics in stats.
+"""
+    def __init__(self, revolutions=2, settle_seconds=0.05, max_missing=0, rpm_range=(180, 420),
+                 timeout_revolutions=15, default_rpm=300):
+        self.revolutions = revolutions
+        self.settle_seconds = settle_seconds
+        self.max_missing = max_missing
+        self.rpm_range = rpm_range
+        self.timeout_revolutions = timeout_revolutions
+        self.rpm = float(default_rpm) # last measured
+        self.lock = Lock()
+        self.pose = None
+        self.stats = [] # one dict per finished pose, see finish_pose
+        self.settled = {} # pose -> time its revolutions may start from
+        self.started = None
+        # the current pose, see start_pose
+        self.settled_at = None
+        self.move_seconds = 0.0
+        self.clean = 0
+        self.rejected = {'settling': 0, 'incomplete': 0, 'checksum': 0, 'rpm': 0}
+        self.rpms = []
+        self.angles = np.zeros(360, dtype=np.bool_)
+
+    def start_pose(self, pose, move_seconds=0.0, now=None):
+        """Begin counting at pose (the tag put on its revolutions, whose first item is the pose id)."""
+        if now is None:
+            now = time.time()
+        if self.started is None:
+            self.started = now - move_seconds
+        with self.lock:
+            self.pose = pose
+            self.move_seconds = move_seconds
+            self.settled_at = now + self.settle_seconds
+            self.settled[pose] = self.settled_at
+            self.clean = 0
+            self.rejected = dict.fromkeys(self.rejected, 0)
+            self.rpms = []
+            self.angles = np.zeros(360, dtype=np.bool_)
+
+    def accepts(self, scan):
+        """True if scan was captured entirely after the servos settled at its pose, whether or not
+that is still the current one.
+"""
+        return scan.pose in self.settled and scan.start_time >= self.settled[scan.pose]
+
+    def add(self, scan):
+        """Count one revolution. Returns True if it is clean and was captured at the current pose."""
+        with self.lock:
+            if scan.pose is None or scan.pose != self.pose:
+                return False
+            if scan.mean_rpm:
+                self.rpm = scan.mean_rpm
+            if scan.start_time < self.settled_at:
+                reason = 'settling'
+            elif scan.bad_packets:
+                reason = 'checksum'
+            elif scan.missing > self.max_missing:
+                reason = 'incomplete'
+            elif not self.rpm_range[0] <= scan.mean_rpm <= self.rpm_range[1]:
+                reason = 'rpm'
+            else:
+                self.clean += 1
+                self.rpms.append(scan.mean_rpm)
+                self.angles |= scan.valid
+                return True
+            self.rejected[reason] += 1
+            return False
+
+    @property
+    def period(self):
+        """Seconds per revolution at the measured RPM."""
+        return 60.0 / max(self.rpm, 1.0)
+
+    def timed_out(self, now=None):
+        if self.settled_at is None: # no pose started yet
+            return False
+        if now is None:
+            now = time.time()
+        return now > self.settled_at + self.timeout_revolutions * self.period
+
+    @property
+    def done(self):
+        """True once enough clean revolutions have been captured at the pose, or it has timed out."""
+        return self.clean >= self.revolutions or self.timed_out()
+
+    def finish_pose(self, now=None):
+        """Record the statistics of the current pose, and stop counting. Returns them as a dict."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            loc = self.pose[0] if isinstance(self.pose, tuple) else self.pose
+            entry = {'id': loc, 'move_seconds': self.move_seconds,
+                     'dwell_seconds': now - self.settled_at + self.settle_seconds if self.settled_at is not None else 0.0,
+                     'clean': self.clean, 'rejected': dict(self.rejected),
+                     'rpm': float(np.mean(self.rpms)) if self.rpms else None,
+                     'angles': int(self.angles.sum()), 'timed_out': self.clean < self.revolutions}
+            if isinstance(self.pose, tuple) and len(self.pose) == 3:
+                entry['yaw'], entry['pitch'] = float(self.pose[1]), float(self.pose[2])
+            self.stats.append(entry)
+            self.pose = None
+        return entry
+
+    def summary(self, now=None):
+        """Totals over the finished poses, e.g. to print at the end of a scan."""
+        if now is None:
+            now = time.time()
+        stats = self.stats
+        return {'poses': len(stats),
+                'seconds': now - self.started if self.started is not None else 0.0,
+                'move_seconds': sum(s['move_seconds'] for s in stats),
+                'dwell_seconds': sum(s['dwell_seconds'] for s in stats),
+                'clean': sum(s['clean'] for s in stats),
+                'timed_out': sum(1 for s in stats if s['timed_out']),
+                'mean_angles': float(np.mean([s['angles'] for s in stats])) if stats else 0.0}
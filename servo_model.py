@@ -0,0 +1,37 @@
+#Move timing of a Maestro servo channel, from the speed and acceleration settings given to it
+#Shared by the driver (altMaestro.py), which predicts where each servo is, and the scan
+#planner (scan_planner.py), which predicts how long a scan takes
+#requires numpy
+
+import numpy as np
+
+UNLIMITED_SPEED = 4000.0 # us/s assumed for a channel with no speed limit set, roughly a hobby servo's top speed
+
+class ServoModel(object):
+    """Move times of one Maestro channel, from its speed and acceleration settings.
+
+speed -- as given to set_speed, in units of (0.25 us)/(10 ms); 0 is no limit
+acceleration -- as given to set_acceleration, in units of (0.25 us)/(10 ms)/(80 ms); 0 is no limit
+Targets are in us, as given to set_target. The output speeds up at the acceleration limit
+until it reaches the speed limit, then slows down the same way as it nears the target.
+"""
+    def __init__(self, speed, acceleration, unlimited_speed=UNLIMITED_SPEED):
+        self.speed = speed * 0.25 / 0.01 if speed else unlimited_speed # us/s
+        self.acceleration = acceleration * 0.25 / 0.01 / 0.08 if acceleration else None # us/s^2
+
+    def top_speed(self, distance):
+        """Fastest the output goes (us/s) in a move of distance us: the speed limit, unless the move is too short
+to reach it before slowing down.
+"""
+        if self.acceleration is None:
+            return self.speed
+        return np.minimum(self.speed, np.sqrt(self.acceleration * np.asarray(distance, dtype=float)))
+
+    def move_time(self, start, end):
+        """Seconds to move from target start to target end (either may be an array)."""
+        distance = np.abs(np.asarray(end, dtype=float) - np.asarray(start, dtype=float))
+        if self.acceleration is None:
+            return distance / self.speed
+        ramp = self.speed ** 2 / self.acceleration # distance covered speeding up and slowing down
+        return np.where(distance >= ramp, distance / self.speed + self.speed / self.acceleration,
+                        2 * np.sqrt(distance / self.acceleration))
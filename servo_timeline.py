@@ -0,0 +1,114 @@
+#Servo positions over time, for 3D scans taken while the servos move
+#A thread reads the Maestro's position of each channel over and over (or predicts it from the
+#Device's motion model, checking with the Maestro now and then), keeping every reading
+#with the time it was taken, so the servos' positions at any moment (e.g. when a lidar
+#sample was taken) can be interpolated. Positions are converted to angles with the servo
+#targets and angles of an angle file such as scan_angles.json
+#requires numpy
+
+import time, json
+from threading import Thread, Lock
+import numpy as np
+
+class ServoCalibration(object):
+    """Converts between one servo's Maestro targets (us) and angles (degrees), interpolating between
+the target of each angle in an angle file, e.g. the 'pitch_angles' of scan_angles.json.
+"""
+    def __init__(self, angles):
+        pairs = sorted((float(target), float(angle)) for angle, target in angles.items())
+        self.targets = np.array([target for target, angle in pairs])
+        self.angles = np.array([angle for target, angle in pairs])
+
+    def angle(self, target):
+        """Angle of a target or array of targets, held at the end angles beyond the calibrated range."""
+        return np.interp(target, self.targets, self.angles)
+
+    def target(self, angle):
+        order = np.argsort(self.angles)
+        return np.interp(angle, self.angles[order], self.targets[order])
+
+def load_calibration(fn='scan_angles.json'):
+    """(yaw, pitch) ServoCalibrations from an angle file."""
+    with open(fn) as f:
+        angles = json.load(f)
+    return ServoCalibration(angles['yaw_angles']), ServoCalibration(angles['pitch_angles'])
+
+class ServoTimeline(object):
+    """Positions of Maestro channels, read on a thread while the timeline runs and kept with their times.
+
+device -- an altMaestro.Device; nothing else may talk to it between start() and stop()
+channels -- the channels to read
+interval -- seconds from one reading of all the channels to the next; 0 reads as fast as the Maestro answers
+check_interval -- if given, the positions are only read from the Maestro this often, and in between
+    are taken from device.predicted_position, which the reads keep corrected
+
+Readings from every run are kept, so revolutions still being processed after stop() can be placed.
+"""
+    def __init__(self, device, channels=(0, 1), interval=0.01, check_interval=None):
+        self.device = device
+        self.channels = list(channels)
+        self.interval = interval
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self.times = np.zeros(1024)
+        self.positions = np.zeros((1024, len(self.channels)))
+        self.count = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self._run, name='servo timeline')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop reading, once the reading under way is finished."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        checked = 0.0
+        while self.running:
+            before = time.time()
+            if self.check_interval is not None and before - checked < self.check_interval:
+                positions = [self.device.predicted_position(channel, before) for channel in self.channels]
+                after = before
+            else:
+                positions = self.device.get_positions(self.channels) or [None]
+                after = time.time()
+                checked = after
+            if None not in positions: # a reply timed out, or a position isn't known
+                self.add((before + after) / 2, positions)
+            time.sleep(max(self.interval - (after - before), 0))
+
+    def add(self, t, positions):
+        """Record the positions of the channels at time t."""
+        with self.lock:
+            if self.count == len(self.times): # full, double the space
+                self.times = np.concatenate((self.times, np.zeros(len(self.times))))
+                self.positions = np.vstack((self.positions, np.zeros(self.positions.shape)))
+            self.times[self.count] = t
+            self.positions[self.count] = positions
+            self.count += 1
+
+    def latest(self):
+        """(time, positions) of the last reading, or None before the first."""
+        with self.lock:
+            if not self.count:
+                return None
+            return self.times[self.count - 1], self.positions[self.count - 1].copy()
+
+    def positions_at(self, times):
+        """(len(times), channels) positions interpolated at each of times, held at the first and last
+readings outside the times they cover.
+"""
+        with self.lock:
+            count = self.count
+            recorded_times = self.times[:count]
+            recorded = self.positions[:count]
+        if not count:
+            raise ValueError('no servo positions have been read yet')
+        return np.column_stack([np.interp(times, recorded_times, recorded[:, k]) for k in range(len(self.channels))])
@@ -0,0 +1,89 @@
+#Checks that the batched, polar, per-sample and table transforms in rotation.py agree with
+#the original one-point-at-a-time formulation
+#
+#Usage:
+#   python -m pytest test_rotation.py    (or python -m unittest test_rotation)
+
+import math, unittest, warnings
+import numpy as np
+import rotation as rot
+
+POSES = [(0.0, 0.0), (-80.0, -32.75), (25.0, 7.0), (77.5, 44.0), (180.0, 90.0)]
+
+def reference_rotation(x, y, z, psi, theta):
+    # the original one-point-at-a-time formulation
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', PendingDeprecationWarning) # np.matrix
+        return _reference_rotation(x, y, z, psi, theta)
+
+def _reference_rotation(x, y, z, psi, theta):
+    pos = np.matrix((x, y, z)).T
+    theta_rad = math.radians(theta)
+    psi_rad = math.radians(psi)
+    Yaw = np.matrix(((math.cos(psi_rad), -math.sin(psi_rad), 0),(math.sin(psi_rad), math.cos(psi_rad), 0),(0, 0, 1)))
+    Pitch = np.matrix(((math.cos(theta_rad), 0, math.sin(theta_rad)),(0, 1, 0),(-math.sin(theta_rad), 0, math.cos(theta_rad))))
+    new_pos = (Yaw*Pitch)*pos
+    return (float(new_pos[0, 0]) - rot.VERTICAL_OFFSET * math.sin(theta_rad), float(new_pos[1, 0]),
+            float(new_pos[2, 0]) + rot.VERTICAL_OFFSET * math.cos(theta_rad) - rot.VERTICAL_OFFSET)
+
+class TransformTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_batched_and_scalar_match_reference(self):
+        for psi, theta in POSES:
+            xyz = self.rng.uniform(-6000, 6000, (200, 3))
+            expected = np.array([reference_rotation(x, y, z, psi, theta) for x, y, z in xyz])
+            self.assertTrue(np.allclose(rot.transform(xyz, psi, theta), expected), (psi, theta))
+            self.assertTrue(np.allclose([rot.rotation(x, y, z, psi, theta) for x, y, z in xyz], expected), (psi, theta))
+
+    def test_polar_matches_reference(self):
+        for psi, theta in POSES:
+            angle = self.rng.randint(0, 360, 200)
+            dist = self.rng.randint(0, 0x3fff, 200)
+            flat = [(d * math.cos(math.radians(a)), -d * math.sin(math.radians(a)), 0) for a, d in zip(angle, dist)]
+            expected = np.array([reference_rotation(x, y, z, psi, theta) for x, y, z in flat])
+            self.assertTrue(np.allclose(rot.transform_polar(angle, dist, psi, theta), expected), (psi, theta))
+
+    def test_polar_each_uses_each_samples_pose(self):
+        psi = self.rng.uniform(-80, 80, 300)
+        theta = self.rng.uniform(-35, 45, 300)
+        angle = self.rng.randint(0, 360, 300)
+        dist = self.rng.randint(0, 0x3fff, 300)
+        expected = np.array([rot.transform_polar([a], [d], p, t)[0] for a, d, p, t in zip(angle, dist, psi, theta)])
+        self.assertTrue(np.allclose(rot.transform_polar_each(angle, dist, psi, theta), expected))
+
+    def test_pitch_is_in_degrees(self):
+        # at 90 degrees of pitch the lidar center is swung fully forward of the pitch axis
+        self.assertTrue(np.allclose(rot.rotation(0, 0, 0, 0, 90), (-rot.VERTICAL_OFFSET, 0, -rot.VERTICAL_OFFSET)))
+
+    def test_cache_keeps_most_recent_poses(self):
+        rot.clear_cache()
+        for i in range(rot.CACHE_SIZE + 10):
+            rot.pose_transform(i, 0)
+        self.assertEqual(len(rot._cache), rot.CACHE_SIZE)
+        self.assertNotIn((0.0, 0.0, rot.VERTICAL_OFFSET), rot._cache)
+        rot.clear_cache()
+
+class ProjectionTableTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.poses = [{'id': 0, 'yaw': -80.0, 'pitch': -32.75}, {'id': 2, 'yaw': 25.0, 'pitch': 7.0}]
+        self.table = rot.ProjectionTable(self.poses)
+
+    def test_revolutions_match_transform_polar(self):
+        dist = self.rng.randint(0, 0x3fff, 360)
+        self.assertTrue(np.allclose(self.table.project(2, dist), rot.transform_polar(np.arange(360), dist, 25.0, 7.0)))
+        # ids missing from the table are left flat
+        self.assertTrue(np.allclose(self.table.project(1, dist), rot.transform_polar(np.arange(360), dist, 0.0, 0.0)))
+
+    def test_mixed_samples_match_transform_polar(self):
+        pose = self.rng.choice([0, 2], 500)
+        angle = self.rng.randint(0, 360, 500)
+        dist = self.rng.randint(0, 0x3fff, 500)
+        angles = dict((p['id'], (p['yaw'], p['pitch'])) for p in self.poses)
+        expected = np.array([rot.transform_polar([a], [d], *angles[p])[0] for p, a, d in zip(pose, angle, dist)])
+        self.assertTrue(np.allclose(self.table.project_samples(pose, angle, dist), expected))
+
+if __name__ == '__main__':
+    unittest.main()